@@ -1,19 +1,27 @@
+import contextvars
 import re
 import traceback
 from time import monotonic
 
 import asyncio
 from urllib.parse import urlparse, urljoin
-from datetime import datetime, timedelta
+from xml.sax.saxutils import escape
 
 import aiohttp
-from aiohttp import ClientConnectorError
+from aiohttp import ClientConnectorError, ServerDisconnectedError
 
 from plex.adapters import remove_adapter
-from utils import (xml2dict, UPNP_RC_SERVICE_TYPE, UPNP_AVT_SERVICE_TYPE, g,
+from plex.transcode import parse_sink_protocols
+from utils import (xml2dict, UPNP_RC_SERVICE_TYPE, UPNP_AVT_SERVICE_TYPE, UPNP_CM_SERVICE_TYPE, g,
                    same_service, service_version, soap_response_body, as_list,
-                   CONTROL_RETRY_DELAYS, CONTROL_RETRY_BUDGET, upnp_error_code,
+                   CONTROL_RETRY_BUDGET, retry_offsets, upnp_error_code,
                    is_transient_failure)
+from utils.timings import stage
+from utils.deadline import remaining
+from utils.lastchange import parse_state_variable_pairs
+from utils.breaker import CircuitBreaker, BREAKER_PROBE_TIMEOUT
+from utils.scheduler import SoapScheduler, Preempted
+from utils.profile import RendererProfile, UnsupportedAction
 from settings import settings
 
 PAYLOAD_FMT = '<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" ' \
@@ -32,8 +40,61 @@ DEFAULT_ACTION_DATA = {
 
 ERROR_COUNT_TO_REMOVE = 20
 
+CONTROL_ATTEMPT_TIMEOUT = 5
+
+# GENA: how long to wait for SUBSCRIBE/UNSUBSCRIBE, the shortest gap between
+# renewals, and how long to wait after a failed SUBSCRIBE, doubling up to the max.
+GENA_REQUEST_TIMEOUT = 3
+GENA_MIN_RENEW_SECS = 5
+GENA_RETRY_SECS = 15
+GENA_RETRY_MAX_SECS = 300
+
+# UPnP errors that mean the action will never work on this renderer: Invalid
+# Action, Optional Action Not Implemented, and Seek mode not supported.
+UNSUPPORTED_ACTION_CODES = ("401", "602", "710")
+
+# A fresh subscription whose initial event has not come by now counts against
+# the renderer's events, see RendererProfile.
+EVENT_GRACE_SECS = 10
+
+# A connection failure while other requests were in flight, this soon after the
+# renderer last answered, is taken as it not coping with parallel requests.
+CONCURRENCY_AWAKE_SECS = 5
+
+# A warm-up keeps the renderer's control connection in use for this long after
+# the last sign of a controller's interest, with a request this often. aiohttp
+# drops idle connections after 15s.
+WARM_WINDOW_SECS = 30
+WARM_INTERVAL_SECS = 10
+
+# GetStateVariables replies missing what was asked for, before it is given up on.
+BATCH_FAILURES_TO_DISABLE = 3
+
 devices = []
 
+# SID -> DlnaDeviceService, for every subscription currently held.
+event_subscriptions = {}
+# SID -> when, for events that came before the SUBSCRIBE response naming their SID.
+early_events = {}
+
+
+def note_early_event(sid: str):
+    """Remember an event for a SID not known yet, for the subscription it turns out to be."""
+    now = monotonic()
+    for old in [s for s, at in early_events.items() if now - at > EVENT_GRACE_SECS]:
+        del early_events[old]
+    early_events[sid] = now
+
+
+def parse_gena_timeout(value, default):
+    """Seconds from a GENA TIMEOUT header, "Second-1800" or "Second-infinite"."""
+    if not value:
+        return default
+    tail = value.strip().rsplit("-", 1)[-1]
+    if tail.lower() == "infinite":
+        return GENA_RETRY_MAX_SECS * 2
+    return int(tail) if tail.isdigit() else default
+
 
 class DlnaDeviceService(object):
 
@@ -44,24 +105,41 @@ class DlnaDeviceService(object):
         self.spec_url = urljoin(device.location_url, service_dict['SCPDURL'])
         self.urn = self.service_type
         self.device = device
-        self.subscribed = False
         self._spec_info = None
-        self.next_subscribe_call_time = None
+        self.sid = None
+        self.sid_expires = 0
+        self._action_names = None
+        self.batch_failures = 0
+        self.last_event_at = None
 
     def payload_from_template(self, action: str, data: dict):
         fields = ''
         for tag, value in data.items():
-            fields += '<{tag}>{value}</{tag}>'.format(tag=tag, value=value)
+            fields += '<{tag}>{value}</{tag}>'.format(tag=tag, value=escape(str(value)))
         payload = PAYLOAD_FMT.format(action=action, urn=self.urn, fields=fields)
         return payload
 
-    async def control(self, action: str, data: dict, client: aiohttp.ClientSession = None):
+    async def control(self, action: str, data: dict, client: aiohttp.ClientSession = None, background=False):
+        """Invoke a SOAP action, returning its response body or None on failure.
+
+        Background calls are the state loop's polls. They are made once, since
+        the next poll comes round anyway, and not at all while the device's
+        breaker is open. Everything else takes the wake-up retry path, and
+        raises UnsupportedAction for an action the renderer has been found not
+        to support, rather than come back empty handed without a word.
+        """
         headers = {
             'Content-type': 'text/xml',
             'SOAPACTION': '"{}#{}"'.format(self.urn, action),
             'charset': 'utf-8',
             'User-Agent': '{}/{}'.format(__file__, '1.0')
         }
+        if self.device.profile.is_unsupported(action):
+            if not background:
+                raise UnsupportedAction(f"{self.device.name} refused {action} as unsupported")
+            if __debug__:
+                print(f"dlna {self.device.name} {action} skipped, refused as unsupported before")
+            return None
         if client is None:
             client = g.http
         action_spec = await self.get_action_spec(action, client=client)
@@ -85,47 +163,88 @@ class DlnaDeviceService(object):
                 if argument.name in DEFAULT_ACTION_DATA.keys() and argument.name not in data.keys():
                     data[argument.name] = DEFAULT_ACTION_DATA[argument.name]
         payload = self.payload_from_template(action, data)
-
+        # A command from a controller has only as long as the controller waits.
+        left = remaining()
+        if left is not None and left <= 0:
+            print(f"dlna {self.device.name} {action} not sent, its deadline has passed")
+            return None
+        budget = CONTROL_RETRY_BUDGET if left is None else min(CONTROL_RETRY_BUDGET, left)
+        offsets = retry_offsets(self.device.profile.wake_latencies, budget=budget)
+        attempt_timeout = CONTROL_ATTEMPT_TIMEOUT if left is None else min(CONTROL_ATTEMPT_TIMEOUT, left)
+        probe = False
+        if background:
+            allowed, probe = self.device.breaker.allow_background()
+            if not allowed:
+                return None
+            offsets = (0,)
+            if probe:
+                attempt_timeout = BREAKER_PROBE_TIMEOUT
+        with stage(f"soap {action}"):
+            try:
+                return await self._post_with_retries(action, payload, headers, client, offsets, attempt_timeout,
+                                                     background=background, budget=budget)
+            finally:
+                if probe:
+                    self.device.breaker.release_probe()
+
+    async def _post_with_retries(self, action: str, payload: str, headers: dict, client: aiohttp.ClientSession,
+                                 offsets=(0,), attempt_timeout=CONTROL_ATTEMPT_TIMEOUT,
+                                 background=False, budget=CONTROL_RETRY_BUDGET):
+        breaker = self.device.breaker
         last_error = None
-        deadline = monotonic() + CONTROL_RETRY_BUDGET
-        for delay in CONTROL_RETRY_DELAYS:
-            if delay:
-                await asyncio.sleep(delay)
-            if monotonic() >= deadline:
+        refused_at = None
+        counted = False
+        started = monotonic()
+        deadline = started + budget
+        for offset in offsets:
+            # Attempts keep to their times from the start, however long the
+            # previous one took to fail.
+            if started + offset >= deadline:
+                last_error = f"{last_error} (retry budget spent)"
+                break
+            wait = started + offset - monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            timeout = min(attempt_timeout, deadline - monotonic())
+            if timeout <= 0:
                 last_error = f"{last_error} (retry budget spent)"
                 break
+            sent_at = monotonic()
+            others_in_flight = self.device.scheduler.active > 0
             try:
-                async with client.post(self.control_url, data=payload.encode('utf8'), headers=headers,
-                                       timeout=5) as response:
-                    if not response.ok:
-                        body = await response.text()
-                        code = upnp_error_code(body)
-                        if is_transient_failure(response.status, code):
-                            last_error = f"{response.status} upnp error {code}"
-                            print(f"dlna {self.device.name} {action} not ready ({last_error}), retrying")
-                            continue
-                        raise Exception(f"service {self.control_url} {action} {response.status} {body}")
-                    self.device.repeat_error_count = 0
-                    info = xml2dict(await response.text())
-                    error = info.Envelope.Body.Fault.detail.UPnPError.get('errorDescription')
-                    if error is not None:
-                        print(f"dlna device control request error {info.toDict()}")
-                        return None
-                    return soap_response_body(info, action, self.device.name)
+                answered, result = await self.device.scheduler.run(
+                    lambda: self._post(action, payload, headers, client, timeout), background=background)
+                if answered:
+                    if refused_at is not None:
+                        self.device.profile.record_wake(monotonic() - refused_at)
+                    return result
+                last_error = result
+                print(f"dlna {self.device.name} {action} not ready ({last_error}), retrying")
+                continue
+            except Preempted:
+                return None
             except Exception as e:
                 # A renderer waking from standby refuses connections before it
                 # refuses actions, so those are retried here too, and only counted
                 # against the device once the retries are spent.
-                if isinstance(e, (ClientConnectorError, asyncio.TimeoutError)):
+                if isinstance(e, (ClientConnectorError, ServerDisconnectedError, asyncio.TimeoutError)):
                     last_error = f"{e.__class__.__name__} {e}"
+                    if not background or self.device.first_failure_of_tick():
+                        counted = True
+                        breaker.record_failure(background)
+                    if refused_at is None:
+                        refused_at = sent_at
+                    if others_in_flight and monotonic() - self.device.last_answer_at < CONCURRENCY_AWAKE_SECS:
+                        self.device.lower_concurrency()
                     continue
                 print(f"dlna {self.device.name} {action} control error {e.__class__.__name__} {str(e)}")
                 if "different loop" in str(e):
                     traceback.print_tb(e.__traceback__)
                 return None
 
-        print(f"dlna {self.device.name} {action} gave up after {len(CONTROL_RETRY_DELAYS)} tries: {last_error}")
-        if last_error and "ClientConnectorError" in last_error:
+        if len(offsets) > 1:
+            print(f"dlna {self.device.name} {action} gave up after {len(offsets)} tries: {last_error}")
+        if counted and last_error and "ClientConnectorError" in last_error:
             self.device.repeat_error_count += 1
             played = settings.device_was_played(self.device.uuid)
             if played and self.device.repeat_error_count == ERROR_COUNT_TO_REMOVE:
@@ -140,27 +259,127 @@ class DlnaDeviceService(object):
                     asyncio.run_coroutine_threadsafe(self.device.remove_self(), self.device.loop)
         return None
 
+    async def _post(self, action: str, payload: str, headers: dict, client: aiohttp.ClientSession, timeout):
+        """One attempt. Returns (True, response body) once the renderer has
+        answered, or (False, reason) when it is not ready yet and worth retrying."""
+        async with client.post(self.control_url, data=payload.encode('utf8'), headers=headers,
+                               timeout=timeout) as response:
+            self.device.breaker.record_success()
+            self.device.last_answer_at = monotonic()
+            if not response.ok:
+                body = await response.text()
+                code = upnp_error_code(body)
+                if code in UNSUPPORTED_ACTION_CODES:
+                    # The request already names the service as the renderer's
+                    # description does, but a 401 also comes back for a request
+                    # it did not like, so only the same refusal again and again
+                    # counts.
+                    if self.device.profile.record_refusal(action, code):
+                        print(f"dlna {self.device.name} does not support {action} ({code}), not sending it again")
+                    else:
+                        print(f"dlna {self.device.name} refused {action} ({code})")
+                if is_transient_failure(response.status, code):
+                    return False, f"{response.status} upnp error {code}"
+                raise Exception(f"service {self.control_url} {action} {response.status} {body}")
+            self.device.repeat_error_count = 0
+            self.device.profile.record_accepted(action)
+            info = xml2dict(await response.text())
+            error = info.Envelope.Body.Fault.detail.UPnPError.get('errorDescription')
+            if error is not None:
+                print(f"dlna device control request error {info.toDict()}")
+                return True, None
+            return True, soap_response_body(info, action, self.device.name)
+
+    @property
+    def evented(self):
+        """Whether the renderer is currently sending this service's events to us."""
+        return self.sid is not None and monotonic() < self.sid_expires \
+            and self.device.profile.events_trusted(self.service_type)
+
+    def event_received(self):
+        if self.last_event_at is None:
+            self.device.profile.record_event(self.service_type, True)
+        self.last_event_at = monotonic()
+
+    def _check_initial_event(self, sid):
+        # The initial event is due right after SUBSCRIBE, carrying every evented variable.
+        if self.sid == sid and self.last_event_at is None:
+            print(f"dlna {self.device.name} sent no event for {self.service_type} subscription")
+            self.device.profile.record_event(self.service_type, False)
+
+    def _forget_sid(self):
+        if self.sid is not None:
+            event_subscriptions.pop(self.sid, None)
+        self.sid = None
+        self.sid_expires = 0
+
     async def subscribe(self, timeout_sec=120):
+        """SUBSCRIBE, or renew the subscription we already hold.
+
+        Returns the seconds to wait before renewing, or None on failure. A
+        renewal the renderer no longer knows about (412) falls back to a fresh
+        subscription, since it has forgotten us, e.g. after a reboot.
+        """
         if settings.host_ip is None:
             print("dlna subscribe no host ip")
-            return False
-        if self.next_subscribe_call_time is not None:
-            if datetime.utcnow() < self.next_subscribe_call_time:
-                return
+            return None
         headers = {
-            'Cache-Control': 'no-cache',
             'User-Agent': '{}/{}'.format(__file__, '1.0'),
+            'Timeout': f'Second-{timeout_sec}'
+        }
+        if self.sid is not None:
+            status, granted = await self._send_subscribe({**headers, 'SID': self.sid})
+            if status == 200:
+                return self._granted(granted, timeout_sec)
+            print(f"renew dlna sub {self.device.name} {self.service_type} failed {status}, subscribing again")
+            self._forget_sid()
+        headers.update({
+            'Cache-Control': 'no-cache',
             'NT': 'upnp:event',
             'Callback': '<http://' + settings.host_ip + ':' + str(settings.http_port) + '/dlna/callback/'
                         + self.device.uuid + '>',
-            'Timeout': f'Second-{timeout_sec}'
-        }
+        })
         print(f"sub dlna device {self.device.name} {self.service_type}")
-        async with g.http.request("SUBSCRIBE", self.event_url, headers=headers) as response:
-            if response.ok:
-                self.next_subscribe_call_time = datetime.utcnow() + timedelta(seconds=(timeout_sec // 2))
-                return True
-        return False
+        status, granted = await self._send_subscribe(headers)
+        if status != 200 or not self.sid:
+            return None
+        event_subscriptions[self.sid] = self
+        self.last_event_at = None
+        if early_events.pop(self.sid, None) is not None:
+            # the initial event beat this response, and was applied by the uuid
+            self.event_received()
+        asyncio.get_running_loop().call_later(EVENT_GRACE_SECS, self._check_initial_event, self.sid)
+        return self._granted(granted, timeout_sec)
+
+    async def _send_subscribe(self, headers):
+        try:
+            async with g.http.request("SUBSCRIBE", self.event_url, headers=headers,
+                                      timeout=GENA_REQUEST_TIMEOUT) as response:
+                if response.status == 200 and 'SID' not in headers:
+                    self.sid = response.headers.get('SID')
+                return response.status, response.headers.get('TIMEOUT')
+        except Exception as e:
+            print(f"sub dlna device {self.device.name} {self.service_type} error {e.__class__.__name__} {e}")
+            return None, None
+
+    def _granted(self, granted, asked):
+        timeout = parse_gena_timeout(granted, asked)
+        self.sid_expires = monotonic() + timeout
+        return max(timeout // 2, GENA_MIN_RENEW_SECS)
+
+    async def unsubscribe(self):
+        sid = self.sid
+        self._forget_sid()
+        if sid is None:
+            return
+        print(f"unsub dlna device {self.device.name} {self.service_type}")
+        try:
+            async with g.http.request("UNSUBSCRIBE", self.event_url, headers={'SID': sid},
+                                      timeout=GENA_REQUEST_TIMEOUT):
+                pass
+        except Exception as e:
+            # It lapses on its own once the timeout runs out.
+            print(f"unsub dlna device {self.device.name} {self.service_type} error {e.__class__.__name__} {e}")
 
     async def get_spec(self, client: aiohttp.ClientSession = None):
         if self._spec_info is not None:
@@ -184,6 +403,14 @@ class DlnaDeviceService(object):
                 return action
         return None
 
+    def supports(self, action_name):
+        """Whether the SCPD lists this action. False until the SCPD has been fetched."""
+        if self._action_names is None:
+            if self._spec_info is None:
+                return False
+            self._action_names = {a['name'] for a in as_list(self._spec_info['scpd']['actionList']['action'])}
+        return action_name in self._action_names
+
     async def get_state_variables(self):
         spec = await self.get_spec()
         return spec['scpd']['serviceStateTable']['stateVariable']
@@ -201,9 +428,22 @@ class DlnaDevice(object):
         self.volume_max = None
         self.volume_min = None
         self.volume_step = None
+        # mime types from ConnectionManager's Sink list, None when unknown or anything goes
+        self.sink_protocols = None
         self.uuid = None
         self.loop = asyncio.get_running_loop()
         self.repeat_error_count = 0
+        # bumped by the state loop every tick; its polls failing together are one failure
+        self.poll_tick = 0
+        self._failed_tick = None
+        self._subscribe_task: asyncio.Task = None
+        self._warm_task: asyncio.Task = None
+        self.warm_until = 0
+        self.last_answer_at = float("-inf")
+        # replaced by the persisted one once the UDN is known
+        self.profile = RendererProfile()
+        self.breaker = CircuitBreaker(location_url)
+        self.scheduler = SoapScheduler(location_url, limit=settings.dlna_concurrency)
 
     async def get_data(self):
         if self.info is None:
@@ -246,8 +486,11 @@ class DlnaDevice(object):
             url = urlparse(self.location_url)
             self.ip = url.hostname
             self.name = settings.dlna_name_alias(self.uuid, self.name, self.ip)
+            self.breaker.name = self.scheduler.name = self.name
+            self.load_profile()
             await self.get_volume_info()
             await asyncio.gather(*[s.get_spec() for s in self.services.values()])
+            await self.get_sink_protocols()
 
     async def _find_service_by_action(self, action):
         await self.get_data()
@@ -258,11 +501,12 @@ class DlnaDevice(object):
         return None
 
     def __getattr__(self, item):
-        def action(data: dict = {}, client: aiohttp.ClientSession = None):
-            return self.action(item, data=data, client=client)
+        def action(data: dict = {}, client: aiohttp.ClientSession = None, background=False):
+            return self.action(item, data=data, client=client, background=background)
         return action
 
-    async def action(self, action: str, data: dict = {}, service_type: str = None, client: aiohttp.ClientSession = None):
+    async def action(self, action: str, data: dict = {}, service_type: str = None, client: aiohttp.ClientSession = None,
+                     background=False):
         await self.get_data()
         service = None
         if service_type is not None:
@@ -273,7 +517,7 @@ class DlnaDevice(object):
             service = await self._find_service_by_action(action)
             if service is None:
                 raise Exception(f"action not found {action}")
-        return await service.control(action, data, client=client)
+        return await service.control(action, data, client=client, background=background)
 
     def _get_service(self, service_type: str):
         service = self.services.get(service_type)
@@ -290,20 +534,137 @@ class DlnaDevice(object):
     async def subscribe(self, service_type: str = UPNP_AVT_SERVICE_TYPE, timeout_sec=120):
         await self.get_data()
         service = self._get_service(service_type)
-        await service.subscribe(timeout_sec=timeout_sec)
+        return await service.subscribe(timeout_sec=timeout_sec)
+
+    def warm_up(self):
+        """Wake the renderer ahead of a command that is probably on its way.
+
+        A controller opening the player list or subscribing to a timeline is
+        about to send playMedia. A renderer in standby takes seconds to answer
+        its first request, and without this those seconds are spent inside
+        playMedia. A GetTransportInfo now wakes its stack and opens a
+        keep-alive connection in the shared session, and a few more keep both
+        that way for WARM_WINDOW_SECS after the last call here.
+        """
+        self.warm_until = monotonic() + WARM_WINDOW_SECS
+        if self._warm_task is not None and not self._warm_task.done():
+            return
+        # A context of its own: not bound by the deadline of the request that
+        # asked for it, nor counted in its timings.
+        self._warm_task = asyncio.create_task(self._keep_warm(), name=f"warm {self.name}",
+                                              context=contextvars.Context())
+
+    async def _keep_warm(self):
+        started = monotonic()
+        try:
+            if await self._warm() and __debug__:
+                print(f"dlna {self.name} warmed up in {int((monotonic() - started) * 1000)}ms")
+            while monotonic() < self.warm_until:
+                await asyncio.sleep(min(WARM_INTERVAL_SECS, max(self.warm_until - monotonic(), 0)))
+                await self._warm()
+        except Exception as e:
+            print(f"dlna {self.name} warm up failed {e.__class__.__name__} {e}")
+
+    async def _warm(self):
+        # In the background lane, so a command is not kept waiting behind it. A
+        # renderer behind an open breaker is away; its probes tell when it is back.
+        if not self.breaker.closed:
+            return False
+        return await self.GetTransportInfo(background=True) is not None
+
+    def first_failure_of_tick(self):
+        """Whether a background call's connection failure is the first of this state loop tick."""
+        if self._failed_tick == self.poll_tick:
+            return False
+        self._failed_tick = self.poll_tick
+        return True
+
+    def load_profile(self):
+        uuid, loop = self.uuid, self.loop
+
+        def save(profile: dict):
+            # the state loop learns things too; the data file is only written from the main loop
+            loop.call_soon_threadsafe(settings.save_device_profile, uuid, profile)
+
+        self.profile = RendererProfile(settings.device_profile(uuid), save=save)
+        if self.profile.max_concurrency:
+            self.scheduler.limit = max(1, min(self.scheduler.limit, self.profile.max_concurrency))
+
+    def lower_concurrency(self):
+        limit = self.profile.record_concurrent_failure(self.scheduler.limit)
+        if limit is not None:
+            print(f"dlna {self.name} fails under parallel requests, sending {limit} at a time from now on")
+            self.scheduler.limit = limit
+
+    def batch_supported(self, service_type: str):
+        """Whether the state of this service can be read with one GetStateVariables call."""
+        service = self._get_service(service_type)
+        return service is not None and service.batch_failures < BATCH_FAILURES_TO_DISABLE \
+            and service.supports("GetStateVariables") and not self.profile.is_unsupported("GetStateVariables")
+
+    async def query_state_variables(self, service_type: str, names: list, client: aiohttp.ClientSession = None,
+                                    background=False):
+        """Read several state variables in one request, returning {name: value}, or None.
 
-    async def loop_subscribe(self, service_type: str = UPNP_AVT_SERVICE_TYPE, timeout_sec=120):
+        A renderer that lists GetStateVariables and then answers without what was
+        asked for stops being asked after a few tries, and is polled with the
+        individual actions instead.
+        """
         service = self._get_service(service_type)
-        if service.subscribed:
-            return
-        service.subscribed = True
-        while service.subscribed:
-            await self.subscribe(service_type=service_type, timeout_sec=timeout_sec)
-            await asyncio.sleep(timeout_sec // 2)
+        result = await service.control("GetStateVariables",
+                                       {"InstanceID": 0, "StateVariableList": ",".join(names)},
+                                       client=client, background=background)
+        variables = parse_state_variable_pairs(result.StateVariableValuePairs) if result else {}
+        if all(name in variables for name in names):
+            service.batch_failures = 0
+            return variables
+        if result is not None:
+            # an answer without the variables; no answer at all, from a timeout,
+            # a dropped connection or a command taking the lane, says nothing
+            service.batch_failures += 1
+            if service.batch_failures == BATCH_FAILURES_TO_DISABLE:
+                print(f"dlna {self.name} GetStateVariables did not answer for {names}, polling actions instead")
+                self.profile.mark_unsupported("GetStateVariables")
+        return None
 
-    def stop_subscribe(self, service_type: str = UPNP_AVT_SERVICE_TYPE):
+    def evented(self, service_type: str):
         service = self._get_service(service_type)
-        service.subscribed = False
+        return service is not None and service.evented
+
+    async def loop_subscribe(self, timeout_sec=120):
+        """Hold AVTransport and RenderingControl subscriptions, renewing each before it lapses.
+
+        Runs once per device; later calls return straight away.
+        """
+        if self._subscribe_task is not None and not self._subscribe_task.done():
+            return
+        self._subscribe_task = asyncio.current_task()
+        services = [self._get_service(t) for t in (UPNP_AVT_SERVICE_TYPE, UPNP_RC_SERVICE_TYPE)]
+        retry = {s: GENA_RETRY_SECS for s in services}
+        renew_at = {s: 0 for s in services}
+        while True:
+            for service in services:
+                if monotonic() < renew_at[service]:
+                    continue
+                wait = await service.subscribe(timeout_sec=timeout_sec)
+                if wait is None:
+                    # Some renderers do not event RenderingControl at all, and
+                    # then are polled for volume as before.
+                    wait = retry[service]
+                    retry[service] = min(retry[service] * 2, GENA_RETRY_MAX_SECS)
+                else:
+                    retry[service] = GENA_RETRY_SECS
+                renew_at[service] = monotonic() + wait
+            await asyncio.sleep(max(0, min(renew_at.values()) - monotonic()))
+
+    async def stop_subscribe(self):
+        if self._warm_task is not None:
+            self._warm_task.cancel()
+        task, self._subscribe_task = self._subscribe_task, None
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        await asyncio.gather(*[self._get_service(t).unsubscribe()
+                               for t in (UPNP_AVT_SERVICE_TYPE, UPNP_RC_SERVICE_TYPE)])
 
     async def get_volume_info(self):
         await self.get_data()
@@ -323,17 +684,36 @@ class DlnaDevice(object):
         except Exception:
             pass
 
+    async def get_sink_protocols(self):
+        """Learn what the renderer plays, so tracks it cannot are transcoded up front."""
+        service = self._get_service(UPNP_CM_SERVICE_TYPE)
+        if service is None:
+            return
+        try:
+            info = await service.control("GetProtocolInfo", {})
+        except Exception as e:
+            print(f"dlna {self.name} GetProtocolInfo failed {e.__class__.__name__} {e}")
+            return
+        if info:
+            self.sink_protocols = parse_sink_protocols(info.Sink if isinstance(info.Sink, str) else "")
+            if self.sink_protocols:
+                print(f"dlna {self.name} plays {', '.join(sorted(self.sink_protocols))}")
+
     async def remove_self(self):
         devices.remove(self)
         from plex.adapters import adapter_by_device, remove_adapter
         from plex.subscribe import sub_man
-        self.stop_subscribe()
+        from plex.timeline_reporter import timeline_reporter
+        from plex.plex_tv import plex_tv_publisher
+        await self.stop_subscribe()
         adapter = adapter_by_device(self)
-        adapter.state.state = "STOPPED"
+        adapter.state.publish(state="STOPPED")
         adapter.state.looping_wait_event.set()
         adapter.state._thread_should_stop = True
         await sub_man.notify_device_disconnected(self)
         await sub_man.notify_server_device(self, force=True)
+        timeline_reporter.forget(self)
+        plex_tv_publisher.forget(self)
         adapter.queue = None
         remove_adapter(adapter)
 
@@ -356,9 +736,10 @@ async def get_device_data():
 
 
 async def get_device_by_uuid(uuid):
-    for device in devices:
-        if device.uuid == uuid:
-            await device.get_data()
-            return device
+    with stage("device lookup"):
+        for device in devices:
+            if device.uuid == uuid:
+                await device.get_data()
+                return device
     print(f"device uuid not found {uuid}")
     return None
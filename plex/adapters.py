@@ -1,18 +1,52 @@
 import asyncio
 from datetime import timedelta, datetime
 import random
-from threading import Thread, current_thread
+from time import monotonic
+from threading import Thread, Lock, current_thread
 
 import aiohttp
 from dotmap import DotMap
 from starlette.datastructures import QueryParams
 
-from plex.play_queue import PlayQueue
-from utils import parse_timedelta, convert_volume, g, pms_header, fallback_charset, clamp_elapsed
+from plex.play_queue import PlayQueue, UNLIMITED
+from plex.prefetch import Prefetcher, upcoming_offsets
+from plex.plex_tv import plex_tv_publisher
+from plex.routes import pms_routes
+from utils import (parse_timedelta, convert_volume, fallback_charset, clamp_elapsed,
+                   UPNP_AVT_SERVICE_TYPE, UPNP_RC_SERVICE_TYPE)
+from utils.coalesce import Coalescer
+from utils.lastchange import upnp_time_ms
+from utils.profile import UnsupportedAction
+from utils.resolver import plex_direct_address
 from settings import settings
 
 adapters = {}
 
+PLEX_STATES = {
+    "PLAYING": "playing",
+    "STOPPED": "stopped",
+    "NO_MEDIA_PRESENT": "stopped",
+    "PAUSED_PLAYBACK": "paused",
+    "TRANSITIONING": "playing",
+}
+
+# The actions the state loop polls, by service, and the state variable behind
+# each field of their replies that it reads.
+POLLED_ACTIONS = {
+    UPNP_AVT_SERVICE_TYPE: {
+        "GetPositionInfo": {"RelTime": "RelativeTimePosition", "TrackURI": "CurrentTrackURI",
+                            "TrackDuration": "CurrentTrackDuration"},
+        "GetTransportInfo": {"CurrentTransportState": "TransportState"},
+    },
+    UPNP_RC_SERVICE_TYPE: {
+        "GetVolume": {"CurrentVolume": "Volume"},
+        "GetMute": {"CurrentMute": "Mute"},
+    },
+}
+
+# Seconds between polls of a renderer someone is following.
+FAST_LOOP_INTERVAL = 0.8
+
 
 def adapter_by_device(device, query_params: QueryParams = None):
     a = adapters.get(device.uuid, None)
@@ -28,6 +62,7 @@ def remove_adapter(adapter):
     del adapters[adapter.dlna.uuid]
 
 
+
 class PlexLib(object):
 
     def __init__(self):
@@ -36,6 +71,8 @@ class PlexLib(object):
         self.port = ''
         self.token = ''
         self.machine_id = ''
+        # (protocol, address, port) the controller used itself, see PmsRoutes
+        self.offered_route = None
 
     def build_url(self, resource, token=True):
         protocol, address = self.protocol, self.address
@@ -43,12 +80,12 @@ class PlexLib(object):
             # plex.direct encodes the server address in its first label, as
             # 10-0-0-14.<hash>.plex.direct for IPv4 and the dashed form of the
             # address for IPv6.
-            head = address.split(".")[0]
+            ip = plex_direct_address(address)
             if settings.plex_lan_address:
                 address = settings.plex_lan_address
                 protocol = "http"
-            elif head.count("-") == 3 and head.replace("-", "").isdigit():
-                address = head.replace("-", ".")
+            elif ip is not None and ip.version == 4:
+                address = str(ip)
                 protocol = "http"
             else:
                 # An IPv6 plex.direct name cannot be rewritten to something a
@@ -71,6 +108,9 @@ class PlexLib(object):
         self.port = int(query.get("port", self.port))
         self.token = query.get("token", self.token)
         self.machine_id = query.get("machineIdentifier", self.machine_id)
+        if "address" in query:
+            self.offered_route = (self.protocol, self.address, self.port)
+        pms_routes.apply(self)
 
     def get_info(self):
         return dict(protocol=self.protocol,
@@ -85,24 +125,99 @@ class PlexLib(object):
         return self.build_url("/:/timeline", token=False)
 
 
+class StateSnapshot(object):
+    """One consistent reading of a renderer's state. Never modified once made.
+
+    The state loop publishes a new snapshot whenever something changes, by
+    replacing DlnaState.snapshot in one assignment, so a reader on any thread
+    that takes the snapshot once sees all of its fields from the same moment.
+    """
+    fields = ("state", "volume", "elapsed", "current_uri", "current_track_duration", "muted")
+    __slots__ = ("version",) + fields
+
+    def __init__(self, version=0, state=None, volume=None, elapsed=0, current_uri=None,
+                 current_track_duration=None, muted=None):
+        for name, value in (("version", version), ("state", state), ("volume", volume), ("elapsed", elapsed),
+                            ("current_uri", current_uri), ("current_track_duration", current_track_duration),
+                            ("muted", muted)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def replace(self, **changes):
+        values = {name: changes.get(name, getattr(self, name)) for name in StateSnapshot.fields}
+        return StateSnapshot(self.version + 1, **values)
+
+    def __repr__(self):
+        return f"v{self.version} state {self.state} {self.elapsed} {self.volume} " \
+               f"{self.muted} {self.current_track_duration} {self.current_uri}"
+
+
+# One bit per snapshot field, so a change set is a mask and waiters match with an AND.
+FIELD_BITS = {name: 1 << idx for idx, name in enumerate(StateSnapshot.fields)}
+STATE_CHANGED = FIELD_BITS["state"]
+VOLUME_CHANGED = FIELD_BITS["volume"]
+ELAPSED_CHANGED = FIELD_BITS["elapsed"]
+URI_CHANGED = FIELD_BITS["current_uri"]
+# Not a field: the position moved other than by playing on, i.e. a seek.
+ELAPSED_JUMP = 1 << len(StateSnapshot.fields)
+ALL_CHANGES = (ELAPSED_JUMP << 1) - 1
+
+
+def interest_mask(fields=None):
+    """The mask for a list of field names, plus "elapsed_jump". No fields means any change."""
+    if not fields:
+        return ALL_CHANGES
+    mask = 0
+    for f in fields:
+        mask |= ELAPSED_JUMP if f == "elapsed_jump" else FIELD_BITS[f]
+    return mask
+
+
+class ChangeSet(object):
+    """What one publish changed: a mask of the changed fields and the snapshots either side."""
+    __slots__ = ("mask", "old", "new")
+
+    def __init__(self, mask: int, old: StateSnapshot, new: StateSnapshot):
+        self.mask = mask
+        self.old = old
+        self.new = new
+        if mask & ELAPSED_CHANGED and not (0 <= (new.elapsed or 0) - (old.elapsed or 0) <= 1000):
+            self.mask |= ELAPSED_JUMP
+
+    def __contains__(self, field: str):
+        return bool(self.mask & FIELD_BITS[field])
+
+    def value(self, field: str):
+        """The new value of `field` if it changed, else None."""
+        return getattr(self.new, field) if self.mask & FIELD_BITS[field] else None
+
+    def matches(self, mask: int):
+        return bool(self.mask & mask)
+
+    @property
+    def elapsed_jump(self):
+        return bool(self.mask & ELAPSED_JUMP)
+
+    def __repr__(self):
+        return " ".join(f"{f}: {getattr(self.old, f)} -> {getattr(self.new, f)}"
+                        for f, bit in FIELD_BITS.items() if self.mask & bit)
+
+
 class DlnaState(object):
-    changing_attrs = ("state", "volume", "elapsed", "current_uri", "current_track_duration", "muted")
+    changing_attrs = StateSnapshot.fields
 
     def __init__(self, adapter, state_change_callback=None):
         self.adapter = adapter
         self.dlna = adapter.dlna
-        self._state = None
-        self._volume = None
-        self._elapsed = 0
-        self._current_uri = None
-        self._current_track_duration = None
-        self._muted = None
+        self.snapshot = StateSnapshot()
+        self._publish_lock = Lock()
 
         self.looping_thread: Thread = None
         self._thread_should_stop = False
         self.running_loop: asyncio.AbstractEventLoop = None
         self.state_change_callback = state_change_callback
-        self._changed_state = None
         self.change_session_lock = None
         self._check_all_next_loop = False
         self.looping_wait_event: asyncio.Event = None
@@ -120,13 +235,46 @@ class DlnaState(object):
         asyncio.set_event_loop(self.running_loop)
         self.running_loop.run_until_complete(self._check_loop())
 
-    def begin_change_session(self):
-        self._changed_state = DotMap()
+    # Plain reads of the current snapshot. Code that needs more than one field
+    # should take self.snapshot once instead, so the fields agree.
+    state = property(lambda self: self.snapshot.state)
+    volume = property(lambda self: self.snapshot.volume)
+    elapsed = property(lambda self: self.snapshot.elapsed)
+    current_uri = property(lambda self: self.snapshot.current_uri)
+    current_track_duration = property(lambda self: self.snapshot.current_track_duration)
+    muted = property(lambda self: self.snapshot.muted)
+
+    def publish(self, **values):
+        """Replace the snapshot with one carrying `values`.
+
+        Returns a ChangeSet, or None without allocating anything when nothing changed.
+        """
+        with self._publish_lock:
+            old = self.snapshot
+            mask = 0
+            for k, v in values.items():
+                if getattr(old, k) != v:
+                    mask |= FIELD_BITS[k]
+            if not mask:
+                return None
+            new = self.snapshot = old.replace(**values)
+        return ChangeSet(mask, old, new)
 
-    def end_change_session(self):
-        s = self._changed_state
-        self._changed_state = None
-        return s
+    @property
+    def idle(self):
+        """Whether nobody has followed this renderer for a while, see watch()."""
+        return self.loop_interval > FAST_LOOP_INTERVAL
+
+    def watch(self):
+        """Note that someone is following this renderer, e.g. a controller polling its timeline.
+
+        A renderer nobody has looked at for a while is polled slowly; this brings
+        it back to the fast interval straight away.
+        """
+        idle = self.idle
+        self.last_access_time = datetime.utcnow()
+        if idle and self.running_loop is not None and self.looping_wait_event is not None:
+            self.running_loop.call_soon_threadsafe(self.looping_wait_event.set)
 
     @property
     def check_all_next_loop(self):
@@ -150,32 +298,13 @@ class DlnaState(object):
             # directly keeps shutdown from dying on the way out.
             set_value()
 
-    def __setattr__(self, key, value):
-        if key in DlnaState.changing_attrs:
-            old_value = self.__getattr__("_" + key)
-            if old_value != value and self._changed_state is not None:
-                self._changed_state[key] = value
-                self._changed_state.old[key] = old_value
-            object.__setattr__(self, "_" + key, value)
-        else:
-            object.__setattr__(self, key, value)
-
-    def __getattr__(self, item):
-        if item in DlnaState.changing_attrs:
-            self.last_access_time = datetime.utcnow()
-            if asyncio.get_running_loop() != self.running_loop:
-                self.running_loop.call_soon_threadsafe(self.looping_wait_event.set)
-            return object.__getattribute__(self, "_" + item)
-        return object.__getattribute__(self, item)
-
     def __del__(self):
         self._thread_should_stop = True
         self.looping_thread.join()
         self.looping_thread = None
 
     def __repr__(self):
-        return f"{self.dlna.name}: state {self.state} {self.elapsed} {self.volume} " \
-               f"{self.muted} {self.current_track_duration} {self.current_uri}"
+        return f"{self.dlna.name}: {self.snapshot}"
 
     async def check(self, client: aiohttp.ClientSession, check_count=0):
         position_check_count = 1
@@ -188,18 +317,37 @@ class DlnaState(object):
         state = DotMap()
         volume = DotMap()
         muted = DotMap()
+        self.dlna.poll_tick += 1
+        if not self.dlna.breaker.closed:
+            # The renderer stopped answering. Nothing goes out but the breaker's
+            # probe until it answers again, and then everything is refreshed.
+            if not self.dlna.breaker.probe_due():
+                return
+            if not await self.dlna.GetTransportInfo(client=client, background=True):
+                return
+            self.check_all_next_loop = True
+        snapshot = self.snapshot
+        polls = []
         if check_count % position_check_count == 0 or self.check_all_next_loop:
-            checks.append(self.dlna.GetPositionInfo(client=client))
-            results.append(position_info)
-        if check_count % state_check_count == 0 or self.state == "TRANSITIONING" or self.check_all_next_loop:
-            checks.append(self.dlna.GetTransportInfo(client=client))
-            results.append(state)
-        if check_count % volume_check_count == 0 or self.check_all_next_loop:
-            checks.append(self.dlna.GetVolume(client=client))
-            results.append(volume)
-        if check_count % muted_check_count == 0:
-            checks.append(self.dlna.GetMute(client=client))
-            results.append(muted)
+            polls.append(("GetPositionInfo", position_info))
+        if check_count % state_check_count == 0 or snapshot.state == "TRANSITIONING" or self.check_all_next_loop:
+            polls.append(("GetTransportInfo", state))
+        # RenderingControl events bring volume and mute as they change.
+        rc_evented = self.dlna.evented(UPNP_RC_SERVICE_TYPE) and snapshot.volume is not None
+        if (check_count % volume_check_count == 0 and not rc_evented) or self.check_all_next_loop:
+            polls.append(("GetVolume", volume))
+        if check_count % muted_check_count == 0 and not rc_evented:
+            polls.append(("GetMute", muted))
+        for service_type, actions in POLLED_ACTIONS.items():
+            due = [(action, holder) for action, holder in polls if action in actions]
+            if len(due) > 1 and self.dlna.batch_supported(service_type):
+                checks.append(self._poll_batched(service_type, due, client))
+                # the holders in `due` are filled in by _poll_batched itself
+                results.append(DotMap())
+                continue
+            for action, holder in due:
+                checks.append(getattr(self.dlna, action)(client=client, background=True))
+                results.append(holder)
         if self.check_all_next_loop:
             self.check_all_next_loop = False
         try:
@@ -210,42 +358,56 @@ class DlnaState(object):
             # silent failure here means position/volume/state stop updating with no
             # indication anywhere of why.
             print(f"dlna {self.dlna.name} state loop error {str(e)}")
-        self.begin_change_session()
+        values = {}
         if position_info and position_info.result:
             position_info = position_info.result
-            self.elapsed = int(parse_timedelta(position_info.RelTime).total_seconds() * 1000)
-            self.current_uri = position_info.TrackURI
-            self.current_track_duration = int(
+            values['elapsed'] = int(parse_timedelta(position_info.RelTime).total_seconds() * 1000)
+            values['current_uri'] = position_info.TrackURI
+            values['current_track_duration'] = int(
                 parse_timedelta(position_info.TrackDuration).total_seconds() * 1000)
-            if not state and not self._changed_state and self.state in ("TRANSITIONING", "PLAYING"):
+            position_changed = any(getattr(snapshot, k) != v for k, v in values.items())
+            if not state and not position_changed and snapshot.state in ("TRANSITIONING", "PLAYING"):
                 if __debug__:
                     print(f"dlna {self.dlna.name} no eplased change? retry state")
                 try:
-                    state.result = await self.dlna.GetTransportInfo(client=client)
+                    state.result = await self.dlna.GetTransportInfo(client=client, background=True)
                 except Exception:
                     pass
         if state and state.result:
             state = state.result
-            self.state = state.CurrentTransportState
+            values['state'] = state.CurrentTransportState
         if volume and volume.result:
             volume = volume.result
             volume = int(volume.CurrentVolume)
-            self.volume = convert_volume(volume, self.dlna.volume_max, self.dlna.volume_min, 100, 0, 1)
+            values['volume'] = convert_volume(volume, self.dlna.volume_max, self.dlna.volume_min, 100, 0, 1)
         if muted and muted.result:
             muted = muted.result
-            self.muted = muted.CurrentMute
-        changed_state = self.end_change_session()
+            values['muted'] = muted.CurrentMute
+        changed_state = self.publish(**values)
         if changed_state and self.state_change_callback:
-            # if __debug__:
-            #     print(f"{self.dlna.name} check loop {changed_state.toDict()} {self} in thread {current_thread().name}")
             self.state_change_callback(changed_state)
 
+    async def _poll_batched(self, service_type, due, client):
+        """Run several polls of one service as a single GetStateVariables.
+
+        Each holder gets a result shaped like the reply of its own action, so
+        check() reads them the same either way.
+        """
+        names = [name for action, _ in due for name in POLLED_ACTIONS[service_type][action].values()]
+        variables = await self.dlna.query_state_variables(service_type, names, client=client, background=True)
+        if variables is None:
+            return None
+        for action, holder in due:
+            holder.result = DotMap({field: variables[name]
+                                    for field, name in POLLED_ACTIONS[service_type][action].items()})
+        return variables
+
     @property
     def loop_interval(self):
         if datetime.utcnow() - self.last_access_time >= timedelta(seconds=90) \
-                and self.state not in ("PLAYING", "TRANSITIONING"):
+                and self.snapshot.state not in ("PLAYING", "TRANSITIONING"):
             return 60
-        return 0.8
+        return FAST_LOOP_INTERVAL
 
     async def wait_for_next_loop(self):
         try:
@@ -274,40 +436,29 @@ class DlnaState(object):
         print(f"{self.dlna.name} state loop {self.dlna.name} stopped")
         self.running_loop = None
 
-    def update(self, state: str = "", uri: str = "", position: str = ""):
-        elapsed = ""
-        if position:
-            elapsed = int(parse_timedelta(position).total_seconds() * 1000)
-        if (state == "" or self.state == state) and (uri == "" or self.current_uri == uri) and (elapsed == "" or self.elapsed == elapsed):
+    def update(self, **values):
+        """Apply snapshot values an event told us about, on the state loop."""
+        snapshot = self.snapshot
+        if all(getattr(snapshot, k) == v for k, v in values.items()):
             return
         if self.running_loop is None:
-            print(f"{self.dlna.name} state update discard due to no running loop {state} {uri} {position}")
+            print(f"{self.dlna.name} state update discard due to no running loop {values}")
             return
         if current_thread() == self.looping_thread:
-            self.running_loop.create_task(self.update_in_thread(state=state, uri=uri, elapsed=elapsed))
+            self.running_loop.create_task(self.update_in_thread(values))
         else:
-            asyncio.run_coroutine_threadsafe(self.update_in_thread(state=state, uri=uri, elapsed=elapsed),
-                                             self.running_loop)
-
-    async def update_in_thread(self, state="", uri="", elapsed=""):
-        if state == "":
-            state = self.state
-        if uri == "":
-            uri = self.current_uri
-        if elapsed == "":
-            elapsed = self.elapsed
-        if self.state == state and self.current_uri == uri and self.elapsed == elapsed:
+            asyncio.run_coroutine_threadsafe(self.update_in_thread(values), self.running_loop)
+
+    async def update_in_thread(self, values: dict):
+        snapshot = self.snapshot
+        if all(getattr(snapshot, k) == v for k, v in values.items()):
             return
         if __debug__:
-            print(f"{self.dlna.name} real update state from sub {state} {uri} {elapsed}")
+            print(f"{self.dlna.name} real update state from sub {values}")
         async with self.change_session_lock:
             if __debug__:
-                print(f"{self.dlna.name} real update state from sub in lock {state} {uri} {elapsed}")
-            self.begin_change_session()
-            self.state = state
-            self.current_uri = uri
-            self.elapsed = elapsed
-            changed = self.end_change_session()
+                print(f"{self.dlna.name} real update state from sub in lock {values}")
+            changed = self.publish(**values)
             if changed and self.state_change_callback:
                 self.state_change_callback(changed)
 
@@ -330,11 +481,16 @@ class PlexDlnaAdapter(object):
         self.delay_stop_state_looping_task: asyncio.Task = None
         self.waiting_sub = 0
         self.current_track_info = None
+        self.volume_sender = Coalescer(self._send_volume, name=f"{dlna} volume")
+        self.seek_sender = Coalescer(self._send_seek, name=f"{dlna} seek")
+        self.prefetcher = Prefetcher(dlna.name)
+        # offsets next() will pick in shuffle, drawn early so they can be prefetched
+        self.shuffle_plan = []
 
-    def check_auto_next(self, changed: DotMap):
+    def check_auto_next(self, changed: ChangeSet):
         if self.queue is None:
             return False
-        if changed.state and changed.state != "PLAYING" and changed.old.state == "TRANSITIONING":
+        if changed.value("state") and changed.new.state != "PLAYING" and changed.old.state == "TRANSITIONING":
             return False
 
         async def auto_next():
@@ -348,61 +504,50 @@ class PlexDlnaAdapter(object):
             else:
                 await self.next()
 
-        if self.state.current_uri is not None and not changed.state and not changed.uri and self.current_track_info:
-            if (changed.elapsed == 0 < changed.old.elapsed <= self.current_track_info.duration
-                and self.current_track_info.duration - changed.old.elapsed <= 2000) \
-                    or (
-                    changed.elapsed and changed.elapsed > changed.old.elapsed and
-                    self.current_track_info.duration // 1000 * 1000 <= changed.elapsed <= self.current_track_info.duration):
+        snapshot = self.state.snapshot
+        elapsed = changed.value("elapsed")
+        old_elapsed = changed.old.elapsed
+        if snapshot.current_uri is not None and not changed.value("state") and self.current_track_info:
+            duration = self.current_track_info.duration
+            if (elapsed == 0 < old_elapsed <= duration and duration - old_elapsed <= 2000) \
+                    or (elapsed and elapsed > old_elapsed and duration // 1000 * 1000 <= elapsed <= duration):
                 self.no_notice = True
-                print(f"auto next stopped {self.state.state}, elapsed: {changed.old.elapsed} -> {changed.elapsed}, "
-                      f"{self.current_track_info.duration}")
-                self.state.update(state="TRANSITIONING", uri=None)
+                print(f"auto next stopped {snapshot.state}, elapsed: {old_elapsed} -> {elapsed}, {duration}")
+                self.state.update(state="TRANSITIONING", current_uri=None)
                 asyncio.run_coroutine_threadsafe(auto_next(), self.loop)
                 self.no_notice = False
                 return True
-        elif not changed.uri and changed.old.state == "PLAYING" and changed.state == "STOPPED" and self.state.current_track_duration - self.state.elapsed <= 1:
+        elif changed.old.state == "PLAYING" and changed.value("state") == "STOPPED" \
+                and snapshot.current_track_duration - snapshot.elapsed <= 1:
             self.no_notice = True
-            print(f"auto next transitioning {changed.old.state} {changed.state}")
-            self.state.update(state="TRANSITIONING", uri=None)
+            print(f"auto next transitioning {changed.old.state} {changed.new.state}")
+            self.state.update(state="TRANSITIONING", current_uri=None)
             asyncio.run_coroutine_threadsafe(auto_next(), self.loop)
             self.no_notice = False
             return True
         return False
 
-    def state_changed_callback(self, changed_state: DotMap):
+    def state_changed_callback(self, changed_state: ChangeSet):
         if self.loop.is_closed():
             return
-        if __debug__ or 'elapsed' not in changed_state.keys() or len(changed_state.keys()) > 2 or \
-                not (0 <= changed_state.elapsed - changed_state.old.elapsed <= 1000):
-            print(f"{self.dlna.name} state change notified {changed_state.toDict()}")
+        if __debug__ or changed_state.mask & ~ELAPSED_CHANGED:
+            # a position that only moved on by playing is not worth a line
+            print(f"{self.dlna.name} state change notified {changed_state}")
         n = self.check_auto_next(changed_state)
         if not n:
             asyncio.run_coroutine_threadsafe(self.state_changed(changed_state), self.loop)
 
-    async def state_changed(self, changed_state: DotMap):
-        removed_event = []
-        for e in self.wait_state_change_events:
-            if not e['interesting_fields']:
-                e['event'].set()
-                removed_event.append(e)
-                continue
-            for f in e['interesting_fields']:
-                if f in changed_state.keys():
+    async def state_changed(self, changed_state: ChangeSet):
+        waiting = self.wait_state_change_events
+        self.wait_state_change_events = [e for e in waiting if not changed_state.matches(e['mask'])]
+        if len(self.wait_state_change_events) != len(waiting):
+            for e in waiting:
+                if changed_state.matches(e['mask']):
                     e['event'].set()
-                    removed_event.append(e)
-                    continue
-            if "elapsed_jump" in e['interesting_fields']:
-                if "elapsed" in changed_state and not (0 <= changed_state.elapsed - changed_state.old.elapsed <= 1000):
-                    e['event'].set()
-                    removed_event.append(e)
-                    continue
-        for r in removed_event:
-            self.wait_state_change_events.remove(r)
 
     async def wait_for_event(self, timeout=None, interesting_fields=None):
         event = asyncio.Event()
-        self.wait_state_change_events.append(dict(event=event, interesting_fields=interesting_fields))
+        self.wait_state_change_events.append(dict(event=event, mask=interest_mask(interesting_fields)))
         if len(self.wait_state_change_events) > 3:
             e = self.wait_state_change_events.pop()
             e['event'].set()
@@ -415,7 +560,8 @@ class PlexDlnaAdapter(object):
         settings.mark_device_played(self.dlna.uuid)
         if query_params is not None:
             self.plex_lib.update(query_params)
-        self.state.update(uri=None)
+        self.state.update(current_uri=None)
+        self.shuffle_plan = []
         self.queue = self.plex_lib.get_queue(container_key)
         await self.queue.get_info()
         await self.play_selected_queue_item(offset=offset, paused=paused)
@@ -424,14 +570,21 @@ class PlexDlnaAdapter(object):
         self.state.update(state="TRANSITIONING")
         self.state.check_all_next_loop = True
         track = await self.queue.selected_track()
-        url = self.queue.url_for_track(track)
+        sink = self.dlna.sink_protocols
+        url, part, mime = self.queue.url_for_track(track, sink, self.dlna.uuid)
         print(f"{self.dlna.name} play {url}")
         if url == self.state.current_uri:
-            self.state.update(uri=None)
-        await self.dlna.SetAVTransportURI(url)
+            self.state.update(current_uri=None)
+        metadata = self.queue.metadata_for_track(track, url, mime, seekable=part is not None)
+        await self.dlna.SetAVTransportURI(dict(CurrentURI=url, CurrentURIMetaData=metadata))
         self.current_track_info = track
+        self.prefetch()
         if offset != 0:
-            await self.dlna.Seek(str(timedelta(milliseconds=offset)))
+            try:
+                await self.dlna.Seek(str(timedelta(milliseconds=offset)))
+            except UnsupportedAction as e:
+                # playing from the start beats not playing at all
+                print(f"{self.dlna.name} play from {offset}ms: {e}")
         if paused:
             await self.pause()
         else:
@@ -439,19 +592,49 @@ class PlexDlnaAdapter(object):
             if self.state != "PLAYING":
                 await self.play()
 
-    async def refresh_queue(self, playQueueID):
-        await self.queue.refresh_queue(playQueueID)
+    def prefetch(self):
+        """Start fetching the tracks after the selected one, from what the queue already holds."""
+        if not settings.relay or settings.prefetch_tracks <= 0 or self.queue is None or self.queue.info is None:
+            self.prefetcher.cancel()
+            return
+        queue = self.queue
+        selected = queue.info.playQueueSelectedItemOffset
+        total = queue.info.playQueueTotalCount or UNLIMITED
+        shuffle_plan = None
+        if self.shuffle > 0 and queue.info.get("allowShuffle", True) is not False and total != UNLIMITED:
+            while len(self.shuffle_plan) < settings.prefetch_tracks:
+                self.shuffle_plan.append(random.choice(range(total)))
+            shuffle_plan = self.shuffle_plan
+        else:
+            self.shuffle_plan = []
+        items = []
+        for offset in upcoming_offsets(selected, total, queue.repeat, settings.prefetch_tracks, shuffle_plan):
+            track = queue.loaded_track(offset)
+            if track is not None and track.Media:
+                url, part, _ = queue.source_for_track(track, self.dlna.sink_protocols, self.dlna.uuid)
+                items.append((url, part))
+        self.prefetcher.start(items)
+
+    def wake_waiters(self):
         while len(self.wait_state_change_events) > 0:
             e = self.wait_state_change_events.pop()
             e['event'].set()
 
+    async def refresh_queue(self, playQueueID):
+        await self.queue.refresh_queue(playQueueID)
+        # the plan was drawn against the queue as it was
+        self.shuffle_plan = []
+        self.prefetch()
+        self.wake_waiters()
+
     async def play(self):
         await self.dlna.Play()
         self.state.check_all_next_loop = True
 
     async def stop(self):
-        self.state.update(state="STOPPED", uri=None)
+        self.state.update(state="STOPPED", current_uri=None)
         self.current_track_info = None
+        self.prefetcher.cancel()
         await self.dlna.Stop()
         self.state.check_all_next_loop = True
 
@@ -470,7 +653,14 @@ class PlexDlnaAdapter(object):
         direction = -1 if revert else 1
         current_offset = await self.queue.selected_offset()
         if self.shuffle > 0 and await self.queue.allow_shuffle():
-            current_offset = random.choice(range(await self.queue.total_count()))
+            total = await self.queue.total_count()
+            current_offset = None
+            while not revert and self.shuffle_plan and current_offset is None:
+                planned = self.shuffle_plan.pop(0)
+                if planned < total:
+                    current_offset = planned
+            if current_offset is None:
+                current_offset = random.choice(range(total))
         else:
             current_offset += direction
         if current_offset >= await self.queue.total_count() or current_offset < 0:
@@ -487,7 +677,12 @@ class PlexDlnaAdapter(object):
         await self.play_selected_queue_item()
 
     async def seek(self, offset):
+        self.seek_sender.submit(offset)
+        self.wake_waiters()
+
+    async def _send_seek(self, offset):
         await self.dlna.Seek(str(timedelta(milliseconds=offset)))
+        self.state.check_all_next_loop = True
 
     async def get_elapsed(self):
         position_info = await self.dlna.GetPositionInfo()
@@ -503,6 +698,10 @@ class PlexDlnaAdapter(object):
         return convert_volume(volume, self.dlna.volume_max, self.dlna.volume_min, 100, 0, 1)
 
     async def set_volume(self, volume):
+        self.volume_sender.submit(volume)
+        self.wake_waiters()
+
+    async def _send_volume(self, volume):
         volume = convert_volume(volume, 100, 0, self.dlna.volume_max, self.dlna.volume_min, self.dlna.volume_step)
         await self.dlna.SetVolume(volume)
         self.state.check_all_next_loop = True
@@ -511,63 +710,39 @@ class PlexDlnaAdapter(object):
         mute = await self.dlna.GetMute()
         return mute.CurrentMute
 
-    def start_plex_tv_notify(self):
-        asyncio.create_task(self._update_plex_tv_connection_loop())
-
-    async def _update_plex_tv_connection_loop(self):
-        while True:
-            try:
-                await self.update_plex_tv_connection()
-            except Exception:
-                pass
-            await asyncio.sleep(60)
-
-    async def update_plex_tv_connection(self):
-        if not settings.host_ip:
-            return
-        if not self.plex_bind_token:
-            self.plex_bind_token = settings.get_token_for_uuid(self.dlna.uuid)
-            if not self.plex_bind_token:
-                return
-        await g.http.put(f"https://plex.tv/devices/{self.dlna.uuid}?X-Plex-Token={self.plex_bind_token}",
-                         data={"Connection[][uri]": f"http://{settings.host_ip}:{settings.http_port}"},
-                         headers=pms_header(self.dlna))
-
-    def update_state(self, info):
-        if info.propertyset:
-            info = info.propertyset.property.LastChange.Event.InstanceID
-        else:
-            return
-        state = info.TransportState['@val']
-        uri = info.AVTransportURI['@val']
-        pos = info.RelativeTimePosition['@val']
-        if not state and not uri and not pos:
-            print("ignoring notice no info")
+    def publish_to_plex_tv(self):
+        plex_tv_publisher.publish(self)
+
+    def update_state(self, variables: dict):
+        """Apply the state variables of a GENA event, see parse_notify."""
+        values = {}
+        if variables.get("TransportState"):
+            values['state'] = variables["TransportState"]
+        uri = variables.get("CurrentTrackURI") or variables.get("AVTransportURI")
+        if uri:
+            values['current_uri'] = uri
+        elapsed = upnp_time_ms(variables.get("RelativeTimePosition"))
+        if elapsed is not None:
+            values['elapsed'] = elapsed
+        duration = upnp_time_ms(variables.get("CurrentTrackDuration"))
+        if duration is not None:
+            values['current_track_duration'] = duration
+        if (variables.get("Volume") or "").isdigit():
+            values['volume'] = convert_volume(int(variables["Volume"]), self.dlna.volume_max, self.dlna.volume_min,
+                                              100, 0, 1)
+        if variables.get("Mute") is not None:
+            values['muted'] = variables["Mute"]
+        if not values:
+            if __debug__:
+                print(f"{self.dlna.name} ignoring notice no info {variables}")
             return
-        if not state:
-            state = ""
-        if not uri:
-            uri = ""
-        if not pos:
-            pos = ""
         if __debug__:
-            print(f"{self.dlna.name} update state from sub {state} {uri} {pos}")
-        self.state.update(state=state, uri=uri, position=pos)
+            print(f"{self.dlna.name} update state from sub {values}")
+        self.state.update(**values)
 
     @property
     def plex_state(self):
-        if self.state.state is None:
-            return None
-        if self.state.state == "PLAYING":
-            return "playing"
-        if self.state.state == "STOPPED":
-            return "stopped"
-        if self.state.state == "NO_MEDIA_PRESENT":
-            return "stopped"
-        if self.state.state == "PAUSED_PLAYBACK":
-            return "paused"
-        if self.state.state == "TRANSITIONING":
-            return "playing"
+        return PLEX_STATES.get(self.state.state)
 
     async def get_pms_state(self):
         if self.state is None:
@@ -583,22 +758,35 @@ class PlexDlnaAdapter(object):
         d['X-Plex-Token'] = self.plex_lib.token
         return d
 
+    def elapsed_for_timeline(self, snapshot=None):
+        """Where playback is, counting a seek that has been asked for but not confirmed."""
+        snapshot = snapshot or self.state.snapshot
+        offset = self.seek_sender.current()
+        if offset is None:
+            return snapshot.elapsed
+        if snapshot.state == "PLAYING":
+            offset += int((monotonic() - self.seek_sender.submitted_at) * 1000)
+        return offset
+
     async def get_state(self):
-        if self.state == "STOPPED" or self.state is None or self.queue is None:
+        self.state.watch()
+        snapshot = self.state.snapshot
+        if self.queue is None:
             return {}
         lib_info = self.plex_lib.get_info()
         shuffle = self.shuffle
         if shuffle > 0 and not await self.queue.allow_shuffle():
             shuffle = 0
         track_info = await self.queue.get_track_info()
-        time = clamp_elapsed(self.state.elapsed, track_info.get('duration'))
-        volume = self.state.volume
-        mute = self.state.muted
+        time = clamp_elapsed(self.elapsed_for_timeline(snapshot), track_info.get('duration'))
+        volume = self.volume_sender.current()
+        if volume is None:
+            volume = snapshot.volume
         state = {
-            'state': self.plex_state,
+            'state': PLEX_STATES.get(snapshot.state),
             'time': time,
             'volume': volume,
-            'mute': mute,
+            'mute': snapshot.muted,
             'shuffle': shuffle,
             'repeat': self.queue.repeat
         }
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+
+# Documents kept, by play queue item; a queue is seldom walked further than this.
+DIDL_DOCUMENTS_KEPT = 512
+
+# Part container -> mime type, and codec for containers that hold several.
+CONTAINER_MIME = {
+    "mp3": "audio/mpeg",
+    "flac": "audio/flac",
+    "ogg": "audio/ogg",
+    "wav": "audio/wav",
+    "aiff": "audio/aiff",
+    "aac": "audio/aac",
+    "mp4": "audio/mp4",
+    "m4a": "audio/mp4",
+    "alac": "audio/mp4",
+    "dsf": "audio/dsf",
+    "ape": "audio/x-ape",
+    "wma": "audio/x-ms-wma",
+    "asf": "audio/x-ms-wma",
+}
+CODEC_MIME = {
+    "mp3": "audio/mpeg",
+    "flac": "audio/flac",
+    "vorbis": "audio/ogg",
+    "opus": "audio/ogg",
+    "pcm": "audio/wav",
+}
+MP3_PROFILE = "DLNA.ORG_PN=MP3;"
+# Byte seeks allowed; a streamed, background-transferable file.
+DLNA_FEATURES = "DLNA.ORG_OP=01;DLNA.ORG_FLAGS=01700000000000000000000000000000"
+# The same without byte seeks, for a transcode, which has no Content-Length.
+DLNA_FEATURES_UNSEEKABLE = "DLNA.ORG_OP=00;DLNA.ORG_FLAGS=01700000000000000000000000000000"
+
+DIDL_HEADER = ('<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" '
+               'xmlns:dc="http://purl.org/dc/elements/1.1/" '
+               'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '
+               'xmlns:dlna="urn:schemas-dlna-org:metadata-1-0/">')
+
+_documents = OrderedDict()
+
+
+def mime_type(container: str = None, codec: str = None):
+    """The mime type of a Part, or None for a container and codec not known here."""
+    container = (container or "").lower()
+    codec = (codec or "").lower()
+    if container in ("ogg", "mp4", "m4a") and codec in CODEC_MIME:
+        return CODEC_MIME[codec]
+    return CONTAINER_MIME.get(container) or CODEC_MIME.get(codec)
+
+
+def protocol_info(mime: str, seekable: bool = True):
+    profile = MP3_PROFILE if mime == "audio/mpeg" else ""
+    features = DLNA_FEATURES if seekable else DLNA_FEATURES_UNSEEKABLE
+    return f"http-get:*:{mime}:{profile}{features}"
+
+
+def didl_duration(ms):
+    """Milliseconds as H:MM:SS.mmm, the form res@duration takes."""
+    ms = int(ms)
+    return f"{ms // 3600000}:{ms // 60000 % 60:02}:{ms // 1000 % 60:02}.{ms % 1000:03}"
+
+
+def _element(tag: str, value):
+    # a field the server left out reads as an empty DotMap
+    if not value and value != 0:
+        return ""
+    return f"<{tag}>{escape(str(value))}</{tag}>"
+
+
+def build_didl(track, url: str, art_url: str = None, mime: str = None, seekable: bool = True):
+    """A DIDL-Lite item for a play queue track, played from `url`.
+
+    A `url` that is not `seekable`, a transcode, is not the file itself, so
+    neither byte seeks nor the file's size are offered for it.
+    """
+    media = track.Media[0] if track.Media else None
+    part = media.Part[0] if media is not None and media.Part else None
+    if mime is None:
+        mime = mime_type(media.container if media is not None else None,
+                         media.audioCodec if media is not None else None)
+    if mime is None:
+        # only sent as is to a renderer that listed no formats, so takes anything
+        mime = "audio/mpeg"
+    attrs = {"protocolInfo": protocol_info(mime, seekable)}
+    if track.duration:
+        attrs["duration"] = didl_duration(track.duration)
+    if seekable and part is not None and part.size:
+        attrs["size"] = part.size
+    if media is not None and media.bitrate:
+        # DIDL counts bytes per second, Plex kbit/s
+        attrs["bitrate"] = int(media.bitrate) * 125
+    if media is not None and media.audioChannels:
+        attrs["nrAudioChannels"] = media.audioChannels
+    res_attrs = "".join(f" {k}={quoteattr(str(v))}" for k, v in attrs.items())
+    artist = track.originalTitle or track.grandparentTitle
+    item_id = quoteattr(str(track.playQueueItemID or track.ratingKey or "0"))
+    return (DIDL_HEADER +
+            f'<item id={item_id} parentID="0" restricted="1">' +
+            _element("dc:title", track.title) +
+            _element("dc:creator", artist) +
+            _element("upnp:artist", artist) +
+            _element("upnp:albumArtist", track.grandparentTitle) +
+            _element("upnp:album", track.parentTitle) +
+            _element("upnp:originalTrackNumber", track.index) +
+            _element("upnp:albumArtURI", art_url) +
+            "<upnp:class>object.item.audioItem.musicTrack</upnp:class>" +
+            f"<res{res_attrs}>{escape(url)}</res>" +
+            "</item></DIDL-Lite>")
+
+
+def track_didl(track, url: str, art_url: str = None, mime: str = None, seekable: bool = True):
+    """build_didl(), kept per play queue item for as long as its URL stays the same.
+
+    Every auto next and every skip back to a track sends the same document.
+    """
+    key = track.playQueueItemID
+    if not key:
+        return build_didl(track, url, art_url, mime, seekable)
+    cached = _documents.get(key)
+    if cached is not None and cached[0] == url:
+        _documents.move_to_end(key)
+        return cached[1]
+    document = build_didl(track, url, art_url, mime, seekable)
+    _documents[key] = (url, document)
+    while len(_documents) > DIDL_DOCUMENTS_KEPT:
+        _documents.popitem(last=False)
+    return document
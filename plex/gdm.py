@@ -1,5 +1,6 @@
 import socket
 from settings import settings
+from utils import device_bundle
 import asyncio
 
 GDM_MULTICAST_ADDR = "239.0.0.250"
@@ -20,7 +21,7 @@ def get_protocol(gdm):
             self.transport = transport
             self.is_connected = True
             # print(f"gdm connected {gdm.device.name}")
-            self.transport.sendto(f"HELLO * HTTP/1.0\n{gdm.client_data}".encode('utf8'),
+            self.transport.sendto(device_bundle(gdm.device).gdm_hello,
                                   (GDM_MULTICAST_ADDR, GDM_MULTICAST_PORT))
 
         def datagram_received(self, data, addr):
@@ -28,9 +29,8 @@ def get_protocol(gdm):
                 if addr[0] == "127.0.0.1":
                     return
                 try:
-                    msg = f"HTTP/1.0 200 OK\n{gdm.client_data}"
                     # print(f"Reply {addr}, {gdm.device.name}")
-                    self.transport.sendto(msg.encode('utf8'), addr)
+                    self.transport.sendto(device_bundle(gdm.device).gdm_reply, addr)
                 except Exception as e:
                     print(f"unable to send client message {e}")
 
@@ -60,25 +60,6 @@ class PlexGDM(object):
     #             self.protocol.transport.sendto(f"HELLO * HTTP/1.0\n{client_data}".encode('utf8'),
     #                                           (GDM_MULTICAST_ADDR, GDM_MULTICAST_PORT))
 
-    @property
-    def client_data(self):
-        data = {
-            "Name": self.device.name,
-            "Port": str(self.server_port),
-            "Content-Type": "plex/media-player",
-            "Product": self.device.model,
-            "Protocol": "plex",
-            "Protocol-Version": "1",
-            "Protocol-Capabilities": "timeline,playback,playqueues",
-            "Version": settings.platform_version,
-            "Resource-Identifier": self.device.uuid,
-            "Device-Class": "stb"
-        }
-        client_data = ""
-        for key, value in data.items():
-            client_data += "%s: %s\n" % (key, value)
-        return client_data
-
     def init_socket(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         try:
@@ -1,19 +1,145 @@
+import asyncio
+from time import monotonic
+
+from dlna import devices
 from dlna.dlna_device import DlnaDevice
+from plex.adapters import adapter_by_device
+from settings import settings
 from utils import pms_header, xml2dict, g
 
-PINS = 'https://plex.tv/api/v2/pins'
-CHECKPINS = 'https://plex.tv/api/v2/pins/{pin_id}'
+PINS = '{base}/api/v2/pins'
+CHECKPINS = '{base}/api/v2/pins/{pin_id}'
+
+# PINs asked of plex.tv at a time, for creating and for checking.
+PIN_CONCURRENCY = 4
+# A PIN this close to expiring is not shown any more, a new one is made.
+PIN_EXPIRY_MARGIN_SECS = 60
+# Used when plex.tv does not say how long a PIN lasts.
+PIN_DEFAULT_LIFETIME_SECS = 900
+# How often PINs on show are checked for having been linked.
+PIN_CHECK_SECS = 5
+# After plex.tv fails to make a PIN, none is asked for for this long, doubling up to the max.
+PIN_RETRY_SECS = 30
+PIN_RETRY_MAX_SECS = 600
+
+
+class Pin(object):
+    __slots__ = ("code", "id", "expires_at")
+
+    def __init__(self, code: str, pin_id: str, lifetime: float):
+        self.code = code
+        self.id = pin_id
+        self.expires_at = monotonic() + lifetime
+
+    @property
+    def usable(self):
+        return monotonic() < self.expires_at - PIN_EXPIRY_MARGIN_SECS
 
 
 async def get_pin(device: DlnaDevice):
-    async with g.http.post(PINS, headers=pms_header(device)) as p:
+    async with g.http.post(PINS.format(base=settings.plex_tv_url), headers=pms_header(device)) as p:
         p.raise_for_status()
-        d = xml2dict(await p.text())
-        return d.pin['@code'], d.pin['@id']
+        pin = xml2dict(await p.text()).pin
+    try:
+        lifetime = float(pin['@expiresIn'])
+    except (KeyError, TypeError, ValueError):
+        lifetime = PIN_DEFAULT_LIFETIME_SECS
+    return Pin(pin['@code'], pin['@id'], lifetime)
 
 
 async def check_pin(pin_id, device: DlnaDevice):
-    async with g.http.get(CHECKPINS.format(pin_id=pin_id), headers=pms_header(device)) as p:
+    async with g.http.get(CHECKPINS.format(base=settings.plex_tv_url, pin_id=pin_id), headers=pms_header(device)) as p:
         p.raise_for_status()
         d = xml2dict(await p.text())
         return d.pin['@authToken']
+
+
+class PinCache(object):
+    """PINs for the bind page, one per unlinked renderer, kept until they expire.
+
+    The page used to ask plex.tv for a fresh PIN for every unlinked renderer, one
+    after another, on every load, so it took a round trip per renderer to show
+    and a reload made the PINs on the user's screen useless. Now PINs are made
+    PIN_CONCURRENCY at a time, reused until they are about to expire, and
+    checked in the background, so a renderer is linked as soon as the PIN is
+    entered at plex.tv/link, with no need to press anything here.
+    """
+
+    def __init__(self):
+        self.pins = {}
+        self.failures = 0
+        self.retry_at = 0
+        self._limit: asyncio.Semaphore = None
+        self._checker: asyncio.Task = None
+
+    @property
+    def limit(self):
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(PIN_CONCURRENCY)
+        return self._limit
+
+    async def pins_for(self, devices):
+        """A usable Pin for each of `devices` by uuid, None for one plex.tv did not give."""
+        missing = [d for d in devices if not (d.uuid in self.pins and self.pins[d.uuid].usable)]
+        if missing and monotonic() >= self.retry_at:
+            await asyncio.gather(*[self._create(d) for d in missing])
+        self._start_checking()
+        return {d.uuid: self.pins.get(d.uuid) for d in devices}
+
+    async def _create(self, device):
+        async with self.limit:
+            if monotonic() < self.retry_at:
+                return
+            try:
+                self.pins[device.uuid] = await get_pin(device)
+                self.failures = 0
+            except Exception as e:
+                self.pins.pop(device.uuid, None)
+                self.failures += 1
+                delay = min(PIN_RETRY_SECS * 2 ** (self.failures - 1), PIN_RETRY_MAX_SECS)
+                self.retry_at = monotonic() + delay
+                print(f"could not get a pin for {device.name} {e.__class__.__name__} {e}, "
+                      f"next try in {delay:.0f}s")
+
+    def _start_checking(self):
+        if self.pins and (self._checker is None or self._checker.done()):
+            self._checker = asyncio.create_task(self._check_loop(), name="pin check")
+
+    async def _check_loop(self):
+        while self.pins:
+            await asyncio.sleep(PIN_CHECK_SECS)
+            now = monotonic()
+            for uuid in [u for u, pin in self.pins.items() if pin.expires_at <= now]:
+                del self.pins[uuid]
+            await asyncio.gather(*[self._check(uuid, pin) for uuid, pin in list(self.pins.items())])
+
+    async def _check(self, uuid: str, pin: Pin):
+        device = next((d for d in devices if d.uuid == uuid), None)
+        if device is None:
+            self.pins.pop(uuid, None)
+            return
+        async with self.limit:
+            try:
+                token = await check_pin(pin.id, device)
+            except Exception as e:
+                print(f"pin check for {device.name} failed {e.__class__.__name__} {e}")
+                return
+        if not token or self.pins.get(uuid) is not pin:
+            return
+        self.linked(device, token)
+
+    def linked(self, device, token: str):
+        """Store the token `device` was linked with; its PIN is done with."""
+        print(f"{device.name} linked to plex.tv")
+        self.pins.pop(device.uuid, None)
+        settings.set_token_for_uuid(device.uuid, token)
+        adapter = adapter_by_device(device)
+        adapter.plex_bind_token = token
+        adapter.publish_to_plex_tv()
+
+    async def close(self):
+        if self._checker is not None:
+            self._checker.cancel()
+
+
+pin_cache = PinCache()
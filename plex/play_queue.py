@@ -1,13 +1,25 @@
 from dotmap import DotMap
 from starlette.datastructures import URL, QueryParams
+from urllib.parse import urlencode
+import asyncio
 import math
 
+import aiohttp
+
+from plex.didl import track_didl, mime_type
+from plex.relay import relay
+from plex.routes import pms_routes
+from plex.transcode import sink_accepts, transcode_target, transcode_path
+from settings import settings
 from utils import g
 
 UNLIMITED = math.inf
 
 MIN_QUEUE_GAP = 25
 
+# Album art is scaled by the server to this size; renderers choke on the originals.
+ALBUM_ART_SIZE = 500
+
 
 class PlayQueue(object):
 
@@ -31,17 +43,26 @@ class PlayQueue(object):
         self.start_offset = None
         self.repeat = 0
 
+    async def fetch(self, url_for):
+        """The MediaContainer at url_for(), asked again over the controller's
+        connection if the quicker one picked by pms_routes does not answer."""
+        for retry in (True, False):
+            try:
+                async with g.http.get(url_for(), headers={"Accept": "application/json"}) as res:
+                    res.raise_for_status()
+                    return DotMap((await res.json())['MediaContainer'])
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if not (retry and pms_routes.failed(self.plex_lib)):
+                    raise
+
     async def get_info(self):
         if self.info is None:
-            url = self.plex_lib.build_url(self.container_key)
-            print(f"get queue {url}")
-            async with g.http.get(url, headers={"Accept": "application/json"}) as res:
-                res.raise_for_status()
-                self.info = DotMap((await res.json())['MediaContainer'])
-                for idx, track in enumerate(await self.available_tracks()):
-                    if track.playQueueItemID == await self.selected_item_id():
-                        self.start_offset = await self.selected_offset() - idx
-                        break
+            print(f"get queue {self.plex_lib.build_url(self.container_key)}")
+            self.info = await self.fetch(lambda: self.plex_lib.build_url(self.container_key))
+            for idx, track in enumerate(await self.available_tracks()):
+                if track.playQueueItemID == await self.selected_item_id():
+                    self.start_offset = await self.selected_offset() - idx
+                    break
         return self.info
 
     async def refresh_queue(self, playQueueID):
@@ -50,32 +71,29 @@ class PlayQueue(object):
             self.container_key = str(self.container_key).replace(str(self.info.playQueueID), str(playQueueID), 1)
         old_selected_item_id = await self.selected_item_id()
         old_selected_item_offset = await self.selected_offset()
-        url = self.plex_lib.build_url(self.container_key)
-        print(f"refresh queue from {url}")
-        async with g.http.get(url, headers={"Accept": "application/json"}) as res:
-            res.raise_for_status()
-            info = DotMap((await res.json())['MediaContainer'])
-            found = 0
-            new_available_offset = None
-            start_offset = None
-            for idx, track in enumerate(info.Metadata):
-                if track.playQueueItemID == old_selected_item_id:
-                    new_available_offset = idx
-                    found += 1
-                if track.playQueueItemID == info.playQueueSelectedItemID:
-                    start_offset = info.playQueueSelectedItemOffset - idx
-                    found += 1
-                if found >= 2:
-                    break
-            if new_available_offset is None or start_offset is None:
-                raise Exception("refreshed queue has no current selected item?")
-            selected_offset = new_available_offset + start_offset
-            print(f"refreshed queue info SelectedItemOffset {old_selected_item_offset} -> {selected_offset}, "
-                  f"start_offset {self.start_offset} -> {start_offset}")
-            info.playQueueSelectedItemID = old_selected_item_id
-            info.playQueueSelectedItemOffset = selected_offset
-            self.info = info
-            self.start_offset = start_offset
+        print(f"refresh queue from {self.plex_lib.build_url(self.container_key)}")
+        info = await self.fetch(lambda: self.plex_lib.build_url(self.container_key))
+        found = 0
+        new_available_offset = None
+        start_offset = None
+        for idx, track in enumerate(info.Metadata):
+            if track.playQueueItemID == old_selected_item_id:
+                new_available_offset = idx
+                found += 1
+            if track.playQueueItemID == info.playQueueSelectedItemID:
+                start_offset = info.playQueueSelectedItemOffset - idx
+                found += 1
+            if found >= 2:
+                break
+        if new_available_offset is None or start_offset is None:
+            raise Exception("refreshed queue has no current selected item?")
+        selected_offset = new_available_offset + start_offset
+        print(f"refreshed queue info SelectedItemOffset {old_selected_item_offset} -> {selected_offset}, "
+              f"start_offset {self.start_offset} -> {start_offset}")
+        info.playQueueSelectedItemID = old_selected_item_id
+        info.playQueueSelectedItemOffset = selected_offset
+        self.info = info
+        self.start_offset = start_offset
 
     async def set_selected_offset(self, offset):
         assert 0 <= offset < await self.total_count()
@@ -104,6 +122,12 @@ class PlayQueue(object):
             offset = offset - self.start_offset
             return (await self.available_tracks())[offset]
 
+    def loaded_track(self, offset):
+        """The track at `offset` if the queue already holds it, without asking the server."""
+        if self.info is None or self.start_offset is None or not self.start_offset <= offset <= self.last_offset:
+            return None
+        return self.info.Metadata[offset - self.start_offset]
+
     async def selected_track(self):
         return await self.track(await self.selected_offset())
 
@@ -120,8 +144,45 @@ class PlayQueue(object):
                 await self.set_selected_offset(idx + self.start_offset)
                 break
 
-    def url_for_track(self, track):
-        return self.plex_lib.build_url(track.Media[0].Part[0].key)
+    def url_for_track(self, track, sink=None, session=None):
+        """source_for_track(), with the URL the renderer is given for `track`."""
+        url, part, mime = self.source_for_track(track, sink, session)
+        if settings.relay:
+            url = relay.register(url, part)
+        return url, part, mime
+
+    def art_url_for_track(self, track):
+        thumb = track.parentThumb or track.thumb or track.grandparentThumb
+        if not thumb:
+            return None
+        query = urlencode(dict(width=ALBUM_ART_SIZE, height=ALBUM_ART_SIZE, minSize=1, upscale=1, url=thumb))
+        url = self.plex_lib.build_url(f"/photo/:/transcode?{query}")
+        if settings.relay:
+            return relay.register(url)
+        return url
+
+    def metadata_for_track(self, track, url, mime=None, seekable=True):
+        """DIDL-Lite for `track` played from `url`, for SetAVTransportURI.
+
+        `mime` and `seekable` describe `url` as url_for_track() worked it out.
+        """
+        return track_didl(track, url, self.art_url_for_track(track), mime, seekable)
+
+    def source_for_track(self, track, sink=None, session=None):
+        """Where the server streams `track` from: (url, Part, mime type).
+
+        `sink` is the renderer's list of mime types. A track it cannot play, or
+        in a format not known here, is transcoded by the server to one it can,
+        and has no Part, since it is not the file itself. `session` names the
+        renderer to the transcoder.
+        """
+        media = track.Media[0] if track.Media else None
+        part = media.Part[0] if media is not None and media.Part else None
+        mime = mime_type(media.container, media.audioCodec) if media is not None else None
+        if part is not None and (not sink or mime is not None and sink_accepts(sink, mime)):
+            return self.plex_lib.build_url(part.key), part, mime
+        ext, mime = transcode_target(sink)
+        return self.plex_lib.build_url(transcode_path(track, ext, session)), None, mime
 
     async def allow_shuffle(self):
         info = await self.get_info()
@@ -140,8 +201,6 @@ class PlayQueue(object):
     async def more(self, after=True):
         if self.info is None:
             await self.get_info()
-        url = URL(self.plex_lib.build_url(self.container_key))
-        url = url.remove_query_params(["center", "includeBefore", "includeAfter"])
         args = {'includeAfter': 0, 'includeBefore': 0}
         if after:
             if self.last_offset >= (await self.total_count()) - 1:
@@ -155,17 +214,20 @@ class PlayQueue(object):
             args['includeBefore'] = 1
             t = await self.track(self.start_offset)
             args['center'] = t.playQueueItemID
-        url = url.include_query_params(**args)
-        async with g.http.get(str(url), headers={"Accept": "application/json"}) as res:
-            res.raise_for_status()
-            info = DotMap((await res.json())['MediaContainer'])
-            if after:
-                self.info.Metadata += info.Metadata
-                print(f"queue {self.container_key} append {len(info.Metadata)} items")
-            else:
-                self.info.Metadata = info.Metadata + self.info.Metadata
-                print(f"queue {self.container_key} prepend {len(info.Metadata)} items")
-                self.start_offset -= len(info.Metadata)
+
+        def url_for():
+            url = URL(self.plex_lib.build_url(self.container_key))
+            url = url.remove_query_params(["center", "includeBefore", "includeAfter"])
+            return str(url.include_query_params(**args))
+
+        info = await self.fetch(url_for)
+        if after:
+            self.info.Metadata += info.Metadata
+            print(f"queue {self.container_key} append {len(info.Metadata)} items")
+        else:
+            self.info.Metadata = info.Metadata + self.info.Metadata
+            print(f"queue {self.container_key} prepend {len(info.Metadata)} items")
+            self.start_offset -= len(info.Metadata)
 
     async def available_tracks(self):
         info = await self.get_info()
@@ -0,0 +1,132 @@
+import asyncio
+import random
+from time import monotonic
+
+import aiohttp
+
+from settings import settings
+from utils import pms_header, parse_retry_after, g
+
+# A published connection is sent again after this long, give or take the
+# jitter, in case plex.tv let it lapse.
+PLEX_TV_REFRESH_SECS = 6 * 3600
+PLEX_TV_REFRESH_JITTER = 0.2
+# After a failed PUT, plex.tv is left alone for this long, doubling up to the max.
+PLEX_TV_RETRY_SECS = 30
+PLEX_TV_RETRY_MAX_SECS = 30 * 60
+PLEX_TV_REQUEST_TIMEOUT = 10
+
+
+class Publication(object):
+    __slots__ = ("adapter", "published", "refresh_at")
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.published = None
+        self.refresh_at = 0
+
+    def wanted(self):
+        """What plex.tv should have for this renderer, or None while it cannot be said."""
+        adapter = self.adapter
+        if not settings.host_ip:
+            return None
+        if not adapter.plex_bind_token:
+            adapter.plex_bind_token = settings.get_token_for_uuid(adapter.dlna.uuid)
+            if not adapter.plex_bind_token:
+                return None
+        return adapter.plex_bind_token, f"http://{settings.host_ip}:{settings.http_port}", adapter.dlna.name
+
+
+class PlexTvPublisher(object):
+    """Keeps each linked renderer's connection URL on plex.tv up to date.
+
+    Every adapter used to PUT its connection every 60 seconds, forever, and
+    never looked at the answer. Now a renderer is published when what plex.tv
+    should know changes (the address, the port, the name or the token) and
+    again every PLEX_TV_REFRESH_SECS or so, jittered so many renderers do not
+    come due together. One worker sends the PUTs one after another, and backs
+    off on errors, as long as plex.tv says in Retry-After if it says.
+    """
+
+    def __init__(self):
+        self.publications = {}
+        self.retry_at = 0
+        self.failures = 0
+        self._wake: asyncio.Event = None
+        self._worker: asyncio.Task = None
+
+    def publish(self, adapter):
+        """Publish `adapter`'s renderer if anything plex.tv knows about it has changed."""
+        publication = self.publications.get(adapter.dlna.uuid)
+        if publication is None:
+            publication = self.publications[adapter.dlna.uuid] = Publication(adapter)
+        publication.adapter = adapter
+        if self._worker is None or self._worker.done():
+            self._wake = asyncio.Event()
+            self._worker = asyncio.create_task(self._run(), name="plex.tv publisher")
+        self._wake.set()
+
+    def forget(self, device):
+        self.publications.pop(device.uuid, None)
+
+    def due(self, now: float):
+        return [p for p in self.publications.values()
+                if p.wanted() is not None and (p.wanted() != p.published or now >= p.refresh_at)]
+
+    def next_refresh(self):
+        times = [p.refresh_at for p in self.publications.values()
+                 if p.published is not None and p.wanted() is not None]
+        return min(times) if times else None
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = monotonic()
+            if now < self.retry_at:
+                await asyncio.sleep(self.retry_at - now)
+                continue
+            for publication in self.due(now):
+                if not await self._put(publication):
+                    break
+            wake_at = [t for t in (self.next_refresh(), self.retry_at) if t and t > now]
+            timeout = max(min(wake_at) - monotonic(), 0) if wake_at else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _put(self, publication: Publication):
+        wanted = publication.wanted()
+        token, uri, name = wanted
+        device = publication.adapter.dlna
+        url = f"{settings.plex_tv_url}/devices/{device.uuid}"
+        retry_after = None
+        try:
+            async with g.http.put(url, params={"X-Plex-Token": token}, data={"Connection[][uri]": uri},
+                                  headers=pms_header(device),
+                                  timeout=aiohttp.ClientTimeout(total=PLEX_TV_REQUEST_TIMEOUT)) as res:
+                if res.status < 400:
+                    self.failures = 0
+                    publication.published = wanted
+                    publication.refresh_at = monotonic() + PLEX_TV_REFRESH_SECS * random.uniform(
+                        1 - PLEX_TV_REFRESH_JITTER, 1 + PLEX_TV_REFRESH_JITTER)
+                    print(f"published {name} at {uri} to plex.tv")
+                    return True
+                retry_after = parse_retry_after(res.headers.get("Retry-After"))
+                error = f"{res.status} {res.reason}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = f"{e.__class__.__name__} {e}"
+        self.failures += 1
+        delay = min(PLEX_TV_RETRY_SECS * 2 ** (self.failures - 1), PLEX_TV_RETRY_MAX_SECS)
+        if retry_after is not None:
+            delay = retry_after
+        self.retry_at = monotonic() + delay
+        print(f"plex.tv update for {name} failed {error}, next try in {delay:.0f}s")
+        return False
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+
+
+plex_tv_publisher = PlexTvPublisher()
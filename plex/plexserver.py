@@ -1,20 +1,32 @@
 
 from fastapi import FastAPI, Request, Header, Query, HTTPException, Form
 from fastapi.responses import Response
+from starlette.datastructures import Headers
+from starlette.routing import Match
 import uvicorn
 
 from dlna import get_device_by_uuid, get_device_data, DlnaDiscover, devices
 from plex.subscribe import sub_man
-from utils import (plex_server_response_headers, xml2dict, timeline_poll_headers, g,
+from utils import (plex_server_response_headers, timeline_poll_headers, device_bundle, g,
                    fallback_charset, device_registration_action)
+from utils.timings import timings, stage, start_request, finish_request
+from utils.commands import RecentCommands
+from utils.lastchange import parse_notify
+from utils.deadline import deadline
+from utils.resolver import PlexDirectResolver
+from utils.profile import UnsupportedAction
 from settings import settings
 import asyncio
-from dlna.dlna_device import DlnaDevice
+from functools import lru_cache
+from time import monotonic
+from dlna.dlna_device import DlnaDevice, event_subscriptions, note_early_event
 from plex.adapters import adapter_by_device
 from plex.gdm import PlexGDM
+from plex.relay import relay
+from plex.timeline_reporter import timeline_reporter
+from plex.plex_tv import plex_tv_publisher
 from fastapi.templating import Jinja2Templates
 from plex import pin_login
-from datetime import datetime, timedelta
 import aiohttp
 
 
@@ -26,6 +38,67 @@ templates = Jinja2Templates(directory="templates")
 plex_server = FastAPI()
 s = plex_server
 
+recent_commands = RecentCommands()
+
+
+# Request paths whose route template is remembered, see route_path().
+ROUTE_PATHS_KEPT = 256
+
+
+@lru_cache(maxsize=ROUTE_PATHS_KEPT)
+def route_path(method: str, path: str):
+    """The route template a request will be dispatched to, e.g. /dlna/callback/{uuid}."""
+    scope = {"type": "http", "method": method, "path": path}
+    for route in plex_server.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return path
+
+
+def time_requests(app):
+    """Middleware timing each request to the start of its response, see RouteTimings.
+
+    Plain ASGI, so the response body goes out as the route sends it: a relayed
+    track or a cached file is not copied through another stream on its way.
+    """
+    async def timed(scope, receive, send):
+        if scope["type"] != "http":
+            return await app(scope, receive, send)
+        method, path = scope["method"], scope["path"]
+        target = Headers(scope=scope).get("x-plex-target-client-identifier")
+        if target is None and path.startswith("/dlna/callback/"):
+            target = path.rsplit("/", 1)[-1]
+        timing = timings.begin(route_path(method, path), method, target)
+        ended = False
+
+        def end(status):
+            nonlocal ended
+            ended = True
+            timings.end(timing, status)
+            if timing.busy_ms >= timings.slow_ms:
+                print(f"{method} {path} for {target} used {timing.duration_ms}ms "
+                      f"{[(n, ms) for n, _, ms in timing.stages]}")
+
+        async def send_timed(message):
+            # a relayed track is timed to its first byte, not for as long as
+            # the renderer takes to play it
+            if message["type"] == "http.response.start" and not ended:
+                end(message["status"])
+            await send(message)
+
+        token = start_request(timing)
+        try:
+            await app(scope, receive, send_timed)
+        finally:
+            finish_request(token)
+            if not ended:
+                end(None)
+    return timed
+
+
+s.add_middleware(time_requests)
+
 
 async def on_new_dlna_device(location_url):
     print(f"got new dlna deviec location url {location_url}")
@@ -61,7 +134,7 @@ async def on_new_dlna_device(location_url):
     asyncio.create_task(device.loop_subscribe(), name=f"dlna sub {device.name}")
     devices.append(device)
     adapter = adapter_by_device(device)
-    adapter.start_plex_tv_notify()
+    adapter.publish_to_plex_tv()
     gdm = PlexGDM(device)
     gdm.run()
 
@@ -103,7 +176,7 @@ def guess_host_ip(request: Request):
     print(f"guessed host ip {settings.host_ip}")
     for device in devices:
         adapter = adapter_by_device(device)
-        asyncio.create_task(adapter.update_plex_tv_connection())
+        adapter.publish_to_plex_tv()
 
 
 async def build_response(content: str, device: DlnaDevice = None, target_uuid: str = None, status_code: int = 200,
@@ -120,16 +193,19 @@ async def build_response(content: str, device: DlnaDevice = None, target_uuid: s
                 'Accept-Language': 'en'}
             if target_uuid is not None:
                 headers['X-Plex-Client-Identifier'] = target_uuid
-    if headers is None:
-        headers = plex_server_response_headers(device)
-    return Response(content=content,
-                    status_code=status_code,
-                    headers=headers)
+    with stage("response"):
+        if headers is None:
+            headers = plex_server_response_headers(device)
+        return Response(content=content,
+                        status_code=status_code,
+                        headers=headers)
 
 
 @s.on_event("startup")
 async def on_startup():
-    g.http = aiohttp.ClientSession(fallback_charset_resolver=fallback_charset)
+    # plex.direct names are resolved from the name itself, see PlexDirectResolver
+    connector = aiohttp.TCPConnector(resolver=PlexDirectResolver(), use_dns_cache=False)
+    g.http = aiohttp.ClientSession(connector=connector, fallback_charset_resolver=fallback_charset)
     asyncio.create_task(register_known_devices(), name="known devices")
     await dlna_discover.discover()
     asyncio.create_task(sub_man.start())
@@ -145,6 +221,10 @@ async def on_shutdown():
         stop_tasks.append(adapter.stop())
         stop_tasks.append(device.remove_self())
     await asyncio.gather(*stop_tasks)
+    await relay.close()
+    await timeline_reporter.close()
+    await plex_tv_publisher.close()
+    await pin_login.pin_cache.close()
     if g.http:
         await g.http.close()
 
@@ -152,25 +232,33 @@ async def on_shutdown():
 @s.get("/")
 async def link_page(request: Request):
     guess_host_ip(request)
+    unbound = [d for d in devices if adapter_by_device(d).plex_bind_token is None]
+    pins = await pin_login.pin_cache.pins_for(unbound)
     ds = []
     for d in devices:
-        adapter = adapter_by_device(d)
-        if adapter.plex_bind_token is not None:
+        pin = pins.get(d.uuid)
+        if d.uuid not in pins:
             ds.append(dict(
                 name=d.name,
                 uuid=d.uuid,
                 binded=True
             ))
         else:
-            pin, pin_id = await pin_login.get_pin(d)
             ds.append(dict(
                 name=d.name,
                 uuid=d.uuid,
-                pin=pin,
-                pin_id=pin_id,
+                pin=pin.code if pin else None,
+                pin_id=pin.id if pin else None,
                 binded=False
             ))
-    return templates.TemplateResponse("bind.html", {'devices': ds, 'request': request})
+    return templates.TemplateResponse("bind.html", {'devices': ds, 'request': request,
+                                                    'waiting': bool(unbound)})
+
+
+@s.get("/link/status")
+async def link_status():
+    """Which renderers are linked, for the bind page to pick up what the PIN checks found."""
+    return {d.uuid: adapter_by_device(d).plex_bind_token is not None for d in devices}
 
 
 @s.post("/")
@@ -185,23 +273,55 @@ async def link_device(request: Request,
     if pin_id:
         token = await pin_login.check_pin(pin_id, device)
         if token:
-            settings.set_token_for_uuid(uuid, token)
-            await adapter.update_plex_tv_connection()
+            pin_login.pin_cache.linked(device, token)
     if name and name != device.name:
         device.name = name
         settings.save_dlna_name_alias(uuid, name)
-        await adapter.update_plex_tv_connection()
+        adapter.publish_to_plex_tv()
     return await link_page(request)
 
 
+def apply_event(sid: str, uuid: str, body: bytes):
+    """Hand a GENA event to its renderer's state. Runs after the NOTIFY was answered."""
+    service = event_subscriptions.get(sid)
+    # The first event can beat the SUBSCRIBE response that tells us its SID.
+    device = service.device if service is not None else next((d for d in devices if d.uuid == uuid), None)
+    if device is None:
+        if __debug__:
+            print(f"event for unknown subscription {sid} {uuid}")
+        return
+    if service is not None:
+        service.event_received()
+    elif sid:
+        note_early_event(sid)
+    adapter_by_device(device).update_state(parse_notify(body))
+
+
 @s.api_route("/dlna/callback/{uuid}", methods=["NOTIFY"])
 async def dlna_subscribe(request: Request, uuid: str):
-    adapter = adapter_by_device(await get_device_by_uuid(uuid))
-    b = await request.body()
-    info = xml2dict(b)
-    if adapter is not None:
-        adapter.update_state(info)
-    return ""
+    # Renderers wait for this answer before sending the next event, and some
+    # drop the subscription when it is slow.
+    body = await request.body()
+    asyncio.get_running_loop().call_soon(apply_event, request.headers.get("sid"), uuid, body)
+    return Response()
+
+
+async def run_command(target_uuid: str, client_uuid: str, command_id: int, execute):
+    """Run a playback command once per commandID, see RecentCommands."""
+    sub_man.update_command_id(target_uuid, client_uuid, command_id)
+    # The controller stops waiting after a few seconds; whatever is still going
+    # on for the command then is cancelled rather than left to finish unseen.
+    with deadline(settings.command_deadline) as at:
+        try:
+            response = await asyncio.wait_for(recent_commands.run(client_uuid, target_uuid, command_id, execute),
+                                              timeout=max(0, at - monotonic()))
+        except asyncio.TimeoutError:
+            print(f"command {command_id} for {target_uuid} missed its {settings.command_deadline}s deadline")
+            raise HTTPException(504, "command timed out")
+        except UnsupportedAction as e:
+            print(f"command {command_id} for {target_uuid} not sent: {e}")
+            raise HTTPException(501, str(e))
+    return response
 
 
 @s.get("/player/playback/playMedia")
@@ -215,16 +335,21 @@ async def play_media(request: Request,
                      target_uuid: str = Header(None, alias="x-plex-target-client-identifier"),
                      client_uuid: str = Header(None, alias="x-plex-client-identifier")):
     guess_host_ip(request)
-    sub_man.update_command_id(target_uuid, client_uuid, commandID)
-    device = await get_device_by_uuid(target_uuid)
-    if device is None:
-        raise HTTPException(404)
-    adapter = adapter_by_device(device, request.query_params)
-    if type_ == "music":
-        await adapter.play_media(containerKey, key=key, offset=offset, paused=paused, query_params=request.query_params)
-    else:
-        await adapter.stop()
-    return await build_response("", device=device)
+
+    async def execute():
+        device = await get_device_by_uuid(target_uuid)
+        if device is None:
+            raise HTTPException(404)
+        adapter = adapter_by_device(device, request.query_params)
+        with stage("adapter"):
+            if type_ == "music":
+                await adapter.play_media(containerKey, key=key, offset=offset, paused=paused,
+                                         query_params=request.query_params)
+            else:
+                await adapter.stop()
+        return await build_response("", device=device)
+
+    return await run_command(target_uuid, client_uuid, commandID, execute)
 
 
 @s.get("/player/playback/refreshPlayQueue")
@@ -232,13 +357,16 @@ async def refresh_play_queue(commandID: int,
                              playQueueID: int,
                              target_uuid: str = Header(None, alias="x-plex-target-client-identifier"),
                              client_uuid: str = Header(None, alias="x-plex-client-identifier")):
-    sub_man.update_command_id(target_uuid, client_uuid, commandID)
-    device = await get_device_by_uuid(target_uuid)
-    if device is None:
-        raise HTTPException(404)
-    adapter = adapter_by_device(device)
-    await adapter.refresh_queue(playQueueID)
-    return await build_response("", device=device)
+    async def execute():
+        device = await get_device_by_uuid(target_uuid)
+        if device is None:
+            raise HTTPException(404)
+        adapter = adapter_by_device(device)
+        with stage("adapter"):
+            await adapter.refresh_queue(playQueueID)
+        return await build_response("", device=device)
+
+    return await run_command(target_uuid, client_uuid, commandID, execute)
 
 
 @s.get("/player/playback/play")
@@ -246,16 +374,19 @@ async def play(commandID: int,
                type_: str = Query("music", alias="type"),
                target_uuid: str = Header(None, alias="x-plex-target-client-identifier"),
                client_uuid: str = Header(None, alias="x-plex-client-identifier")):
-    sub_man.update_command_id(target_uuid, client_uuid, commandID)
-    device = await get_device_by_uuid(target_uuid)
-    if device is None:
-        raise HTTPException(404)
-    adapter = adapter_by_device(device)
-    if type_ == "music":
-        await adapter.play()
-    else:
-        await adapter.stop()
-    return await build_response("", device=device)
+    async def execute():
+        device = await get_device_by_uuid(target_uuid)
+        if device is None:
+            raise HTTPException(404)
+        adapter = adapter_by_device(device)
+        with stage("adapter"):
+            if type_ == "music":
+                await adapter.play()
+            else:
+                await adapter.stop()
+        return await build_response("", device=device)
+
+    return await run_command(target_uuid, client_uuid, commandID, execute)
 
 
 @s.get("/player/playback/pause")
@@ -263,14 +394,17 @@ async def pause(commandID: int,
                 type_: str = Query("music", alias="type"),
                 target_uuid: str = Header(None, alias="x-plex-target-client-identifier"),
                 client_uuid: str = Header(None, alias="x-plex-client-identifier")):
-    sub_man.update_command_id(target_uuid, client_uuid, commandID)
-    device = await get_device_by_uuid(target_uuid)
-    if device is None:
-        raise HTTPException(404)
-    adapter = adapter_by_device(device)
-    if type_ == "music":
-        await adapter.pause()
-    return await build_response("", device=device)
+    async def execute():
+        device = await get_device_by_uuid(target_uuid)
+        if device is None:
+            raise HTTPException(404)
+        adapter = adapter_by_device(device)
+        if type_ == "music":
+            with stage("adapter"):
+                await adapter.pause()
+        return await build_response("", device=device)
+
+    return await run_command(target_uuid, client_uuid, commandID, execute)
 
 
 @s.get("/player/playback/stop")
@@ -280,12 +414,16 @@ async def stop(request: Request,
                target_uuid: str = Header(None, alias="x-plex-target-client-identifier"),
                client_uuid: str = Header(None, alias="x-plex-client-identifier")):
     guess_host_ip(request)
-    sub_man.update_command_id(target_uuid, client_uuid, commandID)
-    if type_ == "music":
-        device = await get_device_by_uuid(target_uuid)
-        adapter = adapter_by_device(device)
-        await adapter.stop()
-    return await build_response(XML_OK, target_uuid=target_uuid)
+
+    async def execute():
+        if type_ == "music":
+            device = await get_device_by_uuid(target_uuid)
+            adapter = adapter_by_device(device)
+            with stage("adapter"):
+                await adapter.stop()
+        return await build_response(XML_OK, target_uuid=target_uuid)
+
+    return await run_command(target_uuid, client_uuid, commandID, execute)
 
 
 @s.get("/player/playback/skipNext")
@@ -293,14 +431,17 @@ async def next_(commandID: int,
                 type_: str = Query("music", alias="type"),
                 target_uuid: str = Header(None, alias="x-plex-target-client-identifier"),
                 client_uuid: str = Header(None, alias="x-plex-client-identifier")):
-    sub_man.update_command_id(target_uuid, client_uuid, commandID)
-    if type_ == "music":
-        device = await get_device_by_uuid(target_uuid)
-        if device is None:
-            raise HTTPException(404, f"device not found {target_uuid}")
-        adapter = adapter_by_device(device)
-        await adapter.next()
-    return await build_response("", target_uuid=target_uuid)
+    async def execute():
+        if type_ == "music":
+            device = await get_device_by_uuid(target_uuid)
+            if device is None:
+                raise HTTPException(404, f"device not found {target_uuid}")
+            adapter = adapter_by_device(device)
+            with stage("adapter"):
+                await adapter.next()
+        return await build_response("", target_uuid=target_uuid)
+
+    return await run_command(target_uuid, client_uuid, commandID, execute)
 
 
 @s.get("/player/playback/skipPrevious")
@@ -308,14 +449,17 @@ async def prev(commandID: int,
                type_: str = Query("music", alias="type"),
                target_uuid: str = Header(None, alias="x-plex-target-client-identifier"),
                client_uuid: str = Header(None, alias="x-plex-client-identifier")):
-    sub_man.update_command_id(target_uuid, client_uuid, commandID)
-    if type_ == "music":
-        device = await get_device_by_uuid(target_uuid)
-        if device is None:
-            raise HTTPException(404, f"device not found {target_uuid}")
-        adapter = adapter_by_device(device)
-        await adapter.prev()
-    return await build_response("", target_uuid=target_uuid)
+    async def execute():
+        if type_ == "music":
+            device = await get_device_by_uuid(target_uuid)
+            if device is None:
+                raise HTTPException(404, f"device not found {target_uuid}")
+            adapter = adapter_by_device(device)
+            with stage("adapter"):
+                await adapter.prev()
+        return await build_response("", target_uuid=target_uuid)
+
+    return await run_command(target_uuid, client_uuid, commandID, execute)
 
 
 @s.get("/player/playback/seekTo")
@@ -324,14 +468,17 @@ async def seek(commandID: int,
                type_: str = Query("music", alias="type"),
                target_uuid: str = Header(None, alias="x-plex-target-client-identifier"),
                client_uuid: str = Header(None, alias="x-plex-client-identifier")):
-    sub_man.update_command_id(target_uuid, client_uuid, commandID)
-    if type_ == "music":
-        device = await get_device_by_uuid(target_uuid)
-        if device is None:
-            raise HTTPException(404, f"device not found {target_uuid}")
-        adapter = adapter_by_device(device)
-        await adapter.seek(offset)
-    return await build_response("", target_uuid=target_uuid)
+    async def execute():
+        if type_ == "music":
+            device = await get_device_by_uuid(target_uuid)
+            if device is None:
+                raise HTTPException(404, f"device not found {target_uuid}")
+            adapter = adapter_by_device(device)
+            with stage("adapter"):
+                await adapter.seek(offset)
+        return await build_response("", target_uuid=target_uuid)
+
+    return await run_command(target_uuid, client_uuid, commandID, execute)
 
 
 @s.get("/player/playback/skipTo")
@@ -340,14 +487,17 @@ async def skip_to(commandID: int,
                   type_: str = Query("music", alias="type"),
                   target_uuid: str = Header(None, alias="x-plex-target-client-identifier"),
                   client_uuid: str = Header(None, alias="x-plex-client-identifier")):
-    sub_man.update_command_id(target_uuid, client_uuid, commandID)
-    if type_ == "music":
-        device = await get_device_by_uuid(target_uuid)
-        if device is None:
-            raise HTTPException(404, f"device not found {target_uuid}")
-        adapter = adapter_by_device(device)
-        await adapter.skip_to_track(key)
-    return await build_response("", target_uuid=target_uuid)
+    async def execute():
+        if type_ == "music":
+            device = await get_device_by_uuid(target_uuid)
+            if device is None:
+                raise HTTPException(404, f"device not found {target_uuid}")
+            adapter = adapter_by_device(device)
+            with stage("adapter"):
+                await adapter.skip_to_track(key)
+        return await build_response("", target_uuid=target_uuid)
+
+    return await run_command(target_uuid, client_uuid, commandID, execute)
 
 
 @s.get("/player/playback/setParameters")
@@ -358,33 +508,36 @@ async def set_parameters(commandID: int,
                          volume: float = None,
                          target_uuid: str = Header(None, alias="x-plex-target-client-identifier"),
                          client_uuid: str = Header(None, alias="x-plex-client-identifier")):
-    sub_man.update_command_id(target_uuid, client_uuid, commandID)
-    if type_ == 'music':
-        device = await get_device_by_uuid(target_uuid)
-        if device is None:
-            raise HTTPException(404, f"device not found {target_uuid}")
-        adapter = adapter_by_device(device)
-        if shuffle is not None:
-            adapter.shuffle = shuffle
-        if repeat is not None:
-            adapter.queue.repeat = repeat
-        if volume is not None:
-            await adapter.set_volume(int(volume))
-    return await build_response("", target_uuid=target_uuid)
+    async def execute():
+        if type_ == 'music':
+            device = await get_device_by_uuid(target_uuid)
+            if device is None:
+                raise HTTPException(404, f"device not found {target_uuid}")
+            adapter = adapter_by_device(device)
+            if shuffle is not None:
+                adapter.shuffle = shuffle
+                adapter.shuffle_plan = []
+            if repeat is not None:
+                adapter.queue.repeat = repeat
+            if shuffle is not None or repeat is not None:
+                adapter.prefetch()
+            if volume is not None:
+                with stage("adapter"):
+                    await adapter.set_volume(int(volume))
+        return await build_response("", target_uuid=target_uuid)
+
+    return await run_command(target_uuid, client_uuid, commandID, execute)
 
 
-waiting_poll_count = 0
 @s.get("/player/timeline/poll")
 async def timeline_poll(request: Request,
                         commandID: int,
                         wait: int = 0,
                         target_uuid: str = Header(None, alias="x-plex-target-client-identifier"),
                         client_uuid: str = Header(None, alias="x-plex-client-identifier")):
-    global waiting_poll_count
-    waiting_poll_count += 1
-    if waiting_poll_count > 3:
-        print(f"waiting poll {waiting_poll_count}")
-    begin_time = datetime.utcnow()
+    waiting_polls = timings.in_flight("/player/timeline/poll")
+    if waiting_polls > 3:
+        print(f"waiting poll {waiting_polls}")
     guess_host_ip(request)
     sub_man.update_command_id(target_uuid, client_uuid, commandID)
     device = await get_device_by_uuid(target_uuid)
@@ -392,19 +545,22 @@ async def timeline_poll(request: Request,
         raise HTTPException(404, f"device not found {target_uuid}")
     asyncio.create_task(device.loop_subscribe())
     adapter = adapter_by_device(device)
+    if adapter.state.idle:
+        # the first poll after a quiet spell
+        device.warm_up()
     if wait == 1:
-        await adapter.wait_for_event(settings.plex_notify_interval * 20, interesting_fields=[
-            'state', 'volume', 'current_uri', 'elapsed_jump'])
-    msg = await sub_man.msg_for_device(device)
-    while msg is None:
-        print(f"waiting for msg {target_uuid}")
-        await asyncio.sleep(settings.plex_notify_interval)
+        with stage("wait for change", waiting=True):
+            await adapter.wait_for_event(settings.plex_notify_interval * 20, interesting_fields=[
+                'state', 'volume', 'current_uri', 'elapsed_jump'])
+    with stage("timeline"):
         msg = await sub_man.msg_for_device(device)
+        while msg is None:
+            print(f"waiting for msg {target_uuid}")
+            await asyncio.sleep(settings.plex_notify_interval)
+            msg = await sub_man.msg_for_device(device)
     msg = msg.format(command_id=commandID)
-    if datetime.utcnow() - begin_time >= timedelta(milliseconds=500):
-        print(f"{request.url} used {datetime.utcnow() - begin_time}")
-    waiting_poll_count -= 1
-    asyncio.create_task(sub_man.notify_server_device(device, force=True))
+    # only sent on if the server has not heard of it yet
+    asyncio.create_task(sub_man.notify_server_device(device))
     return await build_response(msg, device=device, headers=timeline_poll_headers(device))
 
 
@@ -419,6 +575,7 @@ async def subscribe(request: Request,
     device = await get_device_by_uuid(target_uuid)
     if device is None:
         raise HTTPException(404, f"device not found {target_uuid}")
+    device.warm_up()
     sub_man.add_subscriber(target_uuid, client_uuid, request.client.host, port, protocol=protocol, command_id=commandID)
     return await build_response(XML_OK, target_uuid=target_uuid)
 
@@ -440,16 +597,26 @@ async def resources(request: Request, target_uuid: str = Header(None, alias="x-p
     device = await get_device_by_uuid(target_uuid)
     if device is None:
         raise HTTPException(404, f"no device {target_uuid}")
+    device.warm_up()
     print(f"resource for {device.name}")
-    res = "<MediaContainer>"
-    res += f'<Player title="{device.name}" protocol="plex" protocolVersion="1" ' \
-           f'protocolCapabilities="timeline,playback,playqueues" ' \
-           f'machineIdentifier="{device.uuid}" product="{device.model}" ' \
-           f'platform="{settings.platform}" ' \
-           f'platformVersion="{settings.platform_version}" ' \
-           f'version="{settings.version}" deviceClass="stb"/>'
-    res += "</MediaContainer>"
-    return await build_response(res, device=device)
+    return await build_response(device_bundle(device).resources, device=device)
+
+
+@s.api_route("/relay/{relay_id}", methods=["GET", "HEAD"])
+async def relay_track(request: Request, relay_id: str):
+    entry = relay.entry(relay_id)
+    if entry is None:
+        raise HTTPException(404, f"nothing to relay for {relay_id}")
+    try:
+        return await relay.respond(entry, request.method, request.headers.get("range"))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"relay {relay_id} failed {e.__class__.__name__} {e}")
+        raise HTTPException(502, "plex server unreachable")
+
+
+@s.get("/debug/timings")
+async def debug_timings():
+    return timings.snapshot({d.uuid: d.name for d in devices})
 
 
 @s.get("/player/mirror/details")
@@ -0,0 +1,108 @@
+import asyncio
+import contextvars
+from time import monotonic
+
+import aiohttp
+
+from plex.relay import relay, RELAY_CHUNK_BYTES
+from plex.track_cache import track_cache
+from settings import settings
+
+
+def upcoming_offsets(selected: int, total, repeat: int, count: int, shuffle_plan=None):
+    """Queue offsets that will play after `selected`, nearest first.
+
+    repeat 1 plays the same track again, which is already on its way, and
+    repeat 2 wraps around to the start. In shuffle the plan drawn ahead of time
+    is what next() will play.
+    """
+    if count <= 0 or repeat == 1:
+        return []
+    if shuffle_plan is not None:
+        return [o for o in shuffle_plan[:count] if o != selected]
+    offsets = []
+    offset = selected
+    while len(offsets) < count:
+        offset += 1
+        if offset >= total:
+            if repeat != 2:
+                break
+            offset = 0
+        if offset == selected:
+            break
+        offsets.append(offset)
+    return offsets
+
+
+class Prefetcher(object):
+    """Fetches the tracks that play next into the track cache, one at a time.
+
+    When a track starts, the next PREFETCH_TRACKS of the queue are downloaded at
+    no more than PREFETCH_KBPS, so the track change itself is served from disk.
+    A track that cannot be cached, a transcode, only gets its first byte asked
+    for, which is enough to get the server working on it before the renderer
+    asks. A new plan replaces the one running; nothing here is waited on.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.task: asyncio.Task = None
+
+    def start(self, items):
+        """Fetch `items`, (url, part) pairs, in order, in place of the current plan."""
+        self.cancel()
+        if not items:
+            return
+        # not bound by the deadline of the command that started the track
+        self.task = asyncio.create_task(self._run(items), name=f"prefetch {self.name}",
+                                        context=contextvars.Context())
+
+    def cancel(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = None
+
+    async def _run(self, items):
+        for url, part in items:
+            try:
+                if await track_cache.lookup(part) is not None:
+                    continue
+                fill = await track_cache.start_fill(part)
+                if fill is not None:
+                    await self._download(url, fill)
+                elif part is None or not part.get("size"):
+                    await self._touch(url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                print(f"{self.name} prefetch {url.split('?')[0]} failed {e.__class__.__name__} {e}")
+
+    async def _download(self, url: str, fill):
+        started = monotonic()
+        try:
+            async with relay.http.get(url, headers={"Accept-Encoding": "identity"},
+                                      timeout=aiohttp.ClientTimeout(total=None, sock_connect=10,
+                                                                    sock_read=30)) as res:
+                res.raise_for_status()
+                async for chunk in res.content.iter_chunked(RELAY_CHUNK_BYTES):
+                    await fill.write(chunk)
+                    await self._throttle(fill.written, started)
+            await fill.finish()
+            if __debug__:
+                print(f"{self.name} prefetched {fill.path.name} in {monotonic() - started:.1f}s")
+        finally:
+            if fill.key in track_cache.filling:
+                fill.abort()
+
+    @staticmethod
+    async def _throttle(done: int, started: float):
+        rate = settings.prefetch_kbps * 1000 / 8
+        if rate <= 0:
+            return
+        ahead = done / rate - (monotonic() - started)
+        if ahead > 0:
+            await asyncio.sleep(ahead)
+
+    @staticmethod
+    async def _touch(url: str):
+        async with relay.http.get(url, headers={"Range": "bytes=0-0"},
+                                  timeout=aiohttp.ClientTimeout(total=30)) as res:
+            await res.read()
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import mimetypes
+from collections import OrderedDict
+
+import aiohttp
+from starlette.background import BackgroundTask
+from starlette.responses import Response, StreamingResponse
+
+from plex.track_cache import track_cache, parse_range, CachedFileResponse, CacheFill
+from settings import settings
+from utils import fallback_charset
+from utils.resolver import PlexDirectResolver
+
+# Tracks that can be relayed at once; the oldest registration is dropped first.
+RELAY_ENTRIES_KEPT = 256
+# Bytes read from the server per chunk, and chunks read ahead of the renderer.
+RELAY_CHUNK_BYTES = 64 * 1024
+RELAY_READ_AHEAD_CHUNKS = 32
+# An idle connection to the server is kept this long for the next request.
+RELAY_KEEPALIVE_SECS = 60
+
+# Passed from the server's response to the renderer.
+FORWARDED_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "Last-Modified", "ETag")
+
+_END = object()
+
+
+class RelayEntry(object):
+    __slots__ = ("url", "part")
+
+    def __init__(self, url: str, part=None):
+        self.url = url
+        self.part = part
+
+
+class RelayStream(object):
+    """Copies one response body from the server to the renderer, reading ahead.
+
+    A producer reads chunks into a bounded queue while the renderer takes them,
+    so a slow moment at either end does not stall the other for up to
+    RELAY_READ_AHEAD_CHUNKS chunks. Chunks are handed on as aiohttp read them.
+
+    With a `fill`, the same chunks are also written to the track cache.
+    """
+
+    def __init__(self, upstream: aiohttp.ClientResponse, fill: CacheFill = None):
+        self.upstream = upstream
+        self.fill = fill
+        self.queue = asyncio.Queue(maxsize=RELAY_READ_AHEAD_CHUNKS)
+        self.producer = asyncio.create_task(self._read())
+
+    async def _read(self):
+        try:
+            async for chunk in self.upstream.content.iter_chunked(RELAY_CHUNK_BYTES):
+                await self.queue.put(chunk)
+                await self._tee(chunk)
+            if self.fill is not None:
+                await self.fill.finish()
+                self.fill = None
+        except asyncio.CancelledError:
+            # the renderer went away, so nothing is left to take the end from a
+            # queue that may well be full
+            self._abort_fill()
+            raise
+        except Exception as e:
+            # the renderer sees a short body, as it would from the server itself
+            print(f"relay read from {self.upstream.url.host} failed {e.__class__.__name__} {e}")
+        self._abort_fill()
+        await self.queue.put(_END)
+
+    def _abort_fill(self):
+        if self.fill is not None:
+            self.fill.abort()
+            self.fill = None
+
+    async def _tee(self, chunk):
+        if self.fill is None:
+            return
+        try:
+            await self.fill.write(chunk)
+        except OSError as e:
+            # a full disk costs the cache, not the playback
+            print(f"track cache write failed {e}")
+            self._abort_fill()
+
+    async def __aiter__(self):
+        while True:
+            chunk = await self.queue.get()
+            if chunk is _END:
+                return
+            yield chunk
+
+    async def close(self):
+        self.producer.cancel()
+        # wait() rather than await, so the producer's cancellation stays its own
+        await asyncio.wait([self.producer])
+        self.upstream.release()
+
+
+class Relay(object):
+    """Serves tracks to renderers from the bridge's own HTTP server.
+
+    The renderer gets a plain http URL on the LAN, /relay/<id>, instead of the
+    server's https plex.direct URL with the token in it. Cheap renderers stall on
+    the TLS handshake and on seeking over it; here one kept-alive session to the
+    server does that work, and range requests are passed through for seeking.
+
+    Tracks streamed in full are kept in the track cache, and served from disk
+    the next time they are played.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self._http: aiohttp.ClientSession = None
+
+    def register(self, url: str, part=None):
+        """The relay URL for `url`, or `url` itself while the bridge's address is unknown."""
+        if not settings.host_ip:
+            return url
+        relay_id = hashlib.sha1(url.encode("utf8")).hexdigest()[:20]
+        self.entries[relay_id] = RelayEntry(url, part)
+        self.entries.move_to_end(relay_id)
+        while len(self.entries) > RELAY_ENTRIES_KEPT:
+            self.entries.popitem(last=False)
+        return f"http://{settings.host_ip}:{settings.http_port}/relay/{relay_id}"
+
+    def entry(self, relay_id: str):
+        return self.entries.get(relay_id)
+
+    @property
+    def http(self):
+        if self._http is None or self._http.closed:
+            connector = aiohttp.TCPConnector(resolver=PlexDirectResolver(), use_dns_cache=False,
+                                             keepalive_timeout=RELAY_KEEPALIVE_SECS)
+            self._http = aiohttp.ClientSession(connector=connector, fallback_charset_resolver=fallback_charset,
+                                               auto_decompress=False)
+        return self._http
+
+    async def respond(self, entry: RelayEntry, method: str, range_header: str = None):
+        cached = await track_cache.lookup(entry.part)
+        if cached is not None:
+            return self.respond_cached(*cached, method, range_header)
+        headers = {"Accept-Encoding": "identity"}
+        if range_header:
+            headers["Range"] = range_header
+        upstream = await self.http.request(method, entry.url, headers=headers,
+                                           timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30))
+        response_headers = {k: upstream.headers[k] for k in FORWARDED_HEADERS if k in upstream.headers}
+        response_headers["transferMode.dlna.org"] = "Streaming"
+        if method == "HEAD" or upstream.status >= 400:
+            upstream.release()
+            if upstream.status >= 400:
+                print(f"relay {entry.url.split('?')[0]} answered {upstream.status}")
+            return Response(status_code=upstream.status, headers=response_headers)
+        fill = None
+        if method == "GET" and (upstream.status == 200 or
+                                upstream.headers.get("Content-Range", "").startswith("bytes 0-")):
+            fill = await track_cache.start_fill(entry.part)
+        stream = RelayStream(upstream, fill)
+        return StreamingResponse(stream, status_code=upstream.status, headers=response_headers,
+                                 background=BackgroundTask(stream.close))
+
+    @staticmethod
+    def respond_cached(path, st, method: str, range_header: str = None):
+        try:
+            byte_range = parse_range(range_header, st.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{st.st_size}"})
+        return CachedFileResponse(path, st, byte_range, method=method,
+                                  media_type=mimetypes.guess_type(path.name)[0] or "application/octet-stream",
+                                  headers={"transferMode.dlna.org": "Streaming"})
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+
+
+relay = Relay()
@@ -0,0 +1,178 @@
+import asyncio
+from collections import namedtuple
+from time import monotonic
+
+import aiohttp
+
+from settings import settings
+from utils import g
+from utils.resolver import PLEX_DIRECT_SUFFIX
+
+# Seconds a probe of one connection may take, and how long a chosen route is
+# used before it is raced again in the background.
+ROUTE_PROBE_TIMEOUT = 3
+ROUTE_REVALIDATE_SECS = 600
+# Connections remembered per server.
+ROUTES_KEPT = 6
+PMS_DEFAULT_PORT = 32400
+
+Route = namedtuple("Route", ["protocol", "address", "port"])
+
+
+class ChosenRoute(object):
+    __slots__ = ("route", "latency", "checked_at")
+
+    def __init__(self, route: Route, latency: float):
+        self.route = route
+        self.latency = latency
+        self.checked_at = monotonic()
+
+    @property
+    def stale(self):
+        return monotonic() - self.checked_at > ROUTE_REVALIDATE_SECS
+
+
+def lan_routes(offered: Route):
+    """Connections on the LAN, from PLEX_LAN_ADDRESS.
+
+    When the controller used a plex.direct name, the same server's certificate
+    covers the LAN address under that name's hash, so https keeps working.
+    """
+    lan = settings.plex_lan_address
+    if not lan:
+        return []
+    routes = []
+    if offered.address.lower().endswith(PLEX_DIRECT_SUFFIX):
+        server_hash = offered.address.split(".", 1)[1]
+        dashed = lan.replace(".", "-").replace(":", "-")
+        routes.append(Route("https", f"{dashed}.{server_hash}", PMS_DEFAULT_PORT))
+    if offered.protocol == "http" or settings.force_http:
+        # a server that requires secure connections answers /identity over http
+        # and then refuses everything else
+        routes.append(Route("http", lan, PMS_DEFAULT_PORT))
+    return routes
+
+
+class PmsRoutes(object):
+    """Picks the quickest working connection to each Plex server.
+
+    A controller hands over whichever connection it used itself, which is often
+    the remote or relay one while the server is on the same LAN. That, the
+    connections that worked before and the LAN ones are all asked for /identity
+    at once; the first to answer with the right machineIdentifier wins. The
+    race runs in the background, so nothing waits on it: the controller's
+    connection is used until it is done, and the winner from then on. When the
+    winner stops answering, the controller's connection is used again and
+    another race is run.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self._races = {}
+
+    def apply(self, plex_lib):
+        """Point `plex_lib` at the best known route to its server, racing for one if needed."""
+        machine_id = plex_lib.machine_id
+        if not machine_id or not plex_lib.address:
+            return
+        chosen = self.routes.get(machine_id)
+        if chosen is None or chosen.stale:
+            self._start_race(machine_id, self.offered(plex_lib), plex_lib)
+        if chosen is not None:
+            plex_lib.protocol, plex_lib.address, plex_lib.port = chosen.route
+
+    def failed(self, plex_lib):
+        """The route `plex_lib` was pointed at stopped answering.
+
+        Returns whether `plex_lib` was moved back to the controller's connection,
+        and so is worth trying again.
+        """
+        machine_id = plex_lib.machine_id
+        if not machine_id or machine_id not in self.routes:
+            return False
+        chosen = self.routes[machine_id]
+        offered = self.offered(plex_lib)
+        current = Route(plex_lib.protocol, plex_lib.address, int(plex_lib.port or PMS_DEFAULT_PORT))
+        if chosen.route != current or offered == current:
+            return False
+        print(f"plex server {machine_id} via {current.address} stopped answering, back to {offered.address}")
+        del self.routes[machine_id]
+        plex_lib.protocol, plex_lib.address, plex_lib.port = offered
+        self._start_race(machine_id, offered, plex_lib)
+        return True
+
+    @staticmethod
+    def offered(plex_lib):
+        protocol, address, port = plex_lib.offered_route or (plex_lib.protocol, plex_lib.address, plex_lib.port)
+        return Route(protocol, address, int(port or PMS_DEFAULT_PORT))
+
+    def candidates(self, machine_id: str, offered: Route):
+        candidates = [offered]
+        for route in lan_routes(offered) + [Route(*r) for r in settings.pms_routes(machine_id)]:
+            if route not in candidates:
+                candidates.append(route)
+        return candidates
+
+    def _start_race(self, machine_id: str, offered: Route, plex_lib):
+        if machine_id in self._races:
+            return
+        try:
+            task = asyncio.get_running_loop().create_task(self._race(machine_id, offered, plex_lib),
+                                                          name=f"pms route {machine_id}")
+        except RuntimeError:
+            return
+        self._races[machine_id] = task
+        task.add_done_callback(lambda _: self._races.pop(machine_id, None))
+
+    async def _race(self, machine_id: str, offered: Route, plex_lib):
+        candidates = self.candidates(machine_id, offered)
+        chosen = await self.race(machine_id, candidates)
+        if chosen is None:
+            print(f"no route to plex server {machine_id} answered, keeping {offered.address}")
+            return
+        previous = self.routes.get(machine_id)
+        self.routes[machine_id] = chosen
+        if previous is None or previous.route != chosen.route:
+            print(f"plex server {machine_id} via {chosen.route.protocol}://{chosen.route.address}:"
+                  f"{chosen.route.port} ({int(chosen.latency * 1000)}ms)")
+        if plex_lib.machine_id == machine_id:
+            plex_lib.protocol, plex_lib.address, plex_lib.port = chosen.route
+        remembered = [list(chosen.route)] + [list(r) for r in candidates if r != chosen.route]
+        settings.save_pms_routes(machine_id, remembered[:ROUTES_KEPT])
+
+    async def race(self, machine_id: str, candidates, client: aiohttp.ClientSession = None):
+        """The first of `candidates` to answer as `machine_id`, or None."""
+        client = client or g.http
+        if client is None:
+            return None
+        probes = [asyncio.ensure_future(self.probe(machine_id, route, client)) for route in candidates]
+        try:
+            for done in asyncio.as_completed(probes):
+                chosen = await done
+                if chosen is not None:
+                    return chosen
+            return None
+        finally:
+            for probe in probes:
+                probe.cancel()
+
+    @staticmethod
+    async def probe(machine_id: str, route: Route, client: aiohttp.ClientSession):
+        started = monotonic()
+        url = f"{route.protocol}://{route.address}:{route.port}/identity"
+        try:
+            async with client.get(url, headers={"Accept": "application/json"},
+                                  timeout=aiohttp.ClientTimeout(total=ROUTE_PROBE_TIMEOUT)) as res:
+                if not res.ok:
+                    return None
+                identity = await res.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return None
+        identity = identity.get("MediaContainer") if isinstance(identity, dict) else None
+        if not isinstance(identity, dict) or identity.get("machineIdentifier") != machine_id:
+            # another server on that address, or a captive portal
+            return None
+        return ChosenRoute(route, monotonic() - started)
+
+
+pms_routes = PmsRoutes()
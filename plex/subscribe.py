@@ -1,7 +1,8 @@
 import asyncio
 
 from plex.adapters import adapter_by_device
-from utils import subscriber_send_headers, pms_header, g
+from plex.timeline_reporter import timeline_reporter
+from utils import subscriber_send_headers, g
 from settings import settings
 from dlna import devices, get_device_by_uuid
 from datetime import datetime, timedelta
@@ -30,7 +31,6 @@ TIMELINE_PLAYING = '<MediaContainer commandID="{command_id}"><Timeline controlla
 class SubscribeManager(object):
     subscribers = {}
     running = True
-    last_server_notify_state = {}
 
     def get_subscriber(self, target_uuid: str, client_uuid: str):
         s = [s for s in self.subscribers.get(target_uuid, []) if s.uuid == client_uuid]
@@ -76,7 +76,7 @@ class SubscribeManager(object):
             if len(l) == 0:
                 device = await get_device_by_uuid(tu)
                 if device is not None and len(self.subscribers.get(tu, [])) == 0:
-                    device.stop_subscribe()
+                    await device.stop_subscribe()
 
     def stop(self):
         self.running = False
@@ -96,18 +96,7 @@ class SubscribeManager(object):
             return
         if adapter.plex_state is None:
             return
-        if self.last_server_notify_state.get(device.uuid, "") == adapter.plex_state == "stopped" and not force:
-            return
-        self.last_server_notify_state[device.uuid] = adapter.plex_state
-        params = await adapter.get_pms_state()
-        if not params or params.get('state', None) is None:
-            return
-        params.update(pms_header(device))
-        async with g.http.get(adapter.plex_lib.get_timeline(), params=params) as res:
-            try:
-                res.raise_for_status()
-            except Exception as e:
-                print(f"notify server error {e}, {res.content}, {params}")
+        await timeline_reporter.report(device, adapter, force=force)
 
     async def notify(self):
         await self.notify_server()
@@ -118,7 +107,8 @@ class SubscribeManager(object):
         adapter = adapter_by_device(device)
         if adapter.no_notice:
             return None
-        if adapter.state.state is None or adapter.state.state == "STOPPED" or adapter.queue is None:
+        adapter.state.watch()
+        if adapter.state.state in (None, "STOPPED") or adapter.queue is None:
             return TIMELINE_STOPPED
         state = await adapter.get_state()
         if not state or state.get('state', None) is None:
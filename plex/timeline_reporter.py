@@ -0,0 +1,152 @@
+import asyncio
+from time import monotonic
+from urllib.parse import urlparse
+
+import aiohttp
+
+from plex.routes import pms_routes
+from utils import pms_header, fallback_charset, parse_retry_after
+from utils.coalesce import Coalescer
+from utils.resolver import PlexDirectResolver
+
+# A timeline that has not changed is sent again this often while playing or
+# paused, so the server does not drop the session.
+TIMELINE_HEARTBEAT_SECS = 10
+# A position this far from where playing on would have put it is a seek.
+TIMELINE_JUMP_MS = 3000
+# After a failed report the server is left alone for this long, doubling up to the max.
+TIMELINE_BACKOFF_SECS = 2
+TIMELINE_BACKOFF_MAX_SECS = 60
+TIMELINE_REQUEST_TIMEOUT = 5
+TIMELINE_KEEPALIVE_SECS = 60
+
+# A difference in any of these is worth a report on its own.
+CHANGE_KEYS = ('state', 'ratingKey', 'key', 'playQueueItemID', 'shuffle', 'repeat', 'containerKey')
+
+
+class DeviceReport(object):
+    """What was last reported to the server for one renderer."""
+
+    def __init__(self, name: str, send):
+        self.queued = None
+        self.queued_at = 0
+        self.sender = Coalescer(lambda value: send(self, value), name=f"{name} timeline", settle_secs=0)
+
+
+class ServerBackoff(object):
+
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0
+
+    def failed(self, retry_after: float = None):
+        self.failures += 1
+        delay = min(TIMELINE_BACKOFF_SECS * 2 ** (self.failures - 1), TIMELINE_BACKOFF_MAX_SECS)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self.retry_at = monotonic() + delay
+        return delay
+
+    def succeeded(self):
+        self.failures = 0
+        self.retry_at = 0
+
+
+class TimelineReporter(object):
+    """Tells the Plex server what each renderer is playing, when it changes.
+
+    The notify loop and every controller poll used to GET /:/timeline, twice a
+    second per renderer. Now a report goes out when the state, the track or the
+    queue settings change, when the position jumps, and every
+    TIMELINE_HEARTBEAT_SECS otherwise. Reports for one renderer go one at a
+    time, the latest replacing any that is waiting, over a session that keeps
+    one connection to each server open. A server that answers with errors is
+    left alone for a while, longer each time.
+    """
+
+    def __init__(self):
+        self.devices = {}
+        self.servers = {}
+        self._http: aiohttp.ClientSession = None
+
+    @property
+    def http(self):
+        if self._http is None or self._http.closed:
+            connector = aiohttp.TCPConnector(resolver=PlexDirectResolver(), use_dns_cache=False, limit_per_host=1,
+                                             keepalive_timeout=TIMELINE_KEEPALIVE_SECS)
+            self._http = aiohttp.ClientSession(connector=connector, fallback_charset_resolver=fallback_charset)
+        return self._http
+
+    @staticmethod
+    def due(report: DeviceReport, params: dict, now: float):
+        """Why `params` should be reported, or None if it need not be."""
+        last = report.queued
+        if last is None:
+            return "first"
+        if any(str(params.get(k)) != str(last.get(k)) for k in CHANGE_KEYS):
+            return "change"
+        if params.get('state') == "stopped":
+            return None
+        try:
+            expected = int(last.get('time') or 0)
+            if last.get('state') == "playing":
+                expected += int((now - report.queued_at) * 1000)
+            if abs(int(params.get('time') or 0) - expected) > TIMELINE_JUMP_MS:
+                return "seek"
+        except (TypeError, ValueError):
+            pass
+        if now - report.queued_at >= TIMELINE_HEARTBEAT_SECS:
+            return "heartbeat"
+        return None
+
+    async def report(self, device, adapter, force=False):
+        params = await adapter.get_pms_state()
+        if not params or params.get('state', None) is None:
+            return
+        report = self.devices.get(device.uuid)
+        if report is None:
+            report = self.devices[device.uuid] = DeviceReport(device.name, self._send)
+        now = monotonic()
+        if not force and self.due(report, params, now) is None:
+            return
+        url = adapter.plex_lib.get_timeline()
+        backoff = self.servers.setdefault(urlparse(url).netloc, ServerBackoff())
+        if not force and now < backoff.retry_at:
+            return
+        report.queued, report.queued_at = dict(params), now
+        params.update(pms_header(device))
+        report.sender.submit((url, params, backoff, adapter.plex_lib))
+        if force:
+            # the last word on a renderer going away, sent before anything closes
+            await report.sender.wait()
+
+    async def _send(self, report: DeviceReport, value):
+        url, params, backoff, plex_lib = value
+        try:
+            async with self.http.get(url, params=params,
+                                     timeout=aiohttp.ClientTimeout(total=TIMELINE_REQUEST_TIMEOUT)) as res:
+                if res.status < 400:
+                    backoff.succeeded()
+                    return
+                retry_after = parse_retry_after(res.headers.get("Retry-After"))
+                error = f"{res.status} {res.reason}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            retry_after, error = None, f"{e.__class__.__name__} {e}"
+            if pms_routes.failed(plex_lib):
+                # the next report goes over the controller's connection, not held back
+                report.queued = None
+                return
+        # reported again once the server is given another try
+        report.queued = None
+        delay = backoff.failed(retry_after)
+        print(f"notify server error {error}, next try in {delay:.0f}s")
+
+    def forget(self, device):
+        self.devices.pop(device.uuid, None)
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+
+
+timeline_reporter = TimelineReporter()
@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path, PurePosixPath
+
+import anyio
+from starlette.responses import FileResponse
+from starlette.types import Receive, Scope, Send
+
+from settings import settings
+
+# Served from the cache in reads of this size.
+CACHE_READ_BYTES = 64 * 1024
+FILLING_SUFFIX = ".filling"
+# bytes=<start>-[<end>], the only form renderers send
+SINGLE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def part_size(part):
+    if part is None:
+        return None
+    try:
+        size = int(part.get("size") or 0)
+    except (TypeError, ValueError):
+        return None
+    return size if size > 0 else None
+
+
+def cache_key(part):
+    """Names a track by its Part key and size, or None when it cannot be cached.
+
+    The Part key carries the file's update time, so a changed file gets a new key.
+    """
+    size = part_size(part)
+    key = part.get("key") if part is not None else None
+    if size is None or not key:
+        return None
+    return hashlib.sha1(f"{key}|{size}".encode("utf8")).hexdigest()
+
+
+def parse_range(range_header: str, size: int):
+    """(start, end) inclusive for a single byte range, None for the whole file.
+
+    Raises ValueError for a range that cannot be satisfied.
+    """
+    if not range_header:
+        return None
+    m = SINGLE_RANGE.match(range_header.strip())
+    if m is None:
+        # several ranges at once; the whole file is an allowed answer
+        return None
+    first, last = m.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(range_header)
+    return start, end
+
+
+class CachedFileResponse(FileResponse):
+    """FileResponse for one byte range of the file.
+
+    The file is read in CACHE_READ_BYTES pieces, in a thread, so nothing of it
+    is held in memory beyond one read.
+    """
+
+    chunk_size = CACHE_READ_BYTES
+
+    def __init__(self, path, stat_result: os.stat_result, byte_range=None, **kwargs):
+        super().__init__(path, stat_result=stat_result, **kwargs)
+        size = stat_result.st_size
+        self.offset, self.count = 0, size
+        self.headers["accept-ranges"] = "bytes"
+        if byte_range is not None:
+            start, end = byte_range
+            self.offset, self.count = start, end - start + 1
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+            self.headers["content-length"] = str(self.count)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as f:
+                await f.seek(self.offset)
+                left = self.count
+                while left > 0:
+                    chunk = await f.read(min(self.chunk_size, left))
+                    left -= len(chunk)
+                    more_body = left > 0 and len(chunk) > 0
+                    await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+                    if not more_body:
+                        break
+        if self.background is not None:
+            await self.background()
+
+
+class CacheFill(object):
+    """Writes one track into the cache as the relay streams it to a renderer.
+
+    Writes go to a thread, so the disk never holds up the loop; the file only
+    takes its cache name once every byte of the track is in it.
+    """
+
+    def __init__(self, cache: "TrackCache", key: str, suffix: str, size: int):
+        self.cache = cache
+        self.key = key
+        self.size = size
+        self.path = cache.directory.joinpath(key + suffix)
+        self.temp = self.path.with_name(self.path.name + FILLING_SUFFIX)
+        self.file = None
+        self.written = 0
+
+    async def write(self, chunk: bytes):
+        if self.file is None:
+            self.file = await asyncio.to_thread(open, self.temp, "wb")
+        await asyncio.to_thread(self.file.write, chunk)
+        self.written += len(chunk)
+
+    async def finish(self):
+        """Keeps the file if it holds the whole track, and drops it otherwise."""
+        complete = self.written == self.size
+        try:
+            if self.file is not None:
+                await asyncio.to_thread(self.file.close)
+            if complete:
+                await asyncio.to_thread(os.replace, self.temp, self.path)
+        except OSError as e:
+            print(f"track cache write {self.path.name} failed {e}")
+            complete = False
+        if not complete:
+            self.abort()
+        await self.cache.filled(self, complete)
+
+    def abort(self):
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+        try:
+            self.temp.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"track cache cleanup {self.temp.name} failed {e}")
+        self.cache.filling.discard(self.key)
+
+
+class TrackCache(object):
+    """Tracks played through the relay, kept on disk under CONFIG_PATH/tracks.
+
+    Each file is named after cache_key() of its Part, so a replay of the same
+    file finds it no matter which server URL or play queue it came from.
+    Least recently played tracks go first once the cache grows past
+    TRACK_CACHE_MB. The order is kept in the files' modification times, so it
+    survives restarts.
+
+    The index is only touched from the main loop; the disk is left to a thread,
+    as it is by CacheFill, so a slow disk does not hold up the tracks streaming.
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        self._directory = Path(directory) if directory is not None else None
+        self._max_bytes = max_bytes
+        self.entries: "OrderedDict[str, tuple]" = None
+        self.total = 0
+        self.filling = set()
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            return Path(settings.config_path).joinpath("tracks")
+        return self._directory
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is None:
+            return int(settings.track_cache_mb * 1024 * 1024)
+        return self._max_bytes
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _scan(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        found = []
+        for f in os.scandir(self.directory):
+            if not f.is_file():
+                continue
+            if f.name.endswith(FILLING_SUFFIX):
+                # left over from a fill that was cut off by a restart
+                os.unlink(f.path)
+                continue
+            st = f.stat()
+            found.append((st.st_mtime, f.name.split(".")[0], Path(f.path), st.st_size))
+        return sorted(found)
+
+    async def _load(self):
+        if self.entries is not None:
+            return
+        found = await asyncio.to_thread(self._scan)
+        if self.entries is not None:
+            # loaded by another caller meanwhile
+            return
+        self.entries = OrderedDict()
+        self.total = 0
+        for _, key, path, size in found:
+            self.entries[key] = (path, size)
+            self.total += size
+
+    @staticmethod
+    def _touch(path: Path):
+        os.utime(path)
+        return path.stat()
+
+    async def lookup(self, part):
+        """The cached file for `part` and its stat, or None. Marks it recently used."""
+        key = cache_key(part)
+        if key is None or not self.enabled:
+            return None
+        await self._load()
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        path, size = entry
+        try:
+            st = await asyncio.to_thread(self._touch, path)
+        except FileNotFoundError:
+            if self.entries.get(key) == entry:
+                del self.entries[key]
+                self.total -= size
+            return None
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        return path, st
+
+    async def start_fill(self, part):
+        """A CacheFill for `part`, or None if it is cached, being cached, or too big."""
+        key = cache_key(part)
+        if key is None or not self.enabled or key in self.filling:
+            return None
+        size = part_size(part)
+        if size > self.max_bytes:
+            return None
+        await self._load()
+        if key in self.entries or key in self.filling:
+            return None
+        self.filling.add(key)
+        return CacheFill(self, key, PurePosixPath(part.key).suffix, size)
+
+    async def filled(self, fill: CacheFill, complete: bool):
+        self.filling.discard(fill.key)
+        if not complete:
+            return
+        self.entries[fill.key] = (fill.path, fill.size)
+        self.total += fill.size
+        print(f"track cache added {fill.path.name}, {self.total // (1024 * 1024)} MB in use")
+        await self.evict()
+
+    async def evict(self):
+        evicted = []
+        while self.total > self.max_bytes and self.entries:
+            _, (path, size) = self.entries.popitem(last=False)
+            self.total -= size
+            evicted.append(path)
+        if evicted:
+            await asyncio.to_thread(self._remove, evicted)
+
+    @staticmethod
+    def _remove(paths):
+        for path in paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"track cache evict {path.name} failed {e}")
+
+
+track_cache = TrackCache()
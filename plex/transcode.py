@@ -0,0 +1,75 @@
+from urllib.parse import urlencode
+
+from settings import settings
+
+# Mime types renderers list under other names, by the name mime_type() uses.
+MIME_ALIASES = {
+    "audio/mpeg": ("audio/mpeg", "audio/mp3", "audio/x-mp3", "audio/mpeg3", "audio/x-mpeg"),
+    "audio/flac": ("audio/flac", "audio/x-flac"),
+    "audio/mp4": ("audio/mp4", "audio/x-m4a", "audio/m4a", "audio/x-mp4"),
+    "audio/aac": ("audio/aac", "audio/x-aac", "audio/aacp", "audio/vnd.dlna.adts"),
+    "audio/wav": ("audio/wav", "audio/x-wav", "audio/wave"),
+    "audio/aiff": ("audio/aiff", "audio/x-aiff"),
+    "audio/ogg": ("audio/ogg", "application/ogg", "audio/x-ogg"),
+}
+
+# What the server can transcode to, most widely played first:
+# (file extension of the transcode URL, its mime type).
+TRANSCODE_TARGETS = (
+    ("mp3", "audio/mpeg"),
+    ("aac", "audio/aac"),
+)
+TRANSCODE_BITRATE_KBPS = 320
+
+
+def parse_sink_protocols(sink: str):
+    """The mime types in a ConnectionManager Sink list, or None if it takes anything.
+
+    http-get:*:audio/flac:*,http-get:*:audio/mpeg:DLNA.ORG_PN=MP3 -> {"audio/flac", "audio/mpeg"}
+    """
+    mimes = set()
+    for entry in (sink or "").split(","):
+        fields = entry.strip().split(":")
+        if len(fields) < 4 or fields[0] not in ("http-get", "*"):
+            continue
+        mime = fields[2].strip().lower()
+        if mime in ("*", "audio/*", "*/*"):
+            return None
+        mimes.add(mime)
+    return frozenset(mimes) or None
+
+
+def sink_accepts(sink, mime: str):
+    """Whether a renderer with sink mime types `sink` plays `mime`. No list means yes."""
+    if not sink:
+        return True
+    return any(alias in sink for alias in MIME_ALIASES.get(mime, (mime,)))
+
+
+def transcode_target(sink):
+    """(extension, mime) of the first transcode the renderer plays, mp3 if none is listed."""
+    for ext, mime in TRANSCODE_TARGETS:
+        if sink_accepts(sink, mime):
+            return ext, mime
+    return TRANSCODE_TARGETS[0]
+
+
+def transcode_path(track, ext: str, session: str = None):
+    """The server's universal transcoder path for `track`, streamed over plain http.
+
+    Each track gets a transcode session of its own, named after the renderer
+    and the play queue item: the server replaces a running transcode when
+    another starts in the same session, and the next track is asked for while
+    the current one is still streaming.
+    """
+    item = track.playQueueItemID or track.ratingKey
+    track_session = f"{session}-{item}" if session and item else session or ""
+    query = dict(path=track.key, mediaIndex=0, partIndex=0, protocol="http", offset=0,
+                 directPlay=0, directStream=0, directStreamAudio=0, musicBitrate=TRANSCODE_BITRATE_KBPS,
+                 session=track_session, hasMDE=1)
+    query["X-Plex-Client-Identifier"] = session or ""
+    query["X-Plex-Product"] = settings.product
+    query["X-Plex-Platform"] = settings.platform
+    query["X-Plex-Client-Profile-Extra"] = (f"add-transcode-target(type=musicProfile&context=streaming&"
+                                            f"protocol=http&container={ext}&audioCodec={ext})")
+    return f"/music/:/transcode/universal/start.{ext}?{urlencode(query)}"
@@ -24,6 +24,23 @@ class Settings(BaseSettings):
     # Required when the controller reaches Plex over IPv6, since the IPv6 form of
     # a plex.direct name cannot be turned into a usable LAN address on its own.
     plex_lan_address: str = None
+    # SOAP requests in flight to one renderer at a time. Many renderers serve a
+    # single request at a time; controller commands always go ahead of polls.
+    dlna_concurrency = 2
+    # Seconds a playback command from a controller may take, SOAP retries
+    # included. Controllers give up on a player before the retry budget runs out.
+    command_deadline = 8.0
+    # Hand renderers a plain http URL on this bridge for each track, which
+    # fetches it from the Plex server, instead of the server's own URL.
+    relay = False
+    # Megabytes of relayed tracks kept on disk under config_path, 0 to keep none.
+    track_cache_mb = 2048
+    # With relay on, tracks after the playing one fetched into the track cache
+    # ahead of time, and the rate they are fetched at in kbit/s, 0 for no limit.
+    prefetch_tracks = 2
+    prefetch_kbps = 20000
+    # Where linked renderers publish their connection, for testing against a stand-in.
+    plex_tv_url = "https://plex.tv"
     config_path = "config"
     data_file_name = "data.json"
 
@@ -63,6 +80,8 @@ class Settings(BaseSettings):
         info["alias"] = alias
         data[uuid] = info
         self.save_data(data)
+        from utils.bundles import invalidate_device_bundle
+        invalidate_device_bundle(uuid)
 
     def load_data(self):
         p = Path(self.config_path).joinpath(self.data_file_name)
@@ -122,6 +141,38 @@ class Settings(BaseSettings):
         info = self.load_data().get(uuid) or {}
         return bool((info.get("known_device") or {}).get("played"))
 
+    def device_profile(self, uuid):
+        """What was learned about a renderer on earlier runs, see RendererProfile."""
+        info = self.load_data().get(uuid)
+        if not isinstance(info, dict):
+            return {}
+        return info.get("profile") or {}
+
+    def save_device_profile(self, uuid, profile: dict):
+        data = self.load_data()
+        info = data.get(uuid, {})
+        if info.get("profile") == profile:
+            return
+        info["profile"] = profile
+        data[uuid] = info
+        self.save_data(data)
+
+    def pms_routes(self, machine_id):
+        """Connections to a Plex server that answered before, best first, as [protocol, address, port]."""
+        info = self.load_data().get(machine_id)
+        if not isinstance(info, dict):
+            return []
+        return info.get("pms_routes") or []
+
+    def save_pms_routes(self, machine_id, routes: list):
+        data = self.load_data()
+        info = data.get(machine_id, {})
+        if info.get("pms_routes") == routes:
+            return
+        info["pms_routes"] = routes
+        data[machine_id] = info
+        self.save_data(data)
+
     def known_device_urls(self):
         """Description URLs of every renderer that has registered before."""
         urls = []
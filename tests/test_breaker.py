@@ -0,0 +1,95 @@
+import unittest
+
+from utils.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    """A powered off amp must stop costing a retry schedule on every poll."""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker("amp", failure_threshold=3, probe_delays=(2, 5, 10), clock=self.clock)
+
+    def test_stays_closed_below_the_threshold(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.allow_background(), (True, False))
+
+    def test_a_success_resets_the_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_opens_and_short_circuits_background_calls(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.allow_background(), (False, False))
+
+    def test_only_one_probe_once_it_is_due(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.now = 2
+        self.assertTrue(self.breaker.probe_due())
+        self.assertEqual(self.breaker.allow_background(), (True, True))
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        # the other polls of the same tick stay short-circuited
+        self.assertEqual(self.breaker.allow_background(), (False, False))
+
+    def test_failed_probes_back_off(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.now = 2
+        self.breaker.allow_background()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.next_probe_at, 2 + 5)
+        self.clock.now = 7
+        self.breaker.allow_background()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.next_probe_at, 7 + 10)
+        self.clock.now = 17
+        self.breaker.allow_background()
+        self.breaker.record_failure()
+        # the last delay repeats
+        self.assertEqual(self.breaker.next_probe_at, 17 + 10)
+
+    def test_commands_failing_while_open_leave_the_probes_alone(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.now = 1
+        self.breaker.record_failure(background=False)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.next_probe_at, 2)
+
+    def test_successful_probe_closes(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.now = 2
+        self.breaker.allow_background()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.allow_background(), (True, False))
+
+    def test_inconclusive_probe_goes_back_to_open(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.now = 2
+        self.breaker.allow_background()
+        self.breaker.release_probe()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertTrue(self.breaker.probe_due())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+from dotmap import DotMap
+
+from settings import settings
+from utils import pms_header, plex_server_response_headers, subscriber_send_headers, timeline_poll_headers
+from utils.bundles import device_bundle, invalidate_device_bundle
+
+
+def device(name="Living Room"):
+    return DotMap(uuid="uuid-1", name=name, model="amp")
+
+
+class DeviceBundleTest(unittest.TestCase):
+
+    def tearDown(self):
+        invalidate_device_bundle()
+
+    def test_built_once_per_device(self):
+        d = device()
+        self.assertIs(device_bundle(d), device_bundle(d))
+        self.assertIs(pms_header(d), pms_header(d))
+        self.assertIs(plex_server_response_headers(d), device_bundle(d).plex_server_response_headers)
+        self.assertIs(subscriber_send_headers(d), device_bundle(d).subscriber_send_headers)
+        self.assertIs(timeline_poll_headers(d), device_bundle(d).timeline_poll_headers)
+
+    def test_headers_are_read_only(self):
+        headers = pms_header(device())
+        with self.assertRaises(TypeError):
+            headers['X-Plex-Device-Name'] = "changed"
+        self.assertEqual(headers['X-Plex-Device-Name'], "Living Room")
+        self.assertEqual({**headers, 'state': 'playing'}['X-Plex-Client-Identifier'], "uuid-1")
+
+    def test_rename_rebuilds(self):
+        d = device()
+        before = device_bundle(d)
+        d.name = "Kitchen"
+        after = device_bundle(d)
+        self.assertIsNot(before, after)
+        self.assertEqual(after.pms_header['X-Plex-Device-Name'], "Kitchen")
+        self.assertIn(b"Name: Kitchen\n", after.gdm_hello)
+
+    def test_saving_an_alias_invalidates(self):
+        d = device()
+        before = device_bundle(d)
+        old_path = settings.config_path
+        with tempfile.TemporaryDirectory() as config:
+            settings.config_path = config
+            try:
+                settings.save_dlna_name_alias(d.uuid, "Kitchen")
+            finally:
+                settings.config_path = old_path
+        self.assertIsNot(device_bundle(d), before)
+
+    def test_resources_body(self):
+        body = device_bundle(device('Tom & "Jerry"')).resources
+        player = ET.fromstring(body).find("Player")
+        self.assertEqual(player.get("title"), 'Tom & "Jerry"')
+        self.assertEqual(player.get("machineIdentifier"), "uuid-1")
+        self.assertEqual(player.get("product"), "amp")
+
+    def test_gdm_payloads(self):
+        bundle = device_bundle(device())
+        self.assertTrue(bundle.gdm_hello.startswith(b"HELLO * HTTP/1.0\nName: Living Room\n"))
+        self.assertTrue(bundle.gdm_reply.startswith(b"HTTP/1.0 200 OK\nName: Living Room\n"))
+        self.assertIn(f"Port: {settings.http_port}\n".encode(), bundle.gdm_reply)
+        self.assertIn(b"Resource-Identifier: uuid-1\n", bundle.gdm_reply)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import asyncio
+import unittest
+
+from utils.coalesce import Coalescer
+from utils.deadline import deadline, remaining
+from utils.timings import RequestTiming, current_request, start_request, finish_request
+
+
+class CoalescerTest(unittest.IsolatedAsyncioTestCase):
+    """A volume drag must not queue one SetVolume per step."""
+
+    async def test_burst_sends_first_and_last_only(self):
+        sent = []
+        gate = asyncio.Event()
+
+        async def send(value):
+            sent.append(value)
+            if len(sent) == 1:
+                await gate.wait()
+
+        c = Coalescer(send)
+        for v in range(10, 60, 5):
+            c.submit(v)
+            await asyncio.sleep(0)
+        gate.set()
+        await c.wait()
+        self.assertEqual(sent, [10, 55])
+
+    async def test_only_one_send_in_flight(self):
+        in_flight = []
+        peak = []
+
+        async def send(value):
+            in_flight.append(value)
+            peak.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.pop()
+
+        c = Coalescer(send)
+        for v in range(5):
+            c.submit(v)
+            await asyncio.sleep(0.003)
+        await c.wait()
+        self.assertEqual(max(peak), 1)
+
+    async def test_intended_value_is_reported_until_settled(self):
+        gate = asyncio.Event()
+
+        async def send(value):
+            await gate.wait()
+
+        c = Coalescer(send, settle_secs=0.05)
+        self.assertIsNone(c.current())
+        c.submit(42)
+        self.assertEqual(c.current(), 42)
+        gate.set()
+        await c.wait()
+        # still reported while the next poll catches up
+        self.assertEqual(c.current(), 42)
+        await asyncio.sleep(0.06)
+        self.assertIsNone(c.current())
+
+    async def test_a_failed_send_does_not_stop_the_next(self):
+        sent = []
+        gate = asyncio.Event()
+
+        async def send(value):
+            if value == 1:
+                await gate.wait()
+                raise Exception("renderer said no")
+            sent.append(value)
+
+        c = Coalescer(send)
+        c.submit(1)
+        await asyncio.sleep(0)
+        c.submit(2)
+        gate.set()
+        await c.wait()
+        self.assertEqual(sent, [2])
+
+    async def test_sends_belong_to_no_request(self):
+        seen = []
+
+        async def send(value):
+            seen.append((remaining(), current_request()))
+
+        c = Coalescer(send)
+        token = start_request(RequestTiming("/player/playback/setParameters", "GET"))
+        try:
+            with deadline(5):
+                c.submit(30)
+        finally:
+            finish_request(token)
+        await c.wait()
+        self.assertEqual(seen, [(None, None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
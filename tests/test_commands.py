@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+
+from utils.commands import RecentCommands
+
+
+class RecentCommandsTest(unittest.IsolatedAsyncioTestCase):
+    """A resent skipNext must not skip two tracks."""
+
+    def setUp(self):
+        self.commands = RecentCommands()
+        self.runs = []
+
+    def execute(self, name, gate: asyncio.Event = None):
+        async def go():
+            self.runs.append(name)
+            if gate is not None:
+                await gate.wait()
+            return f"done {name}"
+        return go
+
+    async def test_repeated_command_id_is_answered_from_the_first(self):
+        first = await self.commands.run("c", "t", 5, self.execute("a"))
+        again = await self.commands.run("c", "t", 5, self.execute("b"))
+        self.assertEqual(first, again)
+        self.assertEqual(self.runs, ["a"])
+
+    async def test_resend_joins_the_running_command(self):
+        gate = asyncio.Event()
+        first = asyncio.create_task(self.commands.run("c", "t", 5, self.execute("a", gate)))
+        await asyncio.sleep(0)
+        resend = asyncio.create_task(self.commands.run("c", "t", 5, self.execute("b")))
+        await asyncio.sleep(0)
+        gate.set()
+        self.assertEqual(await first, "done a")
+        self.assertEqual(await resend, "done a")
+        self.assertEqual(self.runs, ["a"])
+
+    async def test_command_arriving_out_of_order_still_runs(self):
+        await self.commands.run("c", "t", 7, self.execute("seven"))
+        self.assertEqual(await self.commands.run("c", "t", 6, self.execute("six")), "done six")
+        self.assertEqual(self.runs, ["seven", "six"])
+
+    async def test_pairs_are_independent(self):
+        await self.commands.run("c", "t1", 7, self.execute("a"))
+        await self.commands.run("c", "t2", 7, self.execute("b"))
+        await self.commands.run("other", "t1", 3, self.execute("c"))
+        self.assertEqual(self.runs, ["a", "b", "c"])
+
+    async def test_restarted_controller_is_not_answered_from_before(self):
+        await self.commands.run("c", "t", 1, self.execute("first"))
+        await self.commands.run("c", "t", 500, self.execute("before"))
+        await self.commands.run("c", "t", 1, self.execute("after"))
+        await self.commands.run("c", "t", 2, self.execute("next"))
+        self.assertEqual(self.runs, ["first", "before", "after", "next"])
+
+    async def test_resend_of_a_command_that_timed_out_times_out_too(self):
+        first = asyncio.create_task(self.commands.run("c", "t", 5, self.execute("a", asyncio.Event())))
+        await asyncio.sleep(0)
+        resend = asyncio.create_task(self.commands.run("c", "t", 5, self.execute("b")))
+        await asyncio.sleep(0)
+        first.cancel()
+        with self.assertRaises(asyncio.TimeoutError):
+            await resend
+        self.assertEqual(self.runs, ["a"])
+
+    async def test_failed_command_can_be_resent(self):
+        async def fail():
+            raise Exception("renderer unreachable")
+
+        with self.assertRaises(Exception):
+            await self.commands.run("c", "t", 5, fail)
+        self.assertEqual(await self.commands.run("c", "t", 5, self.execute("retry")), "done retry")
+
+    async def test_without_ids_everything_runs(self):
+        await self.commands.run(None, "t", 5, self.execute("a"))
+        await self.commands.run(None, "t", 5, self.execute("b"))
+        self.assertEqual(self.runs, ["a", "b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
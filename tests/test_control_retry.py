@@ -80,6 +80,37 @@ class TransientFailureTest(unittest.TestCase):
         self.assertLessEqual(CONTROL_RETRY_BUDGET, 15)
 
 
+class RetryOffsetsTest(unittest.TestCase):
+    """Retries fitted to how long this renderer takes to wake up."""
+
+    def test_without_history_the_default_schedule(self):
+        from utils import retry_offsets
+        self.assertEqual(retry_offsets([]), (0, 0.4, 1.2, 2.8, 6.0))
+        self.assertEqual(retry_offsets([0.3, 0.3]), retry_offsets(None))
+
+    def test_fast_renderer_is_retried_quickly(self):
+        from utils import retry_offsets
+        offsets = retry_offsets([0.3, 0.32, 0.35, 0.4])
+        self.assertEqual(offsets[:2], (0.0, 0.3))
+        self.assertLessEqual(offsets[2], 0.5)
+
+    def test_slow_renderer_is_not_asked_before_it_can_answer(self):
+        from utils import retry_offsets
+        offsets = retry_offsets([4, 4.5, 5, 5.5, 6])
+        self.assertEqual(offsets[0], 0)
+        self.assertGreaterEqual(offsets[1], 4)
+        self.assertGreaterEqual(offsets[-1], 6)
+
+    def test_always_within_the_budget(self):
+        from utils import retry_offsets, CONTROL_RETRY_BUDGET, RETRY_MIN_GAP
+        for latencies in ([20, 30, 40], [0.1] * 10, [0.5, 1, 2, 3, 8]):
+            offsets = retry_offsets(latencies)
+            self.assertEqual(offsets[0], 0)
+            self.assertLess(offsets[-1], CONTROL_RETRY_BUDGET)
+            for a, b in zip(offsets, offsets[1:]):
+                self.assertGreaterEqual(round(b - a, 2), RETRY_MIN_GAP)
+
+
 class KnownDeviceCacheTest(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+
+from utils.deadline import deadline, remaining, clear_deadline
+from utils.coalesce import Coalescer
+
+
+class DeadlineTest(unittest.IsolatedAsyncioTestCase):
+
+    def test_no_deadline_outside(self):
+        self.assertIsNone(remaining())
+
+    def test_inner_deadline_cannot_extend_the_outer(self):
+        with deadline(1):
+            with deadline(30):
+                self.assertLessEqual(remaining(), 1)
+            with deadline(0.5):
+                self.assertLessEqual(remaining(), 0.5)
+            self.assertGreater(remaining(), 0.5)
+        self.assertIsNone(remaining())
+
+    async def test_flows_into_awaited_work_and_tasks(self):
+        async def left():
+            return remaining()
+
+        with deadline(5):
+            self.assertLessEqual(await left(), 5)
+            self.assertLessEqual(await asyncio.create_task(left()), 5)
+
+    async def test_background_work_can_drop_it(self):
+        async def detached():
+            clear_deadline()
+            return remaining()
+
+        with deadline(5):
+            self.assertIsNone(await asyncio.create_task(detached()))
+            # the request's own context is untouched
+            self.assertIsNotNone(remaining())
+
+    async def test_coalesced_sends_outlive_the_request(self):
+        seen = []
+
+        async def send(value):
+            seen.append(remaining())
+
+        c = Coalescer(send)
+        with deadline(0.01):
+            c.submit(1)
+        await c.wait()
+        self.assertEqual(seen, [None])
+
+
+if __name__ == "__main__":
+    unittest.main()
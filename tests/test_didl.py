@@ -0,0 +1,76 @@
+import unittest
+from xml.etree import ElementTree
+
+from dotmap import DotMap
+
+import plex  # noqa: F401 - dlna imports plex.adapters, which must load first
+from dlna.dlna_device import DlnaDeviceService
+from plex.didl import build_didl, track_didl, mime_type, didl_duration
+
+NS = {"d": "urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/",
+      "dc": "http://purl.org/dc/elements/1.1/",
+      "upnp": "urn:schemas-upnp-org:metadata-1-0/upnp/"}
+
+
+def track(**fields):
+    t = dict(playQueueItemID=101, title="Rock & Roll", grandparentTitle="Led Zeppelin",
+             parentTitle="IV", index=4, duration=220000,
+             Media=[dict(container="flac", audioCodec="flac", bitrate=900, audioChannels=2,
+                         Part=[dict(key="/library/parts/1/file.flac", size=24000000)])])
+    t.update(fields)
+    return DotMap(t)
+
+
+class DidlTest(unittest.TestCase):
+
+    def test_fields(self):
+        item = ElementTree.fromstring(build_didl(track(), "http://pms/file.flac?a=1&b=2", "http://pms/art")) \
+            .find("d:item", NS)
+        self.assertEqual(item.find("dc:title", NS).text, "Rock & Roll")
+        self.assertEqual(item.find("upnp:artist", NS).text, "Led Zeppelin")
+        self.assertEqual(item.find("upnp:album", NS).text, "IV")
+        self.assertEqual(item.find("upnp:albumArtURI", NS).text, "http://pms/art")
+        res = item.find("d:res", NS)
+        self.assertEqual(res.text, "http://pms/file.flac?a=1&b=2")
+        self.assertTrue(res.get("protocolInfo").startswith("http-get:*:audio/flac:"))
+        self.assertEqual(res.get("duration"), "0:03:40.000")
+        self.assertEqual(res.get("size"), "24000000")
+        self.assertEqual(res.get("bitrate"), "112500")
+
+    def test_missing_fields_are_left_out(self):
+        document = build_didl(track(parentTitle=None, index=None, Media=None, duration=None), "http://pms/x")
+        item = ElementTree.fromstring(document).find("d:item", NS)
+        self.assertIsNone(item.find("upnp:album", NS))
+        self.assertIsNone(item.find("upnp:originalTrackNumber", NS))
+        self.assertIsNone(item.find("d:res", NS).get("duration"))
+
+    def test_mime(self):
+        self.assertEqual(mime_type("mp3", "mp3"), "audio/mpeg")
+        self.assertEqual(mime_type("ogg", "opus"), "audio/ogg")
+        self.assertEqual(mime_type("mp4", "aac"), "audio/mp4")
+        self.assertIsNone(mime_type("mka", "mka"))
+        self.assertEqual(didl_duration(3723004), "1:02:03.004")
+
+    def test_kept_per_queue_item_and_url(self):
+        first = track_didl(track(), "http://pms/a")
+        self.assertIs(track_didl(track(title="changed"), "http://pms/a"), first)
+        self.assertNotEqual(track_didl(track(), "http://pms/b"), first)
+
+
+class PayloadTest(unittest.TestCase):
+
+    def test_values_are_escaped(self):
+        service = DlnaDeviceService({"serviceType": "urn:schemas-upnp-org:service:AVTransport:1",
+                                     "controlURL": "/c", "eventSubURL": "/e", "SCPDURL": "/s"},
+                                    DotMap(location_url="http://renderer/"))
+        didl = build_didl(track(), "http://pms/file.flac?a=1&b=2")
+        payload = service.payload_from_template("SetAVTransportURI", {
+            "InstanceID": 0, "CurrentURI": "http://pms/file.flac?a=1&b=2", "CurrentURIMetaData": didl})
+        action = ElementTree.fromstring(payload).find(".//{urn:schemas-upnp-org:service:AVTransport:1}"
+                                                      "SetAVTransportURI")
+        self.assertEqual(action.find("CurrentURI").text, "http://pms/file.flac?a=1&b=2")
+        self.assertEqual(action.find("CurrentURIMetaData").text, didl)
+
+
+if __name__ == "__main__":
+    unittest.main()
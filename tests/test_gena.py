@@ -0,0 +1,121 @@
+import unittest
+from unittest import mock
+
+import aiohttp
+from aiohttp import web
+
+import plex  # noqa: F401 - dlna imports plex.adapters, which must load first
+from dlna.dlna_device import DlnaDeviceService, event_subscriptions, parse_gena_timeout, note_early_event
+from utils import g
+from utils.profile import RendererProfile
+from settings import settings
+
+
+class FakeDevice(object):
+    uuid = "renderer-uuid"
+    name = "renderer"
+    location_url = None
+
+    def __init__(self):
+        self.profile = RendererProfile()
+
+
+class ParseTimeoutTest(unittest.TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(parse_gena_timeout("Second-1800", 120), 1800)
+
+    def test_missing_or_garbled_uses_what_was_asked(self):
+        self.assertEqual(parse_gena_timeout(None, 120), 120)
+        self.assertEqual(parse_gena_timeout("Second-soon", 120), 120)
+
+    def test_infinite_is_still_renewed(self):
+        self.assertGreater(parse_gena_timeout("Second-infinite", 120), 120)
+
+
+class SubscriptionLifecycleTest(unittest.IsolatedAsyncioTestCase):
+    """The renderer must end up with one subscription from us, not one per renewal."""
+
+    async def asyncSetUp(self):
+        self.requests = []
+        self.known_sids = set()
+        self.count = 0
+
+        async def handle(request: web.Request):
+            self.requests.append((request.method, dict(request.headers)))
+            sid = request.headers.get("SID")
+            if request.method == "UNSUBSCRIBE":
+                self.known_sids.discard(sid)
+                return web.Response()
+            if sid is not None:
+                if sid not in self.known_sids:
+                    return web.Response(status=412)
+                return web.Response(headers={"SID": sid, "TIMEOUT": "Second-300"})
+            self.count += 1
+            sid = f"uuid:sub-{self.count}"
+            self.known_sids.add(sid)
+            return web.Response(headers={"SID": sid, "TIMEOUT": "Second-300"})
+
+        app = web.Application()
+        app.router.add_route("*", "/event", handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.old_http, self.old_host_ip = g.http, settings.host_ip
+        g.http = aiohttp.ClientSession()
+        settings.host_ip = "127.0.0.1"
+        device = FakeDevice()
+        device.location_url = f"http://127.0.0.1:{port}/description.xml"
+        self.service = DlnaDeviceService({
+            "serviceType": "urn:schemas-upnp-org:service:RenderingControl:1",
+            "controlURL": "/control", "eventSubURL": "/event", "SCPDURL": "/scpd.xml"}, device)
+
+    async def asyncTearDown(self):
+        await g.http.close()
+        g.http, settings.host_ip = self.old_http, self.old_host_ip
+        await self.runner.cleanup()
+
+    async def test_renewal_keeps_the_sid(self):
+        self.assertEqual(await self.service.subscribe(timeout_sec=300), 150)
+        sid = self.service.sid
+        self.assertIs(event_subscriptions[sid], self.service)
+        await self.service.subscribe(timeout_sec=300)
+        method, headers = self.requests[-1]
+        self.assertEqual(headers["SID"], sid)
+        self.assertNotIn("NT", headers)
+        self.assertNotIn("Callback", headers)
+        self.assertEqual(self.known_sids, {sid})
+        self.assertTrue(self.service.evented)
+
+    async def test_forgotten_subscription_is_made_again(self):
+        await self.service.subscribe()
+        old_sid = self.service.sid
+        self.known_sids.clear()
+        self.assertIsNotNone(await self.service.subscribe())
+        self.assertNotEqual(self.service.sid, old_sid)
+        self.assertNotIn(old_sid, event_subscriptions)
+        self.assertIn(self.service.sid, self.known_sids)
+
+    async def test_initial_event_before_the_response_counts(self):
+        # the renderer's first NOTIFY, carrying the SID it is about to answer with
+        note_early_event("uuid:sub-1")
+        with mock.patch.object(self.service.device.profile, "record_event") as record_event:
+            await self.service.subscribe()
+            self.service._check_initial_event(self.service.sid)
+        self.assertEqual(self.service.sid, "uuid:sub-1")
+        record_event.assert_called_once_with(self.service.service_type, True)
+
+    async def test_unsubscribe(self):
+        await self.service.subscribe()
+        sid = self.service.sid
+        await self.service.unsubscribe()
+        self.assertEqual(self.requests[-1][0], "UNSUBSCRIBE")
+        self.assertEqual(self.known_sids, set())
+        self.assertNotIn(sid, event_subscriptions)
+        self.assertFalse(self.service.evented)
+
+
+if __name__ == "__main__":
+    unittest.main()
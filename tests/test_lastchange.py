@@ -0,0 +1,96 @@
+import unittest
+from xml.sax.saxutils import escape
+
+from utils.lastchange import parse_notify, parse_last_change, parse_state_variable_pairs, upnp_time_ms
+
+AVT_EVENT = (
+    '<Event xmlns="urn:schemas-upnp-org:metadata-1-0/AVT/"><InstanceID val="0">'
+    '<TransportState val="PLAYING"/>'
+    '<CurrentTrackURI val="http://pms/file.flac?a=1&amp;b=2"/>'
+    '<CurrentTrackDuration val="0:03:25.500"/>'
+    '</InstanceID></Event>'
+)
+
+RCS_EVENT = (
+    '<Event xmlns="urn:schemas-upnp-org:metadata-1-0/RCS/"><InstanceID val="0">'
+    '<Volume channel="LF" val="10"/><Volume channel="Master" val="33"/>'
+    '<Mute channel="Master" val="0"/>'
+    '</InstanceID></Event>'
+)
+
+
+def notify(inner, escaped=True):
+    return (
+        '<?xml version="1.0"?><e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">'
+        f'<e:property><LastChange>{escape(inner) if escaped else inner}</LastChange></e:property>'
+        '</e:propertyset>'
+    ).encode()
+
+
+class ParseNotifyTest(unittest.TestCase):
+
+    def test_avtransport_event(self):
+        variables = parse_notify(notify(AVT_EVENT))
+        self.assertEqual(variables, {
+            "TransportState": "PLAYING",
+            # escaped twice on the wire, once left after parsing
+            "CurrentTrackURI": "http://pms/file.flac?a=1&b=2",
+            "CurrentTrackDuration": "0:03:25.500",
+        })
+
+    def test_rendering_control_reads_the_master_channel(self):
+        self.assertEqual(parse_notify(notify(RCS_EVENT)), {"Volume": "33", "Mute": "0"})
+
+    def test_unescaped_event_markup(self):
+        self.assertEqual(parse_notify(notify(RCS_EVENT, escaped=False)), {"Volume": "33", "Mute": "0"})
+
+    def test_other_instances_are_ignored(self):
+        event = ('<Event><InstanceID val="1"><TransportState val="STOPPED"/></InstanceID>'
+                 '<InstanceID val="0"><TransportState val="PAUSED_PLAYBACK"/></InstanceID></Event>')
+        self.assertEqual(parse_last_change(event), {"TransportState": "PAUSED_PLAYBACK"})
+
+    def test_plain_evented_variables(self):
+        body = (b'<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">'
+                b'<e:property><SinkProtocolInfo>http-get:*:audio/flac:*</SinkProtocolInfo></e:property>'
+                b'</e:propertyset>')
+        self.assertEqual(parse_notify(body), {"SinkProtocolInfo": "http-get:*:audio/flac:*"})
+
+    def test_garbage_is_nothing(self):
+        self.assertEqual(parse_notify(b"<e:propertyset"), {})
+        self.assertEqual(parse_notify(notify("<Event><InstanceID", escaped=True)), {})
+
+
+class StateVariablePairsTest(unittest.TestCase):
+
+    def test_pairs(self):
+        text = ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<stateVariableValuePairs xmlns="urn:schemas-upnp-org:av:avs">'
+                '<stateVariable variableName="TransportState">PLAYING</stateVariable>'
+                '<stateVariable variableName="RelativeTimePosition">0:01:02</stateVariable>'
+                '<stateVariable variableName="CurrentTrackURI"></stateVariable>'
+                '<stateVariable variableName="Volume" channel="LF">3</stateVariable>'
+                '<stateVariable variableName="Volume" channel="Master">40</stateVariable>'
+                '</stateVariableValuePairs>')
+        self.assertEqual(parse_state_variable_pairs(text), {
+            "TransportState": "PLAYING", "RelativeTimePosition": "0:01:02", "CurrentTrackURI": "", "Volume": "40"})
+
+    def test_nothing(self):
+        self.assertEqual(parse_state_variable_pairs(None), {})
+        self.assertEqual(parse_state_variable_pairs("<stateVariableValuePairs"), {})
+
+
+class UpnpTimeTest(unittest.TestCase):
+
+    def test_values(self):
+        self.assertEqual(upnp_time_ms("0:03:25"), 205000)
+        self.assertEqual(upnp_time_ms("00:03:25.500"), 205500)
+        self.assertEqual(upnp_time_ms("12:00:00"), 43200000)
+
+    def test_not_a_time(self):
+        self.assertIsNone(upnp_time_ms("NOT_IMPLEMENTED"))
+        self.assertIsNone(upnp_time_ms(""))
+        self.assertIsNone(upnp_time_ms(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import aiohttp
+from aiohttp import web
+from dotmap import DotMap
+
+from plex import pin_login
+from settings import settings
+from utils import g
+
+
+def device(uuid):
+    return DotMap(uuid=uuid, name=f"amp {uuid}", model="amp")
+
+
+class PinCacheTest(unittest.IsolatedAsyncioTestCase):
+    """Against a local stand-in for plex.tv."""
+
+    async def asyncSetUp(self):
+        self.created = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.tokens = {}
+
+        async def create_pin(request: web.Request):
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+            await asyncio.sleep(0.02)
+            self.in_flight -= 1
+            uuid = request.headers["X-Plex-Client-Identifier"]
+            self.created.append(uuid)
+            return web.Response(text=f'<pin id="id-{uuid}-{len(self.created)}" code="C{uuid}" '
+                                     f'expiresIn="900" authToken=""/>')
+
+        async def check(request: web.Request):
+            uuid = request.headers["X-Plex-Client-Identifier"]
+            token = self.tokens.get(request.match_info["pin_id"], "")
+            return web.Response(text=f'<pin id="{request.match_info["pin_id"]}" code="C{uuid}" '
+                                     f'authToken="{token}"/>')
+
+        app = web.Application()
+        app.router.add_post("/api/v2/pins", create_pin)
+        app.router.add_get("/api/v2/pins/{pin_id}", check)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.old = g.http, settings.plex_tv_url
+        g.http = aiohttp.ClientSession()
+        settings.plex_tv_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        self.cache = pin_login.PinCache()
+
+    async def asyncTearDown(self):
+        await self.cache.close()
+        await g.http.close()
+        g.http, settings.plex_tv_url = self.old
+        await self.runner.cleanup()
+
+    async def test_pins_are_reused_until_they_expire(self):
+        d = device("a")
+        first = (await self.cache.pins_for([d]))["a"]
+        again = (await self.cache.pins_for([d]))["a"]
+        self.assertEqual(first.code, "Ca")
+        self.assertIs(first, again)
+        self.assertEqual(self.created, ["a"])
+
+        first.expires_at = 0
+        renewed = (await self.cache.pins_for([d]))["a"]
+        self.assertIsNot(renewed, first)
+        self.assertEqual(self.created, ["a", "a"])
+
+    async def test_pins_are_created_concurrently_with_a_bound(self):
+        ds = [device(str(i)) for i in range(10)]
+        pins = await self.cache.pins_for(ds)
+        self.assertEqual(sorted(self.created), sorted(d.uuid for d in ds))
+        self.assertTrue(all(pins[d.uuid].code == f"C{d.uuid}" for d in ds))
+        self.assertGreater(self.most_in_flight, 1)
+        self.assertLessEqual(self.most_in_flight, pin_login.PIN_CONCURRENCY)
+
+    async def test_unreachable_plex_tv_gives_no_pin_and_is_left_alone(self):
+        reachable, settings.plex_tv_url = settings.plex_tv_url, "http://127.0.0.1:1"
+        self.assertEqual(await self.cache.pins_for([device("a")]), {"a": None})
+        settings.plex_tv_url = reachable
+        # a bind page left open does not ask again every time it looks
+        self.assertEqual(await self.cache.pins_for([device("a")]), {"a": None})
+        self.assertEqual(self.created, [])
+        self.cache.retry_at = 0
+        self.assertEqual((await self.cache.pins_for([device("a")]))["a"].code, "Ca")
+
+    async def test_linked_pin_is_picked_up_in_the_background(self):
+        d = device("a")
+        adapter = DotMap(plex_bind_token=None)
+        stored = {}
+        with mock.patch.object(pin_login, "PIN_CHECK_SECS", 0.01), \
+                mock.patch.object(pin_login, "devices", [d]), \
+                mock.patch.object(pin_login, "adapter_by_device", lambda _: adapter), \
+                mock.patch.object(type(settings), "set_token_for_uuid",
+                                  lambda self, uuid, token: stored.update({uuid: token})):
+            pin = (await self.cache.pins_for([d]))["a"]
+            self.tokens[pin.id] = "linked-token"
+            for _ in range(200):
+                if stored:
+                    break
+                await asyncio.sleep(0.01)
+        self.assertEqual(stored, {"a": "linked-token"})
+        self.assertEqual(adapter.plex_bind_token, "linked-token")
+        self.assertNotIn("a", self.cache.pins)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import asyncio
+import unittest
+
+import aiohttp
+from aiohttp import web
+from dotmap import DotMap
+
+from plex.plex_tv import PlexTvPublisher
+from settings import settings
+from utils import g
+
+
+def adapter(uuid, name):
+    return DotMap(dlna=DotMap(uuid=uuid, name=name, model="amp"), plex_bind_token="token")
+
+
+class PublisherTest(unittest.IsolatedAsyncioTestCase):
+    """Against a local stand-in for plex.tv."""
+
+    async def asyncSetUp(self):
+        self.puts = []
+        self.in_flight = 0
+        self.overlapped = False
+        self.responses = []
+
+        async def put_device(request: web.Request):
+            self.in_flight += 1
+            self.overlapped |= self.in_flight > 1
+            await asyncio.sleep(0.02)
+            self.in_flight -= 1
+            form = await request.post()
+            self.puts.append((request.match_info["uuid"], form["Connection[][uri]"],
+                              request.headers["X-Plex-Device-Name"], request.query["X-Plex-Token"]))
+            if self.responses:
+                return self.responses.pop(0)
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_put("/devices/{uuid}", put_device)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.old = g.http, settings.host_ip, settings.plex_tv_url
+        g.http = aiohttp.ClientSession()
+        settings.host_ip = "10.0.0.2"
+        settings.plex_tv_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        self.publisher = PlexTvPublisher()
+
+    async def asyncTearDown(self):
+        await self.publisher.close()
+        await g.http.close()
+        g.http, settings.host_ip, settings.plex_tv_url = self.old
+        await self.runner.cleanup()
+
+    async def settle(self, puts):
+        for _ in range(200):
+            if len(self.puts) >= puts:
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+
+    async def test_sent_on_change_only(self):
+        amp = adapter("amp-uuid", "Amp")
+        for _ in range(3):
+            self.publisher.publish(amp)
+        await self.settle(1)
+        self.assertEqual(self.puts, [("amp-uuid", f"http://10.0.0.2:{settings.http_port}", "Amp", "token")])
+        amp.dlna.name = "Living Room"
+        self.publisher.publish(amp)
+        await self.settle(2)
+        self.assertEqual([p[2] for p in self.puts], ["Amp", "Living Room"])
+
+    async def test_puts_are_serialized(self):
+        for i in range(4):
+            self.publisher.publish(adapter(f"amp-{i}", f"Amp {i}"))
+        await self.settle(4)
+        self.assertEqual(len(self.puts), 4)
+        self.assertFalse(self.overlapped)
+
+    async def test_retry_after_is_honoured(self):
+        self.responses = [web.Response(status=429, headers={"Retry-After": "0.2"})]
+        self.publisher.publish(adapter("amp-uuid", "Amp"))
+        await self.settle(1)
+        self.assertEqual(len(self.puts), 1)
+        self.assertGreater(self.publisher.retry_at, 0)
+        await self.settle(2)
+        self.assertEqual(len(self.puts), 2)
+        self.assertEqual(self.publisher.failures, 0)
+
+    async def test_nothing_without_an_address(self):
+        settings.host_ip = None
+        self.publisher.publish(adapter("amp-uuid", "Amp"))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.puts, [])
+
+    async def test_refreshed_after_the_interval(self):
+        self.publisher.publish(adapter("amp-uuid", "Amp"))
+        await self.settle(1)
+        refresh_at = self.publisher.publications["amp-uuid"].refresh_at
+        self.assertEqual(len(self.publisher.due(refresh_at + 1)), 1)
+        self.assertEqual(self.publisher.due(refresh_at - 1), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
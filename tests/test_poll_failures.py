@@ -0,0 +1,45 @@
+import unittest
+
+import aiohttp
+
+import plex  # noqa: F401 - dlna imports plex.adapters, which must load first
+from dlna.dlna_device import DlnaDevice, DlnaDeviceService
+from utils import UPNP_AVT_SERVICE_TYPE
+
+
+class PollFailureTest(unittest.IsolatedAsyncioTestCase):
+    """A renderer that is off fails every poll of a tick at once."""
+
+    async def asyncSetUp(self):
+        self.device = DlnaDevice("http://127.0.0.1:9/description.xml")
+        self.device.name = "amp"
+        self.device.uuid = "uuid-amp"
+        self.service = DlnaDeviceService({"serviceType": UPNP_AVT_SERVICE_TYPE, "controlURL": "/control",
+                                          "eventSubURL": "/event", "SCPDURL": "/scpd.xml"}, self.device)
+        self.client = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def poll(self):
+        return await self.service._post_with_retries("GetTransportInfo", "", {}, self.client, background=True)
+
+    async def test_counted_once_per_tick(self):
+        for _ in range(4):
+            self.assertIsNone(await self.poll())
+        self.assertEqual(self.device.repeat_error_count, 1)
+        self.assertEqual(self.device.breaker.failures, 1)
+
+        self.device.poll_tick += 1
+        await self.poll()
+        self.assertEqual(self.device.repeat_error_count, 2)
+        self.assertEqual(self.device.breaker.failures, 2)
+
+    async def test_commands_still_count_each_time(self):
+        await self.poll()
+        await self.service._post_with_retries("Play", "", {}, self.client)
+        self.assertEqual(self.device.repeat_error_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from aiohttp import web
+from dotmap import DotMap
+
+from plex.adapters import PlexDlnaAdapter
+from plex.prefetch import Prefetcher, upcoming_offsets
+from plex.relay import relay
+from plex.track_cache import TrackCache
+from settings import settings
+
+BODY = b"x" * 100000
+
+
+class UpcomingOffsetsTest(unittest.TestCase):
+
+    def test_in_order(self):
+        self.assertEqual(upcoming_offsets(3, 10, 0, 2), [4, 5])
+        self.assertEqual(upcoming_offsets(9, 10, 0, 2), [])
+
+    def test_repeat_one_plays_the_same_track(self):
+        self.assertEqual(upcoming_offsets(3, 10, 1, 2), [])
+
+    def test_repeat_all_wraps(self):
+        self.assertEqual(upcoming_offsets(8, 10, 2, 3), [9, 0, 1])
+        self.assertEqual(upcoming_offsets(0, 2, 2, 3), [1])
+
+    def test_shuffle_follows_the_plan(self):
+        self.assertEqual(upcoming_offsets(3, 10, 0, 2, [7, 3, 1]), [7])
+
+
+class ShufflePlanTest(unittest.IsolatedAsyncioTestCase):
+    """Offsets drawn for prefetching, then the controller removes tracks."""
+
+    def adapter(self, total):
+        adapter = PlexDlnaAdapter.__new__(PlexDlnaAdapter)
+        adapter.shuffle = 1
+        adapter.shuffle_plan = [8, 2]
+        adapter.queue = mock.AsyncMock()
+        adapter.queue.allow_shuffle.return_value = True
+        adapter.queue.total_count.return_value = total
+        adapter.queue.selected_offset.return_value = 0
+        adapter.state = mock.Mock()
+        adapter.play_selected_queue_item = mock.AsyncMock()
+        adapter.stop = mock.AsyncMock()
+        adapter.prefetch = mock.Mock()
+        adapter.wake_waiters = mock.Mock()
+        return adapter
+
+    async def test_offsets_past_a_shrunk_queue_are_skipped(self):
+        adapter = self.adapter(total=5)
+        await adapter.next()
+        adapter.stop.assert_not_called()
+        adapter.queue.set_selected_offset.assert_awaited_once_with(2)
+        self.assertEqual(adapter.shuffle_plan, [])
+
+    async def test_refresh_draws_a_new_plan(self):
+        adapter = self.adapter(total=5)
+        await adapter.refresh_queue(1)
+        self.assertEqual(adapter.shuffle_plan, [])
+        adapter.prefetch.assert_called_once_with()
+
+
+class PrefetcherTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = TrackCache(self.tmp.name, max_bytes=10 * len(BODY))
+        self.patch = mock.patch("plex.prefetch.track_cache", self.cache)
+        self.patch.start()
+        self.ranges = []
+
+        async def handler(request: web.Request):
+            self.ranges.append(request.headers.get("Range"))
+            return web.Response(body=BODY)
+
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        self.prefetcher = Prefetcher("amp")
+
+    async def asyncTearDown(self):
+        self.prefetcher.cancel()
+        await relay.close()
+        await self.runner.cleanup()
+        self.patch.stop()
+        self.tmp.cleanup()
+
+    async def test_tracks_land_in_the_cache(self):
+        parts = [DotMap(key=f"/library/parts/{i}/1/file.flac", size=len(BODY)) for i in range(2)]
+        with mock.patch.object(settings, "prefetch_kbps", 0):
+            self.prefetcher.start([(self.base + p.key, p) for p in parts])
+            await self.prefetcher.task
+        for p in parts:
+            self.assertIsNotNone(await self.cache.lookup(p))
+
+    async def test_transcodes_are_only_started(self):
+        self.prefetcher.start([(self.base + "/music/:/transcode/universal/start.mp3", None)])
+        await self.prefetcher.task
+        self.assertEqual(self.ranges, ["bytes=0-0"])
+
+    async def test_bandwidth_is_limited(self):
+        p = DotMap(key="/library/parts/1/1/file.flac", size=len(BODY))
+        slept = []
+
+        async def sleep(secs):
+            slept.append(secs)
+
+        # 100 kB at 400 kbit/s takes two seconds
+        with mock.patch.object(settings, "prefetch_kbps", 400), mock.patch("plex.prefetch.asyncio.sleep", sleep):
+            self.prefetcher.start([(self.base + p.key, p)])
+            await self.prefetcher.task
+        self.assertAlmostEqual(max(slept), 2, delta=0.5)
+        self.assertIsNotNone(await self.cache.lookup(p))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from settings import settings
+from utils.profile import (RendererProfile, UNSUPPORTED_TTL_SECS, EVENT_MISSES_UNTRUSTED,
+                           CONCURRENT_FAILURES_TO_LOWER, UNSUPPORTED_REFUSALS_TO_MARK, service_name)
+
+AVT = "urn:schemas-upnp-org:service:AVTransport:2"
+
+
+class RendererProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = []
+        self.profile = RendererProfile(save=self.saved.append)
+
+    def test_unsupported_action_is_remembered_for_a_while(self):
+        self.profile.mark_unsupported("Seek")
+        self.assertTrue(self.profile.is_unsupported("Seek"))
+        self.assertFalse(self.profile.is_unsupported("Play"))
+        later = time.time() + UNSUPPORTED_TTL_SECS + 1
+        with mock.patch("utils.profile.time.time", return_value=later):
+            self.assertFalse(self.profile.is_unsupported("Seek"))
+
+    def test_unsupported_only_after_the_same_refusal_in_a_row(self):
+        for _ in range(UNSUPPORTED_REFUSALS_TO_MARK - 1):
+            self.assertFalse(self.profile.record_refusal("Seek", "401"))
+        self.profile.record_accepted("Seek")
+        for _ in range(UNSUPPORTED_REFUSALS_TO_MARK - 1):
+            self.assertFalse(self.profile.record_refusal("Seek", "401"))
+        self.assertFalse(self.profile.record_refusal("Seek", "710"))
+        self.assertFalse(self.profile.is_unsupported("Seek"))
+        self.assertEqual(self.saved, [])
+        for _ in range(UNSUPPORTED_REFUSALS_TO_MARK - 1):
+            self.profile.record_refusal("Seek", "710")
+        self.assertTrue(self.profile.is_unsupported("Seek"))
+        self.assertNotIn("refusals", self.saved[-1])
+
+    def test_events_stop_being_trusted_after_misses(self):
+        for _ in range(EVENT_MISSES_UNTRUSTED):
+            self.assertTrue(self.profile.events_trusted(AVT))
+            self.profile.record_event(AVT, False)
+        self.assertFalse(self.profile.events_trusted(AVT))
+        self.assertTrue(self.profile.events_trusted("urn:schemas-upnp-org:service:RenderingControl:1"))
+        # any version of the service
+        self.assertFalse(self.profile.events_trusted("urn:schemas-upnp-org:service:AVTransport:1"))
+        self.profile.record_event(AVT, True)
+        self.assertTrue(self.profile.events_trusted(AVT))
+
+    def test_events_arriving_as_usual_are_not_written(self):
+        self.profile.record_event(AVT, True)
+        self.assertEqual(self.saved, [])
+
+    def test_concurrency_is_lowered_only_after_repeated_failures(self):
+        for _ in range(CONCURRENT_FAILURES_TO_LOWER - 1):
+            self.assertIsNone(self.profile.record_concurrent_failure(2))
+        self.assertEqual(self.profile.record_concurrent_failure(2), 1)
+        self.assertIsNone(self.profile.record_concurrent_failure(1))
+
+    def test_round_trip(self):
+        self.profile.mark_unsupported("GetStateVariables")
+        self.profile.record_wake(2.5)
+        again = RendererProfile(self.saved[-1])
+        self.assertTrue(again.is_unsupported("GetStateVariables"))
+        self.assertEqual(again.wake_latencies, [2.5])
+
+    def test_service_name(self):
+        self.assertEqual(service_name(AVT), "AVTransport")
+
+
+class StoredProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self._old = settings.config_path
+        settings.config_path = self.tmp.name
+
+    def tearDown(self):
+        settings.config_path = self._old
+        self.tmp.cleanup()
+
+    def test_kept_next_to_the_known_device(self):
+        settings.remember_device("u1", "Amp", "http://a/desc.xml")
+        settings.save_device_profile("u1", {"max_concurrency": 1})
+        self.assertEqual(settings.device_profile("u1"), {"max_concurrency": 1})
+        self.assertEqual(settings.known_device_urls(), ["http://a/desc.xml"])
+
+    def test_unknown_device_has_an_empty_profile(self):
+        self.assertEqual(settings.device_profile("nobody"), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
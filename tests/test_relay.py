@@ -0,0 +1,112 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+
+from plex.relay import Relay, RELAY_CHUNK_BYTES, RELAY_READ_AHEAD_CHUNKS
+from settings import settings
+
+BODY = bytes(range(256)) * 1024
+
+
+class RelayTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.requests = []
+
+        async def part(request: web.Request):
+            self.requests.append((request.method, request.headers.get("Range")))
+            headers = {"Content-Type": "audio/flac", "Accept-Ranges": "bytes"}
+            body, status = BODY, 200
+            if request.headers.get("Range"):
+                start = int(request.headers["Range"].split("=")[1].split("-")[0])
+                body, status = BODY[start:], 206
+                headers["Content-Range"] = f"bytes {start}-{len(BODY) - 1}/{len(BODY)}"
+            if request.method == "HEAD":
+                headers["Content-Length"] = str(len(body))
+                return web.Response(status=status, headers=headers)
+            return web.Response(body=body, status=status, headers=headers)
+
+        async def long_part(request: web.Request):
+            response = web.StreamResponse(headers={"Content-Type": "audio/flac"})
+            await response.prepare(request)
+            for _ in range(RELAY_READ_AHEAD_CHUNKS * 4):
+                await response.write(b"\0" * RELAY_CHUNK_BYTES)
+            await response.write_eof()
+            return response
+
+        app = web.Application()
+        app.router.add_route("*", "/library/parts/1/file.flac", part)
+        app.router.add_get("/library/parts/2/file.flac", long_part)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/library/parts/1/file.flac?X-Plex-Token=secret"
+        self.long_url = f"http://127.0.0.1:{port}/library/parts/2/file.flac"
+        self.old_host_ip = settings.host_ip
+        settings.host_ip = "10.0.0.2"
+        self.relay = Relay()
+
+    async def asyncTearDown(self):
+        settings.host_ip = self.old_host_ip
+        await self.relay.close()
+        await self.runner.cleanup()
+
+    async def body(self, response):
+        chunks = [chunk async for chunk in response.body_iterator]
+        await response.background()
+        return chunks
+
+    async def test_register_hides_the_server_url(self):
+        url = self.relay.register(self.url)
+        self.assertTrue(url.startswith(f"http://10.0.0.2:{settings.http_port}/relay/"))
+        self.assertNotIn("secret", url)
+        self.assertEqual(self.relay.register(self.url), url)
+        self.assertEqual(self.relay.entry(url.rsplit("/", 1)[1]).url, self.url)
+
+    async def test_without_a_known_address_the_server_url_is_used(self):
+        settings.host_ip = None
+        self.assertEqual(self.relay.register(self.url), self.url)
+
+    async def test_streams_the_whole_body(self):
+        entry = self.relay.entry(self.relay.register(self.url).rsplit("/", 1)[1])
+        response = await self.relay.respond(entry, "GET")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "audio/flac")
+        chunks = await self.body(response)
+        self.assertEqual(b"".join(chunks), BODY)
+        self.assertLessEqual(max(len(c) for c in chunks), RELAY_CHUNK_BYTES)
+
+    async def test_ranges_are_passed_through(self):
+        entry = self.relay.entry(self.relay.register(self.url).rsplit("/", 1)[1])
+        response = await self.relay.respond(entry, "GET", "bytes=1000-")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers["content-range"], f"bytes 1000-{len(BODY) - 1}/{len(BODY)}")
+        self.assertEqual(b"".join(await self.body(response)), BODY[1000:])
+        self.assertEqual(self.requests[-1], ("GET", "bytes=1000-"))
+
+    async def test_renderer_going_away_mid_stream_stops_the_producer(self):
+        entry = self.relay.entry(self.relay.register(self.long_url).rsplit("/", 1)[1])
+        response = await self.relay.respond(entry, "GET")
+        stream = response.body_iterator
+        await stream.__aiter__().__anext__()
+        for _ in range(200):
+            if stream.queue.full():
+                break
+            await asyncio.sleep(0.01)
+        self.assertTrue(stream.queue.full())
+        # what StreamingResponse runs once the renderer disconnects
+        await asyncio.wait_for(response.background(), 1)
+        self.assertTrue(stream.producer.done())
+
+    async def test_head(self):
+        entry = self.relay.entry(self.relay.register(self.url).rsplit("/", 1)[1])
+        response = await self.relay.respond(entry, "HEAD")
+        self.assertEqual(response.headers["content-length"], str(len(BODY)))
+        self.assertEqual(response.body, b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import socket
+import unittest
+from unittest import mock
+
+from utils.resolver import PlexDirectResolver, plex_direct_address, DNS_CACHE_SECS
+
+
+class CountingResolver(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        self.calls += 1
+        if self.fail:
+            raise socket.gaierror("resolver is down")
+        return [dict(hostname=host, host="192.0.2.7", port=port, family=socket.AF_INET, proto=0, flags=0)]
+
+    async def close(self):
+        pass
+
+
+class PlexDirectAddressTest(unittest.TestCase):
+
+    def test_ipv4(self):
+        self.assertEqual(str(plex_direct_address("10-0-0-14.0123abcd.plex.direct")), "10.0.0.14")
+
+    def test_ipv6(self):
+        address = plex_direct_address("2001-db8--14.0123abcd.plex.direct")
+        self.assertEqual(address.version, 6)
+        self.assertEqual(str(address), "2001:db8::14")
+
+    def test_other_names(self):
+        self.assertIsNone(plex_direct_address("plex.tv"))
+        self.assertIsNone(plex_direct_address("nonsense.0123abcd.plex.direct"))
+        self.assertIsNone(plex_direct_address(None))
+
+
+class PlexDirectResolverTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.upstream = CountingResolver()
+        self.resolver = PlexDirectResolver(self.upstream)
+
+    async def test_plex_direct_is_answered_from_the_name(self):
+        host = "10-0-0-14.0123abcd.plex.direct"
+        results = await self.resolver.resolve(host, 32400, socket.AF_UNSPEC)
+        self.assertEqual(self.upstream.calls, 0)
+        self.assertEqual(results[0]["host"], "10.0.0.14")
+        self.assertEqual(results[0]["port"], 32400)
+        # kept for SNI and certificate checks
+        self.assertEqual(results[0]["hostname"], host)
+
+    async def test_other_names_are_cached(self):
+        await self.resolver.resolve("plex.tv", 443)
+        await self.resolver.resolve("plex.tv", 443)
+        self.assertEqual(self.upstream.calls, 1)
+
+    async def test_stale_answer_when_the_resolver_fails(self):
+        await self.resolver.resolve("plex.tv", 443)
+        self.upstream.fail = True
+        with mock.patch("utils.resolver.monotonic", return_value=10 ** 9):
+            with self.assertRaises(OSError):
+                await self.resolver.resolve("plex.tv", 443)
+        self.resolver._cache[("plex.tv", 443, socket.AF_INET)] = (0, ["old answer"])
+        with mock.patch("utils.resolver.monotonic", return_value=DNS_CACHE_SECS):
+            self.assertEqual(await self.resolver.resolve("plex.tv", 443), ["old answer"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import aiohttp
+from aiohttp import web
+from starlette.datastructures import QueryParams
+
+from plex.adapters import PlexLib
+from plex.play_queue import PlayQueue
+from plex.routes import PmsRoutes, Route, ChosenRoute, lan_routes
+from utils import g
+from settings import settings
+
+
+class LanRoutesTest(unittest.TestCase):
+
+    def test_plex_direct_keeps_its_certificate(self):
+        with mock.patch.object(settings, "plex_lan_address", "10.0.0.14"):
+            routes = lan_routes(Route("https", "1-2-3-4.0123abcd.plex.direct", 32400))
+        self.assertEqual(routes, [Route("https", "10-0-0-14.0123abcd.plex.direct", 32400)])
+
+    def test_plain_http_only_when_already_used(self):
+        with mock.patch.object(settings, "plex_lan_address", "10.0.0.14"):
+            self.assertIn(Route("http", "10.0.0.14", 32400), lan_routes(Route("http", "example.org", 32400)))
+        with mock.patch.object(settings, "plex_lan_address", None):
+            self.assertEqual(lan_routes(Route("http", "example.org", 32400)), [])
+
+
+class RaceTest(unittest.IsolatedAsyncioTestCase):
+
+    async def serve(self, machine_id, delay=0):
+        async def identity(request):
+            await asyncio.sleep(delay)
+            return web.json_response({"MediaContainer": {"machineIdentifier": machine_id}})
+
+        async def play_queue(request):
+            return web.json_response({"MediaContainer": {"playQueueID": 1, "Metadata": []}})
+
+        app = web.Application()
+        app.router.add_get("/identity", identity)
+        app.router.add_get("/playQueues/1", play_queue)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        self.runners.append(runner)
+        return Route("http", "127.0.0.1", site._server.sockets[0].getsockname()[1])
+
+    async def asyncSetUp(self):
+        self.runners = []
+        self.old_http = g.http
+        g.http = aiohttp.ClientSession()
+        self.remote = await self.serve("pms", delay=0.3)
+        self.lan = await self.serve("pms")
+        self.impostor = await self.serve("other")
+        self.saved = {}
+        # the data store is left alone
+        self.patches = [mock.patch.object(type(settings), "pms_routes", lambda _, m: []),
+                        mock.patch.object(type(settings), "save_pms_routes",
+                                          lambda _, m, routes: self.saved.__setitem__(m, routes))]
+        for p in self.patches:
+            p.start()
+
+    async def asyncTearDown(self):
+        for p in self.patches:
+            p.stop()
+        await g.http.close()
+        g.http = self.old_http
+        for runner in self.runners:
+            await runner.cleanup()
+
+    async def test_quickest_right_server_wins(self):
+        routes = PmsRoutes()
+        chosen = await routes.race("pms", [self.impostor, self.remote, self.lan])
+        self.assertEqual(chosen.route, self.lan)
+        self.assertIsNone(await routes.race("pms", [self.impostor]))
+
+    async def test_plex_lib_moves_over_once_the_race_is_done(self):
+        routes = PmsRoutes()
+        lib = PlexLib()
+        with mock.patch("plex.adapters.pms_routes", routes), \
+                mock.patch.object(routes, "candidates", lambda m, offered: [offered, self.lan]):
+            lib.update(QueryParams(protocol="http", address="127.0.0.1", port=str(self.remote.port),
+                                   machineIdentifier="pms", token="t"))
+            # the controller's connection until the race is over
+            self.assertEqual(lib.port, self.remote.port)
+            await asyncio.gather(*routes._races.values())
+            self.assertEqual(lib.port, self.lan.port)
+            self.assertEqual(self.saved["pms"][0], list(self.lan))
+            # and straight away for the next command
+            lib.update(QueryParams(port=str(self.remote.port)))
+            self.assertEqual(lib.port, self.lan.port)
+
+
+    async def test_back_to_the_controllers_connection_when_the_chosen_one_fails(self):
+        routes = PmsRoutes()
+        lib = PlexLib()
+        # a chosen route nothing answers on any more
+        dead = Route("http", "127.0.0.1", 9)
+        routes.routes["pms"] = ChosenRoute(dead, 0.001)
+        with mock.patch("plex.adapters.pms_routes", routes), \
+                mock.patch("plex.play_queue.pms_routes", routes), \
+                mock.patch.object(routes, "candidates", lambda m, offered: [offered]):
+            lib.update(QueryParams(protocol="http", address="127.0.0.1", port=str(self.remote.port),
+                                   machineIdentifier="pms", token="t"))
+            self.assertEqual(lib.port, dead.port)
+            info = await PlayQueue("/playQueues/1", lib).fetch(lambda: lib.build_url("/playQueues/1"))
+            self.assertEqual(info.playQueueID, 1)
+            self.assertEqual(lib.port, self.remote.port)
+            # raced again, from the controller's connection
+            await asyncio.gather(*routes._races.values())
+            self.assertEqual(routes.routes["pms"].route.port, self.remote.port)
+        self.assertFalse(routes.failed(lib))
+
+
+if __name__ == "__main__":
+    unittest.main()
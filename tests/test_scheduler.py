@@ -0,0 +1,118 @@
+import asyncio
+import threading
+import unittest
+
+from utils.scheduler import SoapScheduler, Preempted
+
+
+class SoapSchedulerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_limit_is_respected(self):
+        scheduler = SoapScheduler(limit=2)
+        running = []
+        peak = []
+
+        async def request():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+        await asyncio.gather(*[scheduler.run(request, background=True) for _ in range(6)])
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(scheduler.active, 0)
+
+    async def test_user_command_goes_ahead_of_waiting_polls(self):
+        scheduler = SoapScheduler(limit=1)
+        order = []
+        gate = asyncio.Event()
+
+        async def blocker():
+            await gate.wait()
+
+        def request(name):
+            async def go():
+                order.append(name)
+            return go
+
+        first = asyncio.create_task(scheduler.run(blocker))
+        await asyncio.sleep(0)
+        polls = [asyncio.create_task(scheduler.run(request(f"poll{i}"), background=True)) for i in range(3)]
+        await asyncio.sleep(0)
+        pause = asyncio.create_task(scheduler.run(request("Pause")))
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(first, pause, *polls)
+        self.assertEqual(order[0], "Pause")
+
+    async def test_user_command_cancels_polls_in_flight(self):
+        scheduler = SoapScheduler(limit=1)
+        started = asyncio.Event()
+
+        async def slow_poll():
+            started.set()
+            await asyncio.sleep(10)
+
+        async def pause():
+            return "paused"
+
+        poll = asyncio.create_task(scheduler.run(slow_poll, background=True))
+        await started.wait()
+        self.assertEqual(await asyncio.wait_for(scheduler.run(pause), 1), "paused")
+        with self.assertRaises(Preempted):
+            await poll
+        self.assertEqual(scheduler.active, 0)
+
+    async def test_cancelled_waiter_gives_up_its_place(self):
+        scheduler = SoapScheduler(limit=1)
+        gate = asyncio.Event()
+
+        async def blocker():
+            await gate.wait()
+
+        async def noop():
+            return None
+
+        first = asyncio.create_task(scheduler.run(blocker))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(scheduler.run(noop))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        gate.set()
+        await first
+        self.assertEqual(scheduler.waiting, 0)
+        self.assertEqual(scheduler.active, 0)
+
+    async def test_polls_on_another_loop_are_preempted(self):
+        # polls come from the device's state thread, commands from the main loop
+        scheduler = SoapScheduler(limit=1)
+        started = threading.Event()
+        outcome = []
+
+        async def slow_poll():
+            started.set()
+            await asyncio.sleep(10)
+
+        def state_thread():
+            async def poll():
+                try:
+                    await scheduler.run(slow_poll, background=True)
+                except Preempted:
+                    outcome.append("preempted")
+            asyncio.run(poll())
+
+        thread = threading.Thread(target=state_thread)
+        thread.start()
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+
+        async def pause():
+            return "paused"
+
+        self.assertEqual(await asyncio.wait_for(scheduler.run(pause), 2), "paused")
+        await asyncio.get_running_loop().run_in_executor(None, thread.join)
+        self.assertEqual(outcome, ["preempted"])
+
+
+if __name__ == "__main__":
+    unittest.main()
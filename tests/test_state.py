@@ -0,0 +1,155 @@
+import asyncio
+import unittest
+from threading import Lock, current_thread
+
+from dotmap import DotMap
+
+from plex.adapters import StateSnapshot, DlnaState, ChangeSet, interest_mask
+from utils import UPNP_AVT_SERVICE_TYPE
+
+
+class BareState(DlnaState):
+    # DlnaState starts its polling thread on construction and joins it on the
+    # way out; these tests only need the snapshot bookkeeping.
+
+    def __del__(self):
+        pass
+
+
+def bare_state():
+    state = BareState.__new__(BareState)
+    state.snapshot = StateSnapshot()
+    state._publish_lock = Lock()
+    return state
+
+
+class StateSnapshotTest(unittest.TestCase):
+
+    def test_is_immutable(self):
+        snapshot = StateSnapshot(state="PLAYING")
+        with self.assertRaises(AttributeError):
+            snapshot.state = "STOPPED"
+
+    def test_replace_bumps_the_version_and_keeps_the_rest(self):
+        snapshot = StateSnapshot(state="PLAYING", volume=30, elapsed=1000)
+        newer = snapshot.replace(elapsed=2000)
+        self.assertEqual(newer.version, snapshot.version + 1)
+        self.assertEqual((newer.state, newer.volume, newer.elapsed), ("PLAYING", 30, 2000))
+        self.assertEqual(snapshot.elapsed, 1000)
+
+
+class PublishTest(unittest.TestCase):
+
+    def test_publish_reports_changes_with_old_values(self):
+        state = bare_state()
+        state.publish(state="PLAYING", elapsed=1000)
+        changed = state.publish(state="PLAYING", elapsed=2000)
+        self.assertEqual(changed.value("elapsed"), 2000)
+        self.assertEqual(changed.old.elapsed, 1000)
+        self.assertIn("elapsed", changed)
+        self.assertNotIn("state", changed)
+        self.assertIsNone(changed.value("state"))
+
+    def test_nothing_changed_publishes_nothing(self):
+        state = bare_state()
+        state.publish(state="PLAYING")
+        before = state.snapshot
+        self.assertIsNone(state.publish(state="PLAYING"))
+        self.assertIs(state.snapshot, before)
+
+    def test_reads_have_no_side_effects(self):
+        state = bare_state()
+        state.publish(state="PAUSED_PLAYBACK", volume=12)
+        before = state.snapshot
+        self.assertEqual((state.state, state.volume), ("PAUSED_PLAYBACK", 12))
+        self.assertIs(state.snapshot, before)
+
+
+class UpdateTest(unittest.TestCase):
+
+    def test_takes_snapshot_fields(self):
+        # the adapter clears current_uri before loading a track again
+        state = bare_state()
+        state.publish(state="PLAYING", current_uri="http://a")
+        state.dlna = DotMap(name="amp")
+        state.change_session_lock = asyncio.Lock()
+        state.state_change_callback = None
+        loop = asyncio.new_event_loop()
+        state.running_loop, state.looping_thread = loop, current_thread()
+        try:
+            state.update(state="TRANSITIONING", current_uri=None)
+            loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(loop)))
+        finally:
+            loop.close()
+        self.assertEqual((state.snapshot.state, state.snapshot.current_uri), ("TRANSITIONING", None))
+        with self.assertRaises(AttributeError):
+            state.update(uri=None)
+
+
+class ChangeSetTest(unittest.TestCase):
+
+    def change(self, old, **new):
+        state = bare_state()
+        state.publish(**old)
+        return state.publish(**new)
+
+    def test_playing_on_is_not_a_jump(self):
+        changed = self.change(dict(elapsed=1000), elapsed=1800)
+        self.assertFalse(changed.elapsed_jump)
+        self.assertFalse(changed.matches(interest_mask(["state", "volume", "current_uri", "elapsed_jump"])))
+
+    def test_seek_is_a_jump(self):
+        for new in (90000, 0):
+            changed = self.change(dict(elapsed=1000), elapsed=new)
+            self.assertTrue(changed.elapsed_jump)
+            self.assertTrue(changed.matches(interest_mask(["elapsed_jump"])))
+
+    def test_waiter_matching(self):
+        changed = self.change(dict(state="PLAYING", volume=10), state="PLAYING", volume=20)
+        self.assertTrue(changed.matches(interest_mask(["state", "volume"])))
+        self.assertFalse(changed.matches(interest_mask(["state", "current_uri"])))
+        # no fields means any change at all
+        self.assertTrue(changed.matches(interest_mask()))
+
+    def test_value_of_a_field_changed_to_zero(self):
+        # auto next looks for the position dropping back to exactly 0
+        changed = self.change(dict(elapsed=205000), elapsed=0)
+        self.assertEqual(changed.value("elapsed"), 0)
+        self.assertIsInstance(changed, ChangeSet)
+
+
+class BatchedDevice(object):
+
+    def __init__(self, variables):
+        self.variables = variables
+        self.asked = []
+
+    async def query_state_variables(self, service_type, names, client=None, background=False):
+        self.asked.append((service_type, names))
+        return self.variables
+
+
+class PollBatchedTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_one_request_fills_each_action_result(self):
+        state = bare_state()
+        state.dlna = BatchedDevice({"RelativeTimePosition": "0:00:05", "CurrentTrackURI": "http://a",
+                                    "CurrentTrackDuration": "0:03:00", "TransportState": "PLAYING"})
+        position_info, transport = DotMap(), DotMap()
+        await state._poll_batched(UPNP_AVT_SERVICE_TYPE, [("GetPositionInfo", position_info),
+                                                          ("GetTransportInfo", transport)], client=None)
+        self.assertEqual(len(state.dlna.asked), 1)
+        self.assertEqual(position_info.result.RelTime, "0:00:05")
+        self.assertEqual(position_info.result.TrackURI, "http://a")
+        self.assertEqual(transport.result.CurrentTransportState, "PLAYING")
+
+    async def test_no_answer_leaves_the_results_empty(self):
+        state = bare_state()
+        state.dlna = BatchedDevice(None)
+        transport = DotMap()
+        await state._poll_batched(UPNP_AVT_SERVICE_TYPE, [("GetTransportInfo", transport)], client=None)
+        self.assertFalse(transport)
+
+
+if __name__ == "__main__":
+    unittest.main()
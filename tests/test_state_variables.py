@@ -0,0 +1,46 @@
+import unittest
+from unittest import mock
+
+from dotmap import DotMap
+
+import plex  # noqa: F401 - dlna imports plex.adapters, which must load first
+from dlna.dlna_device import DlnaDevice, BATCH_FAILURES_TO_DISABLE
+from utils import UPNP_AVT_SERVICE_TYPE
+
+
+class FakeService(object):
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.batch_failures = 0
+
+    async def control(self, action, data, client=None, background=False):
+        return self.results.pop(0)
+
+
+class QueryStateVariablesTest(unittest.IsolatedAsyncioTestCase):
+
+    def device(self, results):
+        device = DlnaDevice("http://127.0.0.1:9/description.xml")
+        device.name = "amp"
+        device.profile = mock.Mock()
+        service = FakeService(results)
+        device._get_service = lambda service_type: service
+        return device, service
+
+    async def test_no_answer_does_not_count_against_the_batch(self):
+        device, service = self.device([None] * (BATCH_FAILURES_TO_DISABLE + 1))
+        for _ in range(BATCH_FAILURES_TO_DISABLE + 1):
+            self.assertIsNone(await device.query_state_variables(UPNP_AVT_SERVICE_TYPE, ["TransportState"]))
+        self.assertEqual(service.batch_failures, 0)
+        device.profile.mark_unsupported.assert_not_called()
+
+    async def test_answers_without_the_variables_disable_it(self):
+        device, service = self.device([DotMap(StateVariableValuePairs="")] * BATCH_FAILURES_TO_DISABLE)
+        for _ in range(BATCH_FAILURES_TO_DISABLE):
+            await device.query_state_variables(UPNP_AVT_SERVICE_TYPE, ["TransportState"])
+        device.profile.mark_unsupported.assert_called_once_with("GetStateVariables")
+
+
+if __name__ == "__main__":
+    unittest.main()
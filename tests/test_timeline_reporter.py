@@ -0,0 +1,113 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from aiohttp import web
+from dotmap import DotMap
+
+from plex.timeline_reporter import TimelineReporter, DeviceReport, TIMELINE_HEARTBEAT_SECS
+
+
+class FakeAdapter(object):
+
+    def __init__(self, url):
+        self.params = dict(state="playing", ratingKey="1", key="/library/metadata/1", time=0,
+                           duration=200000, playQueueItemID="5", shuffle=0, repeat=0, containerKey="/playQueues/1")
+        self.plex_lib = DotMap(get_timeline=lambda: url)
+
+    async def get_pms_state(self):
+        return dict(self.params)
+
+
+class DueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.report = DeviceReport("amp", None)
+        self.report.queued = dict(state="playing", ratingKey="1", time=10000)
+        self.report.queued_at = 100.0
+
+    def test_playing_on_is_not_news(self):
+        self.assertIsNone(TimelineReporter.due(self.report, dict(state="playing", ratingKey="1", time=12000), 102.0))
+
+    def test_changes_seeks_and_heartbeats(self):
+        due = TimelineReporter.due
+        self.assertEqual(due(self.report, dict(state="paused", ratingKey="1", time=10000), 101.0), "change")
+        self.assertEqual(due(self.report, dict(state="playing", ratingKey="2", time=0), 101.0), "change")
+        self.assertEqual(due(self.report, dict(state="playing", ratingKey="1", time=90000), 101.0), "seek")
+        self.assertEqual(due(self.report, dict(state="playing", ratingKey="1", time=10000 + TIMELINE_HEARTBEAT_SECS
+                                                * 1000), 100.0 + TIMELINE_HEARTBEAT_SECS), "heartbeat")
+
+    def test_stopped_is_said_once(self):
+        self.report.queued = dict(state="stopped")
+        self.assertIsNone(TimelineReporter.due(self.report, dict(state="stopped"), 1000.0))
+
+
+class ReporterTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.requests = []
+        self.status = 200
+
+        async def timeline(request: web.Request):
+            self.requests.append(dict(request.query))
+            await asyncio.sleep(0.05)
+            return web.Response(status=self.status, headers={"Retry-After": "30"} if self.status == 503 else {})
+
+        app = web.Application()
+        app.router.add_get("/:/timeline", timeline)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/:/timeline"
+        self.adapter = FakeAdapter(url)
+        self.device = DotMap(uuid="renderer", name="amp", model="amp")
+        self.reporter = TimelineReporter()
+
+    async def asyncTearDown(self):
+        await self.reporter.close()
+        await self.runner.cleanup()
+
+    async def settle(self):
+        await self.reporter.devices[self.device.uuid].sender.wait()
+
+    async def test_only_news_is_sent(self):
+        for _ in range(5):
+            await self.reporter.report(self.device, self.adapter)
+        await self.settle()
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.requests[0]["X-Plex-Client-Identifier"], "renderer")
+        self.adapter.params["state"] = "paused"
+        await self.reporter.report(self.device, self.adapter)
+        await self.settle()
+        self.assertEqual([r["state"] for r in self.requests], ["playing", "paused"])
+
+    async def test_bursts_send_only_the_latest(self):
+        await self.reporter.report(self.device, self.adapter)
+        for state in ("paused", "playing", "paused"):
+            self.adapter.params["state"] = state
+            self.adapter.params["ratingKey"] = state
+            await self.reporter.report(self.device, self.adapter)
+        await self.settle()
+        self.assertEqual([(r["state"], r["ratingKey"]) for r in self.requests], [("paused", "paused")])
+
+    async def test_errors_back_off(self):
+        self.status = 503
+        await self.reporter.report(self.device, self.adapter)
+        await self.settle()
+        self.adapter.params["state"] = "paused"
+        await self.reporter.report(self.device, self.adapter)
+        await self.settle()
+        self.assertEqual(len(self.requests), 1)
+        backoff = next(iter(self.reporter.servers.values()))
+        self.assertEqual(backoff.failures, 1)
+        with mock.patch("plex.timeline_reporter.monotonic", return_value=backoff.retry_at + 1):
+            self.status = 200
+            await self.reporter.report(self.device, self.adapter)
+            await self.settle()
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(backoff.failures, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
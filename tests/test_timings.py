@@ -0,0 +1,127 @@
+import asyncio
+import unittest
+
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from plex.plexserver import time_requests
+from utils.timings import RouteTimings, stage, start_request, finish_request, timings as route_timings
+
+
+class RouteTimingsTest(unittest.TestCase):
+
+    def test_counts_in_flight_until_the_request_ends(self):
+        timings = RouteTimings()
+        a = timings.begin("/player/timeline/poll", "GET", "u1")
+        b = timings.begin("/player/timeline/poll", "GET", "u1")
+        self.assertEqual(timings.in_flight("/player/timeline/poll"), 2)
+        timings.end(a, 200)
+        timings.end(b, 200)
+        self.assertEqual(timings.in_flight("/player/timeline/poll"), 0)
+        stats = timings.snapshot()["routes"]["/player/timeline/poll"]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["max_in_flight"], 2)
+
+    def test_server_errors_are_counted(self):
+        timings = RouteTimings()
+        timings.end(timings.begin("/player/playback/play", "GET"), 500)
+        # an exception escaping the route never produces a status
+        timings.end(timings.begin("/player/playback/play", "GET"), None)
+        timings.end(timings.begin("/player/playback/play", "GET"), 404)
+        self.assertEqual(timings.snapshot()["routes"]["/player/playback/play"]["errors"], 2)
+
+    def test_keeps_only_the_slowest(self):
+        timings = RouteTimings(slowest_kept=2, slow_ms=0)
+        for ms in (30, 10, 50, 20):
+            t = timings.begin("/r", "GET")
+            t.started -= ms / 1000
+            timings.end(t, 200)
+        kept = [round(t.duration_ms, -1) for t in timings.slowest()]
+        self.assertEqual(kept, [50, 30])
+
+    def test_fast_requests_are_not_kept(self):
+        timings = RouteTimings(slow_ms=500)
+        timings.end(timings.begin("/r", "GET"), 200)
+        self.assertEqual(timings.slowest(), [])
+
+    def test_time_spent_waiting_is_not_slow(self):
+        timings = RouteTimings(slow_ms=500)
+        t = timings.begin("/player/timeline/poll", "GET")
+        t.started -= 10
+        t.add_stage("wait for change", t.started + 0.001, t.started + 9.999, waiting=True)
+        timings.end(t, 200)
+        self.assertLess(t.busy_ms, 500)
+        self.assertEqual(timings.slowest(), [])
+        # still counted in full for the route
+        self.assertGreaterEqual(timings.snapshot()["routes"]["/player/timeline/poll"]["max_ms"], 10000)
+
+    def test_percentiles_come_from_the_buckets(self):
+        timings = RouteTimings()
+        for ms in (3, 3, 3, 3, 3, 3, 3, 3, 3, 700):
+            t = timings.begin("/r", "GET")
+            t.started -= ms / 1000
+            timings.end(t, 200)
+        stats = timings.snapshot()["routes"]["/r"]
+        self.assertEqual(stats["p50_ms"], 5)
+        self.assertEqual(stats["p99_ms"], 1000)
+
+    def test_stages_are_recorded_against_the_current_request(self):
+        timings = RouteTimings(slow_ms=0)
+        t = timings.begin("/player/playback/pause", "GET", "u1")
+        token = start_request(t)
+        try:
+            with stage("device lookup"):
+                pass
+            with stage("soap Pause"):
+                pass
+        finally:
+            finish_request(token)
+        timings.end(t, 200)
+        slow = timings.snapshot({"u1": "Hegel H150"})["slowest"][0]
+        self.assertEqual(slow["device"], "Hegel H150")
+        self.assertEqual([s["name"] for s in slow["stages"]], ["device lookup", "soap Pause"])
+
+    def test_stage_outside_a_request_does_nothing(self):
+        with stage("soap GetPositionInfo"):
+            pass
+
+
+class MiddlewareTest(unittest.TestCase):
+
+    def test_streamed_body_is_not_timed(self):
+        async def body():
+            for _ in range(3):
+                await asyncio.sleep(0.2)
+                yield b"x"
+
+        async def stream(request):
+            return StreamingResponse(body())
+
+        app = Starlette(routes=[Route("/stream", stream)])
+        app.add_middleware(time_requests)
+        self.assertEqual(TestClient(app).get("/stream").content, b"xxx")
+        self.assertLess(route_timings.routes["/stream"].max_ms, 500)
+
+    def test_messages_pass_through_untouched(self):
+        messages = [{"type": "http.response.start", "status": 200, "headers": []},
+                    {"type": "http.response.zerocopysend", "file": None}]
+
+        async def app(scope, receive, send):
+            for message in messages:
+                await send(message)
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/raw", "headers": []}
+        asyncio.run(time_requests(app)(scope, None, send))
+        self.assertEqual(sent, messages)
+        self.assertEqual(route_timings.routes["/raw"].count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from aiohttp import web
+from dotmap import DotMap
+
+from plex.relay import Relay
+from plex.track_cache import TrackCache, parse_range, cache_key, CACHE_READ_BYTES
+from settings import settings
+
+BODY = bytes(range(256)) * 1024
+
+
+def part(key="/library/parts/1/1600000000/file.flac", size=len(BODY)):
+    return DotMap(key=key, size=size)
+
+
+async def send_response(response):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    await response({"type": "http"}, receive, send)
+    start = messages[0]
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return start["status"], dict((k.decode(), v.decode()) for k, v in start["headers"]), body, messages
+
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_forms(self):
+        self.assertIsNone(parse_range(None, 100))
+        self.assertEqual(parse_range("bytes=0-", 100), (0, 99))
+        self.assertEqual(parse_range("bytes=10-19", 100), (10, 19))
+        self.assertEqual(parse_range("bytes=90-200", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        # several ranges are answered with the whole file
+        self.assertIsNone(parse_range("bytes=0-1,5-6", 100))
+
+    def test_unsatisfiable(self):
+        with self.assertRaises(ValueError):
+            parse_range("bytes=100-", 100)
+
+    def test_key_needs_a_size(self):
+        self.assertIsNone(cache_key(part(size=None)))
+        self.assertIsNone(cache_key(None))
+        self.assertNotEqual(cache_key(part()), cache_key(part(size=5)))
+
+
+class TrackCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = TrackCache(self.tmp.name, max_bytes=len(BODY) * 2)
+        self.patch = mock.patch("plex.relay.track_cache", self.cache)
+        self.patch.start()
+        self.requests = 0
+
+        async def handler(request: web.Request):
+            self.requests += 1
+            return web.Response(body=BODY, headers={"Content-Type": "audio/flac"})
+
+        app = web.Application()
+        app.router.add_get("/library/parts/{tail:.*}", handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.old_host_ip = settings.host_ip
+        settings.host_ip = "10.0.0.2"
+        self.relay = Relay()
+
+    async def asyncTearDown(self):
+        settings.host_ip = self.old_host_ip
+        await self.relay.close()
+        await self.runner.cleanup()
+        self.patch.stop()
+        self.tmp.cleanup()
+
+    def entry(self, p):
+        url = f"http://127.0.0.1:{self.port}{p.key}?X-Plex-Token=secret"
+        return self.relay.entry(self.relay.register(url, p).rsplit("/", 1)[1])
+
+    async def play(self, p, range_header=None):
+        response = await self.relay.respond(self.entry(p), "GET", range_header)
+        return await send_response(response)
+
+    async def test_replay_comes_from_disk(self):
+        status, _, body, _ = await self.play(part())
+        self.assertEqual((status, body), (200, BODY))
+        self.assertEqual(self.requests, 1)
+        self.assertEqual(len(os.listdir(self.tmp.name)), 1)
+
+        status, headers, body, _ = await self.play(part())
+        self.assertEqual((status, body), (200, BODY))
+        self.assertEqual(headers["content-type"], "audio/flac")
+        self.assertEqual(self.requests, 1)
+
+        status, headers, body, _ = await self.play(part(), "bytes=1000-1999")
+        self.assertEqual(status, 206)
+        self.assertEqual(headers["content-range"], f"bytes 1000-1999/{len(BODY)}")
+        self.assertEqual(body, BODY[1000:2000])
+        self.assertEqual(self.requests, 1)
+
+    async def test_size_mismatch_is_not_kept(self):
+        await self.play(part(size=len(BODY) + 1))
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        await self.play(part(size=len(BODY) + 1))
+        self.assertEqual(self.requests, 2)
+
+    async def test_least_recently_played_goes_first(self):
+        a, b, c = (part(f"/library/parts/{i}/1/file.flac") for i in range(3))
+        await self.play(a)
+        await self.play(b)
+        # a is played again from the cache, so b is now the oldest
+        await self.play(a)
+        await self.play(c)
+        self.assertIsNotNone(await self.cache.lookup(a))
+        self.assertIsNone(await self.cache.lookup(b))
+        self.assertIsNotNone(await self.cache.lookup(c))
+        self.assertEqual(self.cache.total, len(BODY) * 2)
+
+    async def test_sent_in_reads(self):
+        await self.play(part())
+        response = await self.relay.respond(self.entry(part()), "GET", "bytes=10-")
+        _, _, body, messages = await send_response(response)
+        self.assertEqual(body, BODY[10:])
+        self.assertTrue(all(m["type"] == "http.response.body" for m in messages[1:]))
+        self.assertLessEqual(max(len(m["body"]) for m in messages[1:]), CACHE_READ_BYTES)
+
+    async def test_index_survives_a_restart(self):
+        await self.play(part())
+        reloaded = TrackCache(self.tmp.name, max_bytes=len(BODY) * 2)
+        self.assertIsNotNone(await reloaded.lookup(part()))
+
+
+if __name__ == "__main__":
+    unittest.main()
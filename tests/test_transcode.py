@@ -0,0 +1,95 @@
+import unittest
+from urllib.parse import urlparse, parse_qs
+
+from dotmap import DotMap
+
+from plex.adapters import PlexLib
+from plex.play_queue import PlayQueue
+from plex.transcode import parse_sink_protocols, sink_accepts, transcode_target
+
+MP3_ONLY = "http-get:*:audio/mpeg:DLNA.ORG_PN=MP3,http-get:*:audio/x-ms-wma:*"
+
+
+def flac_track():
+    return DotMap(dict(key="/library/metadata/7", title="Song", playQueueItemID=5,
+                       Media=[dict(container="flac", audioCodec="flac",
+                                   Part=[dict(key="/library/parts/9/1/file.flac", size=1000)])]))
+
+
+class SinkProtocolsTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_sink_protocols(MP3_ONLY), {"audio/mpeg", "audio/x-ms-wma"})
+        self.assertIsNone(parse_sink_protocols(""))
+        self.assertIsNone(parse_sink_protocols("http-get:*:*:*"))
+
+    def test_aliases(self):
+        self.assertTrue(sink_accepts(frozenset({"audio/x-flac"}), "audio/flac"))
+        self.assertFalse(sink_accepts(frozenset({"audio/mpeg"}), "audio/flac"))
+        # nothing known, nothing held back
+        self.assertTrue(sink_accepts(None, "audio/flac"))
+
+    def test_target(self):
+        self.assertEqual(transcode_target(frozenset({"audio/aac"})), ("aac", "audio/aac"))
+        self.assertEqual(transcode_target(frozenset({"audio/L16"})), ("mp3", "audio/mpeg"))
+
+
+class SourceForTrackTest(unittest.TestCase):
+
+    def setUp(self):
+        lib = PlexLib()
+        lib.protocol, lib.address, lib.port, lib.token = "http", "10.0.0.14", 32400, "t"
+        self.queue = PlayQueue("/playQueues/1", lib)
+
+    def test_direct_play_when_the_renderer_takes_it(self):
+        url, part, mime = self.queue.source_for_track(flac_track(), frozenset({"audio/flac"}))
+        self.assertEqual(url, "http://10.0.0.14:32400/library/parts/9/1/file.flac?X-Plex-Token=t")
+        self.assertEqual(part.size, 1000)
+        self.assertEqual(mime, "audio/flac")
+
+    def test_transcode_when_it_does_not(self):
+        url, part, mime = self.queue.source_for_track(flac_track(), parse_sink_protocols(MP3_ONLY), "renderer")
+        parsed = urlparse(url)
+        self.assertEqual(parsed.path, "/music/:/transcode/universal/start.mp3")
+        query = parse_qs(parsed.query)
+        self.assertEqual(query["path"], ["/library/metadata/7"])
+        self.assertEqual(query["session"], ["renderer-5"])
+        self.assertEqual(query["X-Plex-Client-Identifier"], ["renderer"])
+        self.assertEqual(query["X-Plex-Token"], ["t"])
+        self.assertIsNone(part)
+        self.assertEqual(mime, "audio/mpeg")
+        didl = self.queue.metadata_for_track(flac_track(), url, mime, seekable=False)
+        self.assertIn("http-get:*:audio/mpeg:", didl)
+        self.assertIn("DLNA.ORG_OP=00", didl)
+        self.assertNotIn("size=", didl)
+
+    def test_unknown_format_is_transcoded_for_a_renderer_with_a_list(self):
+        track = flac_track()
+        track.Media[0].container = track.Media[0].audioCodec = "mka"
+        url, part, mime = self.queue.source_for_track(track, parse_sink_protocols(MP3_ONLY), "renderer")
+        self.assertEqual(urlparse(url).path, "/music/:/transcode/universal/start.mp3")
+        self.assertIsNone(part)
+        self.assertEqual(mime, "audio/mpeg")
+        # one that listed nothing is given the file
+        url, part, mime = self.queue.source_for_track(track, None, "renderer")
+        self.assertEqual(part.size, 1000)
+        self.assertIsNone(mime)
+
+    def test_each_track_is_transcoded_in_its_own_session(self):
+        sink = parse_sink_protocols(MP3_ONLY)
+        current = flac_track()
+        upcoming = flac_track()
+        upcoming.playQueueItemID = 6
+        sessions = {parse_qs(urlparse(self.queue.source_for_track(t, sink, "renderer")[0]).query)["session"][0]
+                    for t in (current, upcoming)}
+        self.assertEqual(sessions, {"renderer-5", "renderer-6"})
+
+    def test_direct_play_offers_byte_seeks(self):
+        url, _, mime = self.queue.source_for_track(flac_track(), frozenset({"audio/flac"}))
+        didl = self.queue.metadata_for_track(flac_track(), url, mime)
+        self.assertIn("DLNA.ORG_OP=01", didl)
+        self.assertIn('size="1000"', didl)
+
+
+if __name__ == "__main__":
+    unittest.main()
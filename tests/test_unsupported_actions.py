@@ -0,0 +1,59 @@
+import unittest
+
+import aiohttp
+from aiohttp import web
+
+import plex  # noqa: F401 - dlna imports plex.adapters, which must load first
+from dlna.dlna_device import DlnaDevice, DlnaDeviceService
+from utils import UPNP_AVT_SERVICE_TYPE
+from utils.profile import UnsupportedAction, UNSUPPORTED_REFUSALS_TO_MARK
+
+FAULT = ('<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">'
+         '<s:Body><s:Fault><detail><UPnPError xmlns="urn:schemas-upnp-org:control-1-0">'
+         '<errorCode>401</errorCode><errorDescription>Invalid Action</errorDescription>'
+         '</UPnPError></detail></s:Fault></s:Body></s:Envelope>')
+
+
+class UnsupportedActionTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        async def refuse(request: web.Request):
+            return web.Response(status=500, text=FAULT)
+
+        app = web.Application()
+        app.router.add_post("/control", refuse)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.device = DlnaDevice(f"http://127.0.0.1:{port}/description.xml")
+        self.device.name = "amp"
+        self.service = DlnaDeviceService({"serviceType": UPNP_AVT_SERVICE_TYPE, "controlURL": "/control",
+                                          "eventSubURL": "/event", "SCPDURL": "/scpd.xml"}, self.device)
+        self.client = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.runner.cleanup()
+
+    async def refuse(self):
+        with self.assertRaises(Exception):
+            await self.service._post("Seek", "", {}, self.client, 1)
+
+    async def test_one_refusal_is_not_remembered(self):
+        await self.refuse()
+        self.assertFalse(self.device.profile.is_unsupported("Seek"))
+        for _ in range(UNSUPPORTED_REFUSALS_TO_MARK - 1):
+            await self.refuse()
+        self.assertTrue(self.device.profile.is_unsupported("Seek"))
+
+    async def test_commands_for_it_fail_and_polls_are_skipped(self):
+        self.device.profile.mark_unsupported("Seek")
+        with self.assertRaises(UnsupportedAction):
+            await self.service.control("Seek", {"Target": "0:00:10"})
+        self.assertIsNone(await self.service.control("Seek", {"Target": "0:00:10"}, background=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import plex  # noqa: F401 - dlna imports plex.adapters, which must load first
+from dlna.dlna_device import DlnaDevice
+from utils.deadline import deadline, remaining
+
+
+class WarmUpTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.device = DlnaDevice("http://127.0.0.1:9/description.xml")
+        self.device.name = "amp"
+        self.calls = []
+
+        async def get_transport_info(background=False):
+            self.assertTrue(background)
+            self.calls.append(remaining())
+            return {"CurrentTransportState": "STOPPED"}
+        self.device.GetTransportInfo = get_transport_info
+
+    async def test_repeated_signals_share_one_warm_up(self):
+        with mock.patch("dlna.dlna_device.WARM_WINDOW_SECS", 0):
+            for _ in range(5):
+                self.device.warm_up()
+            await self.device._warm_task
+        self.assertEqual(len(self.calls), 1)
+
+    async def test_not_bound_by_the_request_deadline(self):
+        with mock.patch("dlna.dlna_device.WARM_WINDOW_SECS", 0):
+            with deadline(0.01):
+                self.device.warm_up()
+            await self.device._warm_task
+        self.assertEqual(self.calls, [None])
+
+    async def test_kept_warm_for_the_window(self):
+        with mock.patch("dlna.dlna_device.WARM_WINDOW_SECS", 0.05), \
+                mock.patch("dlna.dlna_device.WARM_INTERVAL_SECS", 0.02):
+            self.device.warm_up()
+            await asyncio.wait_for(self.device._warm_task, 1)
+        self.assertGreater(len(self.calls), 1)
+
+    async def test_not_while_the_breaker_is_open(self):
+        for _ in range(self.device.breaker.failure_threshold):
+            self.device.breaker.record_failure()
+        self.assertFalse(self.device.breaker.closed)
+        with mock.patch("dlna.dlna_device.WARM_WINDOW_SECS", 0):
+            self.device.warm_up()
+            await self.device._warm_task
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
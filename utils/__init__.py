@@ -4,11 +4,14 @@ import xmltodict
 from dotmap import DotMap
 
 from settings import settings
+from utils.bundles import device_bundle
 from datetime import timedelta, datetime
+from email.utils import parsedate_to_datetime
 
 
 UPNP_AVT_SERVICE_TYPE = "urn:schemas-upnp-org:service:AVTransport:1"
 UPNP_RC_SERVICE_TYPE = "urn:schemas-upnp-org:service:RenderingControl:1"
+UPNP_CM_SERVICE_TYPE = "urn:schemas-upnp-org:service:ConnectionManager:1"
 
 # Some renderers implement newer versions of the same services - the Hegel H150,
 # for example, advertises AVTransport:2 and RenderingControl:2. Their SOAP replies
@@ -67,58 +70,19 @@ def xml2dict(xml):
 
 
 def pms_header(device):
-    return {
-        'X-Plex-Client-Identifier': device.uuid,
-        'X-Plex-Device': device.model,
-        'X-Plex-Device-Name': device.name,
-        'X-Plex-Platform': settings.platform,
-        'X-Plex-Platform-Version': settings.platform_version,
-        'X-Plex-Product': device.model,
-        'X-Plex-Version': settings.version,
-        'X-Plex-Provides': 'player,pubsub-player'
-    }
+    return device_bundle(device).pms_header
 
 
 def plex_server_response_headers(device):
-    return {
-        'Accept': '*/*',
-        'Connection': 'keep-alive',
-        'Accept-Language': 'en',
-        'X-Plex-Device': device.model,
-        'X-Plex-Platform': settings.platform,
-        'X-Plex-Platform-Version': settings.platform_version,
-        'X-Plex-Product': device.model,
-        'X-Plex-Version': settings.version,
-        'X-Plex-Client-Identifier': device.uuid,
-        'X-Plex-Device-Name': device.name,
-        'X-Plex-Provides': 'player,pubsub-player',
-    }
+    return device_bundle(device).plex_server_response_headers
 
 
 def subscriber_send_headers(device):
-    return {
-        'Content-Type': 'application/xml',
-        'Connection': 'Keep-Alive',
-        'X-Plex-Client-Identifier': device.uuid,
-        'X-Plex-Platform': settings.platform,
-        'X-Plex-Platform-Version': settings.platform_version,
-        'X-Plex-Product': device.model,
-        'X-Plex-Version': settings.version,
-        'X-Plex-Device-Name': device.name,
-        'Accept-Encoding': 'gzip, deflate',
-        'Accept-Language': 'en,*'
-    }
+    return device_bundle(device).subscriber_send_headers
 
 
 def timeline_poll_headers(device):
-    return {
-        'X-Plex-Client-Identifier': device.uuid,
-        'X-Plex-Protocol': '1.0',
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Max-Age': '1209600',
-        'Access-Control-Expose-Headers': 'X-Plex-Client-Identifier',
-        'Content-Type': 'text/xml;charset=utf-8'
-    }
+    return device_bundle(device).timeline_poll_headers
 
 
 def parse_timedelta(s):
@@ -198,12 +162,69 @@ CONTROL_RETRY_DELAYS = (0, 0.4, 0.8, 1.6, 3.2)
 # up on a player long before that.
 CONTROL_RETRY_BUDGET = 12.0
 
+# Wake up latencies a renderer needs to have shown before its retries are
+# fitted to them, and the least time between two attempts.
+RETRY_MIN_SAMPLES = 3
+RETRY_MIN_GAP = 0.2
+
+
+def retry_offsets(wake_latencies, budget: float = CONTROL_RETRY_BUDGET, attempts: int = len(CONTROL_RETRY_DELAYS)):
+    """When to make each attempt of a control call, in seconds from its start.
+
+    Without enough history this is CONTROL_RETRY_DELAYS added up. With it, the
+    retries are spread over where this renderer has actually answered, from
+    its 10th to a little past its 90th percentile wake up time, so an amp that
+    is up in 300ms is retried within 300ms and one that needs 5s is not asked
+    four times before it can possibly answer. One more attempt at the default
+    schedule's end covers a wake up slower than any seen. Everything stays
+    inside the budget, less a second for the attempt itself.
+    """
+    default = []
+    total = 0
+    for delay in CONTROL_RETRY_DELAYS:
+        total += delay
+        default.append(round(total, 2))
+    latencies = sorted(x for x in wake_latencies or () if isinstance(x, (int, float)) and x >= 0)
+    if len(latencies) < RETRY_MIN_SAMPLES or attempts < 2:
+        return tuple(o for o in default if o < budget) or (0,)
+
+    def quantile(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    latest = max(budget - 1, 0)
+    low = min(max(quantile(0.1), RETRY_MIN_GAP), latest)
+    high = min(max(quantile(0.9) * 1.25, low), latest)
+    retries = attempts - 2
+    step = (high - low) / (retries - 1) if retries > 1 else 0
+    offsets = [0.0]
+    for t in [low + i * step for i in range(retries)] + [max(high, min(default[-1], latest))]:
+        if t - offsets[-1] >= RETRY_MIN_GAP:
+            offsets.append(round(t, 2))
+    return tuple(offsets)
+
 def upnp_error_code(body: str):
     """The UPnP errorCode from a SOAP fault body, or None."""
     m = re.search(r"<errorCode>\s*(\d+)\s*</errorCode>", body or "")
     return m.group(1) if m else None
 
 
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, in seconds or as an HTTP date, or None."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return max((when - datetime.now(when.tzinfo)).total_seconds(), 0)
+
+
 def is_transient_failure(status: int, code):
     """Whether a failed control request is worth trying again.
 
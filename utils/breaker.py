@@ -0,0 +1,101 @@
+import threading
+from time import monotonic
+
+# Consecutive connection failures before background traffic to a renderer stops.
+BREAKER_FAILURE_THRESHOLD = 3
+
+# Wait before each half-open probe while the breaker stays open; the last one
+# repeats. A renderer that is switched off is usually off for hours, but one
+# that is only restarting comes back within seconds.
+BREAKER_PROBE_DELAYS = (2, 5, 10, 30, 60)
+
+# A probe is a single GetTransportInfo. It does not need the long timeout an
+# action that changes something gets.
+BREAKER_PROBE_TIMEOUT = 2
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+    """Stops background polling of a renderer that is not answering.
+
+    An unreachable renderer otherwise costs a full retry schedule on every poll,
+    so a powered off amp keeps its state loop and its connection slots busy for
+    as long as it stays off. Once the breaker opens, background calls fail
+    immediately, apart from one cheap probe on a backoff schedule to notice it
+    coming back. Commands from a controller never go through here: those are
+    exactly the calls that are expected to wake it up.
+
+    Used from the main loop and from the device's state loop, hence the lock.
+    """
+
+    def __init__(self, name: str = "", failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 probe_delays=BREAKER_PROBE_DELAYS, clock=monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.probe_delays = probe_delays
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_count = 0
+        self.next_probe_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self.state == CLOSED
+
+    def probe_due(self):
+        return self.state == OPEN and self.clock() >= self.next_probe_at
+
+    def allow_background(self):
+        """Whether a background call may go out, and if so whether it is the probe.
+
+        Returns (allowed, is_probe). Only one probe is in flight at a time.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True, False
+            if self.state == OPEN and self.clock() >= self.next_probe_at:
+                self.state = HALF_OPEN
+                return True, True
+            return False, False
+
+    def record_success(self):
+        with self._lock:
+            was = self.state
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_count = 0
+            self.next_probe_at = None
+        if was != CLOSED:
+            print(f"dlna {self.name} answering again, resuming background polling")
+
+    def record_failure(self, background=True):
+        """Count a connection failure: refused, unreachable or timed out.
+
+        Once open, only background failures, i.e. the probes, move the next
+        probe further out; a command failing meanwhile says nothing new.
+        """
+        with self._lock:
+            self.failures += 1
+            if self.state == CLOSED and self.failures < self.failure_threshold:
+                return
+            if self.state != CLOSED and not background:
+                return
+            was = self.state
+            delay = self.probe_delays[min(self.opened_count, len(self.probe_delays) - 1)]
+            self.opened_count += 1
+            self.state = OPEN
+            self.next_probe_at = self.clock() + delay
+        if was == CLOSED:
+            print(f"dlna {self.name} unreachable after {self.failures} tries, "
+                  f"pausing background polling, probing in {delay}s")
+
+    def release_probe(self):
+        """Put the breaker back to open when a probe ended without an answer either way."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
@@ -0,0 +1,113 @@
+from types import MappingProxyType
+from xml.sax.saxutils import quoteattr
+
+from settings import settings
+
+PLEX_PROVIDES = 'player,pubsub-player'
+PLEX_CAPABILITIES = 'timeline,playback,playqueues'
+
+
+class DeviceBundle(object):
+    """Everything sent on behalf of one renderer that only depends on its name.
+
+    The header sets, the /resources body and the GDM announcement were built
+    again for every request, report and discovery reply. They are built once
+    here, per renderer, and built again only when the renderer's name or model
+    changes. The header sets are read-only, so a caller wanting more headers
+    has to copy them rather than change them for everyone.
+    """
+
+    __slots__ = ("uuid", "name", "model", "pms_header", "plex_server_response_headers",
+                 "subscriber_send_headers", "timeline_poll_headers", "resources", "gdm_hello", "gdm_reply")
+
+    def __init__(self, device):
+        self.uuid = device.uuid
+        self.name = device.name
+        self.model = device.model
+        self.pms_header = MappingProxyType({
+            'X-Plex-Client-Identifier': device.uuid,
+            'X-Plex-Device': device.model,
+            'X-Plex-Device-Name': device.name,
+            'X-Plex-Platform': settings.platform,
+            'X-Plex-Platform-Version': settings.platform_version,
+            'X-Plex-Product': device.model,
+            'X-Plex-Version': settings.version,
+            'X-Plex-Provides': PLEX_PROVIDES
+        })
+        self.plex_server_response_headers = MappingProxyType({
+            'Accept': '*/*',
+            'Connection': 'keep-alive',
+            'Accept-Language': 'en',
+            'X-Plex-Device': device.model,
+            'X-Plex-Platform': settings.platform,
+            'X-Plex-Platform-Version': settings.platform_version,
+            'X-Plex-Product': device.model,
+            'X-Plex-Version': settings.version,
+            'X-Plex-Client-Identifier': device.uuid,
+            'X-Plex-Device-Name': device.name,
+            'X-Plex-Provides': PLEX_PROVIDES,
+        })
+        self.subscriber_send_headers = MappingProxyType({
+            'Content-Type': 'application/xml',
+            'Connection': 'Keep-Alive',
+            'X-Plex-Client-Identifier': device.uuid,
+            'X-Plex-Platform': settings.platform,
+            'X-Plex-Platform-Version': settings.platform_version,
+            'X-Plex-Product': device.model,
+            'X-Plex-Version': settings.version,
+            'X-Plex-Device-Name': device.name,
+            'Accept-Encoding': 'gzip, deflate',
+            'Accept-Language': 'en,*'
+        })
+        self.timeline_poll_headers = MappingProxyType({
+            'X-Plex-Client-Identifier': device.uuid,
+            'X-Plex-Protocol': '1.0',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Max-Age': '1209600',
+            'Access-Control-Expose-Headers': 'X-Plex-Client-Identifier',
+            'Content-Type': 'text/xml;charset=utf-8'
+        })
+        self.resources = (
+            f'<MediaContainer><Player title={quoteattr(str(device.name))} protocol="plex" protocolVersion="1" '
+            f'protocolCapabilities="{PLEX_CAPABILITIES}" '
+            f'machineIdentifier={quoteattr(str(device.uuid))} product={quoteattr(str(device.model))} '
+            f'platform={quoteattr(settings.platform)} '
+            f'platformVersion={quoteattr(settings.platform_version)} '
+            f'version={quoteattr(settings.version)} deviceClass="stb"/></MediaContainer>'
+        ).encode('utf8')
+        gdm_data = "".join(f"{key}: {value}\n" for key, value in {
+            "Name": device.name,
+            "Port": str(settings.http_port),
+            "Content-Type": "plex/media-player",
+            "Product": device.model,
+            "Protocol": "plex",
+            "Protocol-Version": "1",
+            "Protocol-Capabilities": PLEX_CAPABILITIES,
+            "Version": settings.platform_version,
+            "Resource-Identifier": device.uuid,
+            "Device-Class": "stb"
+        }.items())
+        self.gdm_hello = f"HELLO * HTTP/1.0\n{gdm_data}".encode('utf8')
+        self.gdm_reply = f"HTTP/1.0 200 OK\n{gdm_data}".encode('utf8')
+
+    def matches(self, device):
+        return self.name == device.name and self.model == device.model
+
+
+_bundles = {}
+
+
+def device_bundle(device) -> DeviceBundle:
+    """The bundle for `device`, built again if its name or model is not what it was built for."""
+    bundle = _bundles.get(device.uuid)
+    if bundle is None or not bundle.matches(device):
+        bundle = _bundles[device.uuid] = DeviceBundle(device)
+    return bundle
+
+
+def invalidate_device_bundle(uuid: str = None):
+    """Drop the bundle for `uuid`, or every bundle, so it is built from scratch next time."""
+    if uuid is None:
+        _bundles.clear()
+    else:
+        _bundles.pop(uuid, None)
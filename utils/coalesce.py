@@ -0,0 +1,73 @@
+import asyncio
+import contextvars
+from time import monotonic
+
+# How long the value asked for keeps being reported once it has been sent, so
+# the timeline does not flick back to the old value before the next poll has
+# read the new one from the renderer.
+SETTLE_SECS = 2.0
+
+_NOTHING = object()
+
+
+class Coalescer(object):
+    """Sends only the latest of a burst of values, one request at a time.
+
+    Dragging the volume slider or scrubbing sends a stream of commands, and a
+    renderer taking a full SOAP round trip for each one falls further and further
+    behind the finger. Here at most one send is in flight; anything submitted
+    meanwhile replaces whatever was waiting, so once the current send finishes
+    the renderer is sent straight to the last value asked for.
+
+    submit() returns at once. `intended` is what the controller last asked for,
+    for reporting in the timeline until the renderer has caught up.
+    """
+
+    def __init__(self, send, name: str = "", settle_secs: float = SETTLE_SECS):
+        self.send = send
+        self.name = name
+        self.settle_secs = settle_secs
+        self.intended = None
+        self.submitted_at = None
+        self.settled_at = None
+        self.sent_count = 0
+        self._pending = _NOTHING
+        self._worker: asyncio.Task = None
+
+    def submit(self, value):
+        self._pending = value
+        self.intended = value
+        self.submitted_at = monotonic()
+        self.settled_at = None
+        if self._worker is None or self._worker.done():
+            # The request that submitted the first value has long been answered:
+            # a context of its own, so the sends are neither bound by its
+            # deadline nor counted in its timings.
+            self._worker = asyncio.create_task(self._drain(), name=f"coalesce {self.name}",
+                                               context=contextvars.Context())
+
+    @property
+    def busy(self):
+        return self._worker is not None and not self._worker.done()
+
+    def current(self):
+        """The value to report instead of the renderer's, or None."""
+        if self.intended is None:
+            return None
+        if self.busy or (self.settled_at is not None and monotonic() - self.settled_at < self.settle_secs):
+            return self.intended
+        return None
+
+    async def wait(self):
+        if self._worker is not None:
+            await asyncio.shield(self._worker)
+
+    async def _drain(self):
+        while self._pending is not _NOTHING:
+            value, self._pending = self._pending, _NOTHING
+            try:
+                await self.send(value)
+                self.sent_count += 1
+            except Exception as e:
+                print(f"{self.name} send {value} failed {e.__class__.__name__} {e}")
+        self.settled_at = monotonic()
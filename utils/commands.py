@@ -0,0 +1,93 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+
+# Outcomes remembered per controller and player.
+COMMANDS_KEPT = 32
+# Controller/player pairs remembered at all.
+PAIRS_KEPT = 64
+# A commandID this far below the newest one is not a command that arrived out of
+# order but one from a controller that restarted and began counting from 1 again.
+OUT_OF_ORDER_WINDOW = 32
+# After this long without a command, the history of a pair is forgotten.
+HISTORY_SECS = 120
+
+
+class _History(object):
+    __slots__ = ("outcomes", "newest", "last_seen")
+
+    def __init__(self):
+        self.outcomes = OrderedDict()
+        self.newest = None
+        self.last_seen = monotonic()
+
+
+class RecentCommands(object):
+    """Runs each Plex command once, however many times the controller sends it.
+
+    Controllers resend a command when the answer is slow, with the same
+    commandID. Running it again issues a second SetAVTransportURI and play
+    queue fetch, or skips two tracks instead of one. A repeated commandID is
+    answered with the outcome of the first one, or waits for it if it is still
+    running. Any other commandID runs, even one older than the newest seen:
+    that is a separate command that arrived out of order, not a resend.
+    """
+
+    def __init__(self):
+        self._pairs = OrderedDict()
+
+    def _history(self, client_uuid, target_uuid, create=True):
+        key = (client_uuid, target_uuid)
+        history = self._pairs.get(key)
+        if history is not None and monotonic() - history.last_seen > HISTORY_SECS:
+            history = None
+            del self._pairs[key]
+        if history is None and create:
+            history = self._pairs[key] = _History()
+            while len(self._pairs) > PAIRS_KEPT:
+                self._pairs.popitem(last=False)
+        if history is not None:
+            self._pairs.move_to_end(key)
+        return history
+
+    async def run(self, client_uuid, target_uuid, command_id, execute):
+        """Await execute() unless this command has run already."""
+        if client_uuid is None or target_uuid is None or command_id is None:
+            return await execute()
+        history = self._history(client_uuid, target_uuid)
+        history.last_seen = monotonic()
+        if history.newest is not None and command_id <= history.newest - OUT_OF_ORDER_WINDOW:
+            # the controller started counting again
+            history.outcomes.clear()
+            history.newest = None
+        outcome = history.outcomes.get(command_id)
+        if outcome is not None:
+            print(f"command {command_id} from {client_uuid} already seen, not running it again")
+            try:
+                return await asyncio.shield(outcome)
+            except asyncio.CancelledError:
+                if not outcome.cancelled():
+                    raise
+                # the first run missed its deadline, so this answer has too
+                raise asyncio.TimeoutError()
+        outcome = asyncio.get_running_loop().create_future()
+        history.outcomes[command_id] = outcome
+        while len(history.outcomes) > COMMANDS_KEPT:
+            history.outcomes.popitem(last=False)
+        if history.newest is None or command_id > history.newest:
+            history.newest = command_id
+        try:
+            result = await execute()
+        except asyncio.CancelledError:
+            history.outcomes.pop(command_id, None)
+            outcome.cancel()
+            raise
+        except Exception as e:
+            # A failed command is not remembered, so a resend gets to try again.
+            history.outcomes.pop(command_id, None)
+            outcome.set_exception(e)
+            # nobody may be waiting; do not let asyncio complain about that
+            outcome.exception()
+            raise
+        outcome.set_result(result)
+        return result
@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+
+_deadline = ContextVar("deadline", default=None)
+
+
+@contextmanager
+def deadline(secs: float):
+    """Give the enclosed work, and everything it awaits, `secs` to finish.
+
+    An enclosing deadline that is sooner still applies. The deadline only
+    informs timeouts and retries further down, see remaining(); it does not
+    interrupt anything by itself.
+    """
+    at = monotonic() + secs
+    current = _deadline.get()
+    if current is not None:
+        at = min(at, current)
+    token = _deadline.set(at)
+    try:
+        yield at
+    finally:
+        _deadline.reset(token)
+
+
+def clear_deadline():
+    """Drop the deadline inherited from whatever started this task.
+
+    A task created during a request copies its context, deadline included;
+    work that is meant to outlive the request calls this first.
+    """
+    _deadline.set(None)
+
+
+def remaining():
+    """Seconds left before the current deadline, or None when there is none."""
+    at = _deadline.get()
+    if at is None:
+        return None
+    return at - monotonic()
+
+
+def deadline_at():
+    """The current deadline as a monotonic() time, or None."""
+    return _deadline.get()
@@ -0,0 +1,129 @@
+from xml.etree.ElementTree import XMLPullParser, ParseError
+
+# Channel read for per-channel variables such as Volume and Mute.
+MASTER_CHANNEL = "Master"
+
+
+def _local(tag: str):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _instance_variables(events, variables: dict):
+    """Collect val attributes of the children of InstanceID 0 from (event, element) pairs."""
+    depth = 0
+    in_instance = False
+    for event, element in events:
+        if event == "end":
+            depth -= 1
+            if in_instance and depth == 1:
+                in_instance = False
+            element.clear()
+            continue
+        depth += 1
+        name = _local(element.tag)
+        if depth == 2 and name == "InstanceID":
+            in_instance = element.get("val", "0") == "0"
+        elif in_instance and depth == 3:
+            value = element.get("val")
+            channel = element.get("channel")
+            if value is None or (channel is not None and channel != MASTER_CHANNEL):
+                continue
+            variables[name] = value
+
+
+def parse_last_change(text: str, variables: dict = None):
+    """The variables of InstanceID 0 in a LastChange <Event> document."""
+    if variables is None:
+        variables = {}
+    parser = XMLPullParser(events=("start", "end"))
+    try:
+        parser.feed(text)
+        _instance_variables(parser.read_events(), variables)
+        parser.close()
+    except ParseError as e:
+        print(f"bad LastChange {e}: {text[:200]}")
+    return variables
+
+
+def parse_notify(body: bytes):
+    """All state variables carried by a GENA NOTIFY body, by name.
+
+    The body is a propertyset of evented variables. For AVTransport and
+    RenderingControl the one variable is LastChange, an escaped <Event>
+    document with a child per variable that changed since the last event:
+    only those are returned. The outer parser undoes the escaping, so the
+    inner document is parsed as text as it comes out. Per-channel variables
+    are read from the Master channel.
+    """
+    variables = {}
+    parser = XMLPullParser(events=("start", "end"))
+    depth = 0
+    try:
+        parser.feed(body)
+        parser.close()
+    except ParseError as e:
+        print(f"bad NOTIFY body {e}: {body[:200]}")
+        return variables
+    for event, element in parser.read_events():
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        # propertyset > property > variable
+        if depth != 2:
+            continue
+        name = _local(element.tag)
+        if name == "LastChange":
+            if len(element):
+                # Some renderers put the event in unescaped, as markup.
+                _instance_variables(_tree_events(element[0]), variables)
+            elif element.text:
+                parse_last_change(element.text.strip(), variables)
+        elif element.text is not None:
+            variables[name] = element.text.strip()
+    return variables
+
+
+def _tree_events(element):
+    # The events a pull parser would have produced for an already parsed subtree.
+    yield "start", element
+    for child in list(element):
+        yield from _tree_events(child)
+    yield "end", element
+
+
+def upnp_time_ms(value: str):
+    """Milliseconds in a UPnP time value, H+:MM:SS[.F+], or None for NOT_IMPLEMENTED and the like."""
+    if not value:
+        return None
+    try:
+        hours, minutes, seconds = value.strip().split(":")
+        return int((int(hours) * 3600 + int(minutes) * 60 + float(seconds)) * 1000)
+    except ValueError:
+        return None
+
+
+def parse_state_variable_pairs(text: str):
+    """The variables in the StateVariableValuePairs document a GetStateVariables call returns.
+
+    <stateVariableValuePairs><stateVariable variableName="TransportState">PLAYING</stateVariable>...
+    Per-channel variables are read from the Master channel, as in events.
+    """
+    variables = {}
+    if not text or not isinstance(text, str):
+        return variables
+    parser = XMLPullParser(events=("end",))
+    try:
+        parser.feed(text.strip())
+        parser.close()
+    except ParseError as e:
+        print(f"bad StateVariableValuePairs {e}: {text[:200]}")
+        return variables
+    for _, element in parser.read_events():
+        if _local(element.tag) != "stateVariable":
+            continue
+        name = element.get("variableName")
+        channel = element.get("channel")
+        if name and (channel is None or channel == MASTER_CHANNEL):
+            variables[name] = (element.text or "").strip()
+    return variables
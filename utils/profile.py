@@ -0,0 +1,124 @@
+import threading
+import time
+
+# An action a renderer refused as unsupported is not sent again for this long.
+# Long enough to cover restarts, short enough that a firmware update is noticed.
+UNSUPPORTED_TTL_SECS = 7 * 24 * 3600
+# Refusals of an action in a row, all with the same UPnP error code, before it
+# is taken as unsupported. One refusal may just as well be a bad request.
+UNSUPPORTED_REFUSALS_TO_MARK = 3
+# Wake up latencies remembered, newest last.
+WAKE_SAMPLES_KEPT = 20
+# Subscriptions in a row that brought no event before events are not relied on.
+EVENT_MISSES_UNTRUSTED = 2
+# Connection failures with other requests in flight, at a time the renderer was
+# otherwise answering, before it is sent one request fewer at a time.
+CONCURRENT_FAILURES_TO_LOWER = 3
+
+
+class UnsupportedAction(Exception):
+    """A command for an action the renderer refused as unsupported before."""
+
+
+def service_name(service_type: str):
+    """urn:schemas-upnp-org:service:AVTransport:2 -> AVTransport"""
+    parts = service_type.split(":")
+    return parts[-2] if len(parts) >= 2 else service_type
+
+
+class RendererProfile(object):
+    """What has been learned about one renderer, kept in the data store by UDN.
+
+    Every restart used to find the same things out the hard way: the Seek that
+    is always refused, the events that never come, the amp that needs seconds to
+    wake up. Control, polling and retries consult this instead.
+
+    Updated from the main loop and the device's state loop, hence the lock.
+    `save` is called with to_dict() whenever something worth keeping changed.
+    """
+
+    def __init__(self, data: dict = None, save=None):
+        data = data or {}
+        self.save = save
+        self.unsupported = dict(data.get("unsupported") or {})
+        self.event_misses = dict(data.get("event_misses") or {})
+        self.wake_latencies = list(data.get("wake_latencies") or [])[-WAKE_SAMPLES_KEPT:]
+        self.max_concurrency = data.get("max_concurrency")
+        self.concurrent_failures = 0
+        # action -> (UPnP error code, refusals in a row); not kept across restarts
+        self.refusals = {}
+        self._lock = threading.Lock()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "unsupported": dict(self.unsupported),
+                "event_misses": dict(self.event_misses),
+                "wake_latencies": list(self.wake_latencies),
+                "max_concurrency": self.max_concurrency,
+            }
+
+    def _changed(self):
+        if self.save is not None:
+            self.save(self.to_dict())
+
+    def is_unsupported(self, action: str):
+        since = self.unsupported.get(action)
+        return since is not None and time.time() - since < UNSUPPORTED_TTL_SECS
+
+    def mark_unsupported(self, action: str):
+        with self._lock:
+            if action in self.unsupported:
+                return
+            self.unsupported[action] = time.time()
+        self._changed()
+
+    def record_refusal(self, action: str, code: str):
+        """Count a refusal of `action` as unsupported. True once that marked it so."""
+        with self._lock:
+            last_code, count = self.refusals.get(action, (None, 0))
+            count = count + 1 if code == last_code else 1
+            if count < UNSUPPORTED_REFUSALS_TO_MARK:
+                self.refusals[action] = (code, count)
+                return False
+            del self.refusals[action]
+        self.mark_unsupported(action)
+        return True
+
+    def record_accepted(self, action: str):
+        if action in self.refusals:
+            with self._lock:
+                self.refusals.pop(action, None)
+
+    def events_trusted(self, service_type: str):
+        return self.event_misses.get(service_name(service_type), 0) < EVENT_MISSES_UNTRUSTED
+
+    def record_event(self, service_type: str, arrived: bool):
+        """Note whether a fresh subscription brought its initial event."""
+        name = service_name(service_type)
+        with self._lock:
+            misses = self.event_misses.get(name, 0)
+            if arrived and misses == 0:
+                return
+            self.event_misses[name] = 0 if arrived else misses + 1
+        self._changed()
+
+    def record_wake(self, secs: float):
+        """Time from the first refused attempt of a call to the renderer answering it."""
+        with self._lock:
+            self.wake_latencies.append(round(secs, 3))
+            del self.wake_latencies[:-WAKE_SAMPLES_KEPT]
+        self._changed()
+
+    def record_concurrent_failure(self, limit: int):
+        """Returns the lower limit to use from now on, or None to keep `limit`."""
+        if limit <= 1:
+            return None
+        with self._lock:
+            self.concurrent_failures += 1
+            if self.concurrent_failures < CONCURRENT_FAILURES_TO_LOWER:
+                return None
+            self.concurrent_failures = 0
+            self.max_concurrency = limit - 1
+        self._changed()
+        return self.max_concurrency
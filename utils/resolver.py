@@ -0,0 +1,85 @@
+import asyncio
+import ipaddress
+import socket
+from time import monotonic
+
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import DefaultResolver
+
+PLEX_DIRECT_SUFFIX = ".plex.direct"
+# How long a looked up address is used before it is looked up again, and how
+# long past that it is still used when the lookup fails.
+DNS_CACHE_SECS = 300
+DNS_STALE_SECS = 3600
+
+
+def plex_direct_address(hostname: str):
+    """The address a plex.direct hostname stands for, or None.
+
+    The first label spells it out: 10-0-0-14.<hash>.plex.direct for IPv4, and
+    the address with its colons turned into dashes for IPv6.
+    """
+    if not hostname or not hostname.lower().endswith(PLEX_DIRECT_SUFFIX):
+        return None
+    head = hostname.split(".")[0]
+    for candidate in (head.replace("-", "."), head.replace("-", ":")):
+        try:
+            return ipaddress.ip_address(candidate)
+        except ValueError:
+            pass
+    return None
+
+
+class PlexDirectResolver(AbstractResolver):
+    """Resolves plex.direct names without asking DNS, and caches the rest.
+
+    Every Plex server URL a controller hands over is a plex.direct name, and
+    every play queue fetch and timeline report went through the system
+    resolver for it. Those names carry their address, so it is read off the
+    name instead. The hostname is kept in the result, so TLS still sends it as
+    SNI and verifies the certificate against it.
+
+    Other names are looked up as usual and kept for DNS_CACHE_SECS. A failed
+    lookup falls back to the last answer for up to DNS_STALE_SECS more, and
+    simultaneous lookups of one name share a single query.
+    """
+
+    def __init__(self, resolver: AbstractResolver = None):
+        self._resolver = resolver
+        self._cache = {}
+        self._pending = {}
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET):
+        address = plex_direct_address(host)
+        if address is not None:
+            addr_family = socket.AF_INET if address.version == 4 else socket.AF_INET6
+            if family in (socket.AF_UNSPEC, addr_family):
+                return [dict(hostname=host, host=str(address), port=port, family=addr_family,
+                             proto=0, flags=socket.AI_NUMERICHOST | socket.AI_NUMERICSERV)]
+        key = (host, port, family)
+        cached = self._cache.get(key)
+        now = monotonic()
+        if cached is not None and now < cached[0]:
+            return cached[1]
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = asyncio.ensure_future(self._lookup(key, cached))
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _lookup(self, key, cached):
+        if self._resolver is None:
+            self._resolver = DefaultResolver()
+        try:
+            results = await self._resolver.resolve(*key)
+        except OSError as e:
+            if cached is not None and monotonic() < cached[0] + DNS_STALE_SECS:
+                print(f"resolving {key[0]} failed ({e}), using the last answer")
+                return cached[1]
+            raise
+        self._cache[key] = (monotonic() + DNS_CACHE_SECS, results)
+        return results
+
+    async def close(self):
+        if self._resolver is not None:
+            await self._resolver.close()
@@ -0,0 +1,128 @@
+import asyncio
+import threading
+from collections import deque
+
+USER = "user"
+BACKGROUND = "background"
+
+
+class Preempted(Exception):
+    """A background request was cancelled to make way for a user command."""
+
+
+class _Slot(object):
+    __slots__ = ("lane", "loop", "task", "preempted")
+
+    def __init__(self, lane):
+        self.lane = lane
+        self.loop = None
+        self.task = None
+        self.preempted = False
+
+
+class SoapScheduler(object):
+    """Orders the SOAP requests going to one renderer.
+
+    Plenty of renderers serve a single HTTP request at a time, so a Pause sent
+    while a GetPositionInfo is in flight waits for it, and the state loop keeps
+    several of those going. Requests here take a slot, at most `limit` are out
+    at once, and a waiting user command always gets the next free slot ahead of
+    any poll. A user command arriving also cancels the polls already in flight:
+    the poll comes round again, the controller is waiting on the command.
+
+    User commands come from the main loop and polls from the device's state
+    loop, so waiters are futures on their own loop and are woken thread-safely.
+    """
+
+    def __init__(self, name: str = "", limit: int = 2):
+        self.name = name
+        self.limit = max(1, limit)
+        self.active = 0
+        self._lock = threading.Lock()
+        self._waiting = {USER: deque(), BACKGROUND: deque()}
+        self._in_flight_background = set()
+
+    async def run(self, request_factory, background=False):
+        """Run the coroutine made by `request_factory` once a slot is free.
+
+        Raises Preempted when a background request is cancelled for a user command.
+        """
+        lane = BACKGROUND if background else USER
+        if not background:
+            self.preempt_background()
+        slot = _Slot(lane)
+        await self._acquire(slot)
+        try:
+            if not background:
+                return await request_factory()
+            slot.loop = asyncio.get_running_loop()
+            slot.task = asyncio.ensure_future(request_factory())
+            with self._lock:
+                self._in_flight_background.add(slot)
+            try:
+                return await slot.task
+            except asyncio.CancelledError:
+                if slot.preempted:
+                    raise Preempted()
+                raise
+            finally:
+                with self._lock:
+                    self._in_flight_background.discard(slot)
+        finally:
+            self._release()
+
+    def preempt_background(self):
+        with self._lock:
+            slots = list(self._in_flight_background)
+        for slot in slots:
+            if slot.task is None or slot.task.done():
+                continue
+            slot.preempted = True
+            if slot.loop.is_closed():
+                continue
+            slot.loop.call_soon_threadsafe(slot.task.cancel)
+
+    @property
+    def waiting(self):
+        return len(self._waiting[USER]) + len(self._waiting[BACKGROUND])
+
+    async def _acquire(self, slot: _Slot):
+        with self._lock:
+            if self.active < self.limit and not self._waiting[USER] \
+                    and (slot.lane == USER or not self._waiting[BACKGROUND]):
+                self.active += 1
+                return
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._waiting[slot.lane].append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                lane = self._waiting[slot.lane]
+                if (loop, future) in lane:
+                    lane.remove((loop, future))
+                    raise
+            # The slot was already handed over. If it arrived, give it back; if
+            # it is still on its way, _grant gives it back when it lands.
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        with self._lock:
+            for lane in (USER, BACKGROUND):
+                while self._waiting[lane]:
+                    loop, future = self._waiting[lane].popleft()
+                    if future.done() or loop.is_closed():
+                        continue
+                    # the slot passes straight to the waiter, active is unchanged
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+            self.active -= 1
+
+    def _grant(self, future):
+        if future.cancelled():
+            self._release()
+            return
+        future.set_result(None)
@@ -0,0 +1,213 @@
+import heapq
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic, time
+
+# Upper bounds of the latency buckets, in milliseconds. A long poll with wait=1
+# legitimately takes up to ten seconds, so the buckets reach past that.
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+SLOW_REQUEST_MS = 500
+SLOWEST_KEPT = 20
+# Only requests this recent compete for a place among the slowest, otherwise one
+# bad minute after startup would sit in the list for good.
+SLOWEST_WINDOW_SECS = 15 * 60
+
+_current = ContextVar("request_timing", default=None)
+
+
+class RequestTiming(object):
+    __slots__ = ("route", "method", "target", "started", "wall_time", "stages", "status", "duration_ms",
+                 "waited_ms")
+
+    def __init__(self, route: str, method: str, target: str = None):
+        self.route = route
+        self.method = method
+        self.target = target
+        self.started = monotonic()
+        self.wall_time = time()
+        self.stages = []
+        self.status = None
+        self.duration_ms = None
+        self.waited_ms = 0.0
+
+    def add_stage(self, name: str, started: float, ended: float, waiting: bool = False):
+        ms = round((ended - started) * 1000, 1)
+        self.stages.append((name, round((started - self.started) * 1000, 1), ms))
+        if waiting:
+            self.waited_ms += ms
+
+    @property
+    def busy_ms(self):
+        """How long the request took, less the time it was waiting on purpose, as a long poll does."""
+        return round(max(self.duration_ms - self.waited_ms, 0), 1)
+
+    def to_dict(self, device_name: str = None):
+        return {
+            "route": self.route,
+            "method": self.method,
+            "target": self.target,
+            "device": device_name,
+            "status": self.status,
+            "at": self.wall_time,
+            "ms": self.duration_ms,
+            "busy_ms": self.busy_ms,
+            "stages": [{"name": n, "at_ms": at, "ms": ms} for n, at, ms in self.stages],
+        }
+
+
+class RouteStats(object):
+    __slots__ = ("count", "errors", "in_flight", "max_in_flight", "total_ms", "max_ms", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, ms: float, error: bool):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        for idx, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[idx] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, p: float):
+        """Upper bound of the bucket holding the p-th percentile, in ms."""
+        if self.count == 0:
+            return None
+        rank = p * self.count
+        seen = 0
+        for idx, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return LATENCY_BUCKETS_MS[idx] if idx < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "mean_ms": round(self.total_ms / self.count, 1) if self.count else None,
+            "max_ms": round(self.max_ms, 1),
+            "p50_ms": self.percentile(0.5),
+            "p90_ms": self.percentile(0.9),
+            "p99_ms": self.percentile(0.99),
+            "buckets": {(f"<={b}" if idx < len(LATENCY_BUCKETS_MS) else f">{LATENCY_BUCKETS_MS[-1]}"): n
+                        for idx, (b, n) in enumerate(zip(LATENCY_BUCKETS_MS + (None,), self.buckets)) if n},
+        }
+
+
+class RouteTimings(object):
+    """Latency per route, what is in flight, and the slowest recent requests.
+
+    The slow list keeps each request's stage breakdown - device lookup, adapter
+    call, the SOAP calls it made, building the response - which is what tells a
+    slow renderer apart from a slow Plex server or a slow route. It is ranked by
+    busy_ms, so a long poll waiting for a change is not slow for waiting.
+    """
+
+    def __init__(self, slowest_kept: int = SLOWEST_KEPT, slow_ms: float = SLOW_REQUEST_MS):
+        self.slowest_kept = slowest_kept
+        self.slow_ms = slow_ms
+        self.routes = {}
+        self._slowest = []
+        self._seq = 0
+        # Requests are timed on the main loop, but SOAP stages can be recorded
+        # from anywhere that inherits the request's context.
+        self._lock = threading.Lock()
+
+    def begin(self, route: str, method: str, target: str = None) -> RequestTiming:
+        timing = RequestTiming(route, method, target)
+        with self._lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = RouteStats()
+            stats.in_flight += 1
+            stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+        return timing
+
+    def end(self, timing: RequestTiming, status: int = None):
+        timing.duration_ms = round((monotonic() - timing.started) * 1000, 1)
+        timing.status = status
+        error = status is None or status >= 500
+        with self._lock:
+            stats = self.routes[timing.route]
+            stats.in_flight -= 1
+            stats.observe(timing.duration_ms, error)
+            if timing.busy_ms >= self.slow_ms:
+                self._keep_slow(timing)
+        return timing
+
+    def in_flight(self, route: str) -> int:
+        stats = self.routes.get(route)
+        return stats.in_flight if stats else 0
+
+    def _keep_slow(self, timing: RequestTiming):
+        cutoff = time() - SLOWEST_WINDOW_SECS
+        self._slowest = [e for e in self._slowest if e[2].wall_time >= cutoff]
+        heapq.heapify(self._slowest)
+        self._seq += 1
+        entry = (timing.busy_ms, self._seq, timing)
+        if len(self._slowest) < self.slowest_kept:
+            heapq.heappush(self._slowest, entry)
+        elif entry > self._slowest[0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self):
+        with self._lock:
+            return [t for _, _, t in sorted(self._slowest, reverse=True)]
+
+    def snapshot(self, device_names: dict = None):
+        device_names = device_names or {}
+        with self._lock:
+            routes = {route: stats.to_dict() for route, stats in sorted(self.routes.items())}
+        return {
+            "routes": routes,
+            "slowest": [t.to_dict(device_names.get(t.target)) for t in self.slowest()],
+        }
+
+
+timings = RouteTimings()
+
+
+def start_request(timing: RequestTiming):
+    return _current.set(timing)
+
+
+def finish_request(token):
+    _current.reset(token)
+
+
+def current_request() -> RequestTiming:
+    return _current.get()
+
+
+@contextmanager
+def stage(name: str, waiting: bool = False):
+    """Record how long the enclosed block took against the current request.
+
+    Does nothing outside a request, so the same code can run from the state
+    loops without noting anything. A `waiting` stage is not counted against
+    the request's busy_ms.
+    """
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    started = monotonic()
+    try:
+        yield
+    finally:
+        timing.add_stage(name, started, monotonic(), waiting)